@@ -1,46 +1,106 @@
-def abbreviate_methods(obj, prefix):
-  def get_unique_abbreviations(suffix):
-    abbreviations = []
-    for i in range(2, len(suffix) + 1):
-      abbreviations.append(suffix[:i])
-    return abbreviations
-
-  methods_dict = {}
-  duplicates = []
-  for attr_name in dir(obj):
-    if attr_name.startswith(prefix):
-      method = getattr(obj, attr_name)
-      suffix = attr_name[len(prefix):]
-      abbreviations = get_unique_abbreviations(suffix)
-      for abbreviation in abbreviations:
-        if abbreviation in methods_dict:
-          duplicates.append(abbreviation)
-        else:
-          methods_dict[abbreviation] = method
-  for abbreviation in duplicates:
-    if abbreviation in methods_dict:
-      del methods_dict[abbreviation]
-
-  return methods_dict
+MIN_ABBREVIATION = 2         # shortest abbreviation accepted, unless it is a whole name
+
+class Node:
+  def __init__(self):
+    self.children = {}
+    self.names = []          # the names that start with the path to this node
+
+
+class CommandTrie:
+  """Prefix tree of command names.  A name can be abbreviated as long
+  as the abbreviation is unique, and an exact name is always accepted,
+  even if it is the prefix of another one."""
+  def __init__(self):
+    self.root = Node()
+    self.values = {}
+
+  def add(self, name, value):
+    self.values[name] = value
+    node = self.root
+    node.names.append(name)
+    for c in name:
+      child = node.children.get(c)
+      if child is None:
+        child = node.children[c] = Node()
+      node = child
+      node.names.append(name)
+
+  def candidates(self, word):
+    """Names that start with word."""
+    node = self.root
+    for c in word:
+      node = node.children.get(c)
+      if node is None:
+        return []
+    return node.names
+
+  def lookup(self, word):
+    """Return (value, candidates).  value is None unless word names or
+    abbreviates exactly one command, candidates are the names that
+    start with word."""
+    if word in self.values:
+      return self.values[word], [word]
+    candidates = self.candidates(word)
+    if len(candidates) == 1 and len(word) >= MIN_ABBREVIATION:
+      return self.values[candidates[0]], candidates
+    return None, candidates
+
+  def complete(self, word):
+    """Return (completion, candidates), completion is what the candidates
+    have in common after word."""
+    candidates = self.candidates(word)
+    if not candidates:
+      return '', candidates
+    first = candidates[0]
+    end = len(first)
+    for name in candidates[1:]:
+      i = len(word)
+      while i < end and i < len(name) and name[i] == first[i]:
+        i += 1
+      end = i
+    return first[len(word):end], candidates
+
+
+def command_trie(cls, prefix='cmd_'):
+  """Return the CommandTrie of the methods of cls whose names start with
+  prefix.  <prefix>_<command> is a top level command, <prefix><group>_<command>
+  a command in group, whose value is the group's CommandTrie.  The trie
+  is built on first use and kept in the class, like Enum's name table."""
+  trie = cls.__dict__.get('_command_trie')
+  if trie is None:
+    trie = CommandTrie()
+    for attr_name in sorted(dir(cls)):
+      if not attr_name.startswith(prefix):
+        continue
+      group, _, command = attr_name[len(prefix):].partition('_')
+      if group:
+        group_trie = trie.values.get(group)
+        if group_trie is None:
+          group_trie = CommandTrie()
+          trie.add(group, group_trie)
+        group_trie.add(command, getattr(cls, attr_name))
+      else:
+        trie.add(command, getattr(cls, attr_name))
+    cls._command_trie = trie
+  return trie
 
 if __name__ == '__main__':
   # Example usage:
   class ExampleClass:
-    def pre_test(self):
+    def pre__test(self, args):
       print("test method")
 
-    def pre_run(self):
+    def pre__run(self, args):
       print("run method")
 
-    def pre_read(self):
-      print("read method")
+    def pre_show_read(self, args):
+      print("show read method")
 
   example = ExampleClass()
-  methods_map = abbreviate_methods(example, "pre_")
-
-  for key in methods_map:
-    print(f"{key}: {methods_map[key]}")
+  commands = command_trie(ExampleClass, "pre_")
 
-  methods_map['ru']()
-  methods_map['re']()
-  methods_map['tes']()
+  commands.lookup('ru')[0](example, [])
+  commands.lookup('te')[0](example, [])
+  commands.lookup('sh')[0].lookup('re')[0](example, [])
+  print(commands.complete('r'))
+  print(commands.lookup('xx'))
@@ -0,0 +1,215 @@
+import time
+import errno
+
+import telnet
+import log
+
+# Moves data between the PX-8 serial port and the socket of a modem
+# connection.  Both directions go through ring buffers that are
+# allocated once.  The socket is read whenever there is room for the
+# data, the UART gets only as much as it can send without blocking
+# the main loop, which is estimated from the baud rate.
+
+RING_SIZE = 2048
+RECV_SIZE = 256
+UART_READ_SIZE = 64
+TX_BURST = 32                # bytes that fit into the UART TX FIFO
+HIGH_WATER = RING_SIZE * 3 // 4
+LOW_WATER = RING_SIZE // 4
+RATE_INTERVAL = 1000         # ms over which the byte rates are measured
+
+FLOW_NONE = 'none'
+FLOW_XONXOFF = 'xonxoff'
+
+XON = 0x11
+XOFF = 0x13
+IAC = 0xff
+
+
+class RingBuffer:
+    def __init__(self, size):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.reset()
+
+    def reset(self):
+        self.start = 0
+        self.count = 0
+
+    def free(self):
+        return self.size - self.count
+
+    def write(self, data):
+        """Append as much of data as fits, return the number of bytes taken."""
+        count = min(len(data), self.size - self.count)
+        end = (self.start + self.count) % self.size
+        first = min(count, self.size - end)
+        self.view[end:end + first] = data[:first]
+        if count > first:
+            self.view[:count - first] = data[first:count]
+        self.count += count
+        return count
+
+    def readable(self):
+        """Return a memoryview of the contiguous data at the start."""
+        return self.view[self.start:min(self.start + self.count, self.size)]
+
+    def consume(self, count):
+        self.start = (self.start + count) % self.size
+        self.count -= count
+
+
+class Bridge:
+    def __init__(self, uart, baudrate):
+        self.uart = uart
+        self.baudrate = baudrate
+        self.parser = telnet.TelnetParser(RECV_SIZE)
+        self.to_px8 = RingBuffer(RING_SIZE)
+        self.to_socket = RingBuffer(RING_SIZE)
+        self.uart_buffer = bytearray(UART_READ_SIZE)
+        self.uart_view = memoryview(self.uart_buffer)
+        self.socket = None
+        self.open = False
+        self.start(None, FLOW_NONE)
+
+    def start(self, socket, flow):
+        self.socket = socket
+        self.open = socket is not None
+        self.flow = flow
+        self.parser.reset(socket)
+        self.to_px8.reset()
+        self.to_socket.reset()
+        self.px8_stopped = False                            # the PX-8 sent XOFF
+        self.px8_throttled = False                          # we told the PX-8 to stop
+        self.credit = TX_BURST
+        self.credit_time = time.ticks_us()
+        self.bytes_to_px8 = 0
+        self.bytes_from_px8 = 0
+        self.rate_to_px8 = 0
+        self.rate_from_px8 = 0
+        self.rate_time = time.ticks_ms()
+        self.rate_start = (0, 0)
+
+    def pending(self):
+        """Number of bytes received from the socket, not yet sent to the PX-8."""
+        return self.to_px8.count
+
+    def poll(self):
+        busy = self.receive_socket()
+        busy = self.write_uart() or busy
+        busy = self.read_uart() or busy
+        busy = self.send_socket() or busy
+        return busy
+
+    def close(self, reason, *args):
+        if self.open:
+            log.info(reason, *args)
+            self.open = False
+
+    def receive_socket(self):
+        room = min(self.to_px8.free(), RECV_SIZE)
+        if not self.open or not room:
+            return False
+        try:
+            data = self.socket.recv(room)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                self.close('Error %s reading from socket, closing connection', e)
+            return False
+        if not data:
+            self.close('Connection closed by remote')
+            return True
+        self.to_px8.write(self.parser.feed(data))
+        return True
+
+    def write_uart(self):
+        if self.px8_stopped or not self.to_px8.count:
+            return False
+        if self.uart.txdone():
+            self.credit = TX_BURST
+            self.credit_time = time.ticks_us()
+        else:
+            # one byte takes 10 bit times (start, 8 data, stop bit)
+            earned = time.ticks_diff(time.ticks_us(), self.credit_time) * self.baudrate // 10_000_000
+            if earned:
+                self.credit = min(self.credit + earned, TX_BURST)
+                self.credit_time = time.ticks_add(self.credit_time, earned * 10_000_000 // self.baudrate)
+        data = self.to_px8.readable()
+        count = min(len(data), self.credit)
+        if not count:
+            return False
+        self.uart.write(data[:count])
+        self.to_px8.consume(count)
+        self.credit -= count
+        self.bytes_to_px8 += count
+        return True
+
+    def read_uart(self):
+        available = self.uart.any()
+        # worst case every byte is an IAC that has to be doubled
+        room = min(available, self.to_socket.free() // 2, UART_READ_SIZE)
+        if not room:
+            return False
+        count = self.uart.readinto(self.uart_view[:room]) or 0
+        data = self.uart_view[:count]
+        if self.flow == FLOW_XONXOFF and (XON in data or XOFF in data):
+            data = self.filter_flow_control(data)
+        self.bytes_from_px8 += len(data)
+        start = 0
+        if IAC in data:
+            for i in range(len(data)):
+                if data[i] == IAC:
+                    self.to_socket.write(data[start:i + 1])
+                    self.to_socket.write(b'\xff')           # escape IAC for telnet
+                    start = i + 1
+        self.to_socket.write(data[start:])
+        if not self.px8_throttled and self.to_socket.count > HIGH_WATER:
+            self.throttle_px8(True)
+        return True
+
+    def filter_flow_control(self, data):
+        count = 0
+        for byte in data:
+            if byte == XOFF:
+                self.px8_stopped = True
+            elif byte == XON:
+                self.px8_stopped = False
+            else:
+                self.uart_buffer[count] = byte
+                count += 1
+        return self.uart_view[:count]
+
+    def throttle_px8(self, stop):
+        self.px8_throttled = stop
+        if self.flow == FLOW_XONXOFF:
+            self.uart.write(b'\x13' if stop else b'\x11')
+
+    def send_socket(self):
+        if not self.open or not self.to_socket.count:
+            return False
+        try:
+            count = self.socket.send(self.to_socket.readable())
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                self.close('Error %s writing to socket, closing connection', e)
+            return False
+        self.to_socket.consume(count)
+        if self.px8_throttled and self.to_socket.count < LOW_WATER:
+            self.throttle_px8(False)
+        return count > 0
+
+    def update_rates(self):
+        now = time.ticks_ms()
+        elapsed = time.ticks_diff(now, self.rate_time)
+        if elapsed < RATE_INTERVAL:
+            return
+        to_px8, from_px8 = self.rate_start
+        self.rate_to_px8 = (self.bytes_to_px8 - to_px8) * 1000 // elapsed
+        self.rate_from_px8 = (self.bytes_from_px8 - from_px8) * 1000 // elapsed
+        self.rate_time = now
+        self.rate_start = (self.bytes_to_px8, self.bytes_from_px8)
+
+    def status(self):
+        return (f'{self.rate_to_px8} bytes/s to PX-8 ({self.bytes_to_px8} total), '
+                f'{self.rate_from_px8} bytes/s from PX-8 ({self.bytes_from_px8} total)')
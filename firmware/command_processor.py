@@ -1,12 +1,14 @@
 import re
-import config
 import gc
-from abbrev import abbreviate_methods
+from abbrev import CommandTrie, command_trie
 from collections import deque
 import wifi
 import ramdisk
 import storage
 import uos
+import log
+import modem
+import dialer
 
 BANNER = '\r\nPicoX-8 configuration interface.  Type "help" for help\r\n\n'
 PROMPT = "picox-8> "
@@ -14,35 +16,75 @@ PROMPT = "picox-8> "
 CLEAN_RE = re.compile(r'^\s*(.*?)\s*$')
 SPLIT_RE = re.compile(r'\s+')
 NUMBER_RE = re.compile(r'^\d+$')
+SNAPSHOT_RE = re.compile(r'^[A-Za-z0-9_-]{1,8}$')
 
 MAXHISTORY = 30
+TX_CHUNK = 32                # bytes that fit into the UART TX FIFO
 
-class CommandProcessor:
+
+class TerminalOutput:
+  """Collects the output for a terminal, so that a command or a burst of
+  echoed characters becomes one write.  flush() sends what the terminal
+  can take without waiting: a UART gets TX_CHUNK bytes whenever its
+  transmitter is idle, so uart.write() never blocks the main loop and
+  the RAM-Disk, other terminals (telnet sessions queue their output
+  themselves) get all of it."""
   def __init__(self, terminal):
     self.terminal = terminal
-    self.cmd_abbrevs = abbreviate_methods(self, 'cmd__')
-    self.set_abbrevs = abbreviate_methods(self, 'cmd_set_')
-    self.show_abbrevs = abbreviate_methods(self, 'cmd_show_')
+    self.paced = hasattr(terminal, 'txdone')
+    self.buffer = bytearray()
+    self.sent = 0
+
+  def write(self, s):
+    self.buffer.extend(s.encode() if isinstance(s, str) else s)
+
+  def pending(self):
+    return len(self.buffer) - self.sent
+
+  def flush(self):
+    """Return True if something was sent."""
+    count = self.pending()
+    if not count:
+      return False
+    if self.paced:
+      if not self.terminal.txdone():
+        return False
+      count = min(count, TX_CHUNK)
+    self.terminal.write(memoryview(self.buffer)[self.sent:self.sent + count])
+    self.sent += count
+    if self.sent == len(self.buffer):
+      self.buffer = bytearray()
+      self.sent = 0
+    return True
+
+
+class CommandProcessor:
+  def __init__(self, terminal):
+    self.output = TerminalOutput(terminal)
+    self.commands = command_trie(type(self))
     self.history = deque([], MAXHISTORY)
     self.history_pointer = -1
-    self.terminal.write(BANNER)
+    self.output.write(BANNER)
     self.reset()
     self.done = False
+    self.output.flush()
 
 
   def reset(self):
     self.line_buffer = ''
-    self.terminal.write(PROMPT)
+    self.output.write(PROMPT)
 
 
   def say(self, s):
-    self.terminal.write(f'{s}\r\n')
+    self.output.write(f'{s}\r\n')
 
   def cmd__help(self, args):
     self.say("""\
 PicoX-8 configuration command help\r
 \r
 show status                            Show system status\r
+show log [<count>]                     Show recent log messages\r
+show modem                             Show modem state statistics\r
 
 set wifi <ssid> <password>             Set WiFi SSID and password\r
 set phonebook <number> <host>[:<port>] Set phonebook entry\r
@@ -50,23 +92,60 @@ show phonebook                         Show phonebook\r
 
 ls                                     List files on SD-Card\r
 set ramdisk <filename>                 Set RAM-Disk file\r
+show ramdisk                           Show RAM-Disk files\r
+snapshot <name>                        Keep RAM-Disk contents, write changes aside\r
+rollback                               Return RAM-Disk to the snapshot\r
+commit                                 Keep changes made since the snapshot\r
+show snapshot                          Show RAM-Disk snapshot\r
 
-quit                                   Exit configuration""")
+quit                                   Exit configuration\r
+\r
+Commands can be abbreviated, <Tab> completes them""")
 
 
   def cmd_show_status(self, args):
     gc.collect()
     self.say(f'Free memory: {gc.mem_free()}')
     self.say(f'WiFi status: {wifi.status()}')
+    self.say(f'DNS cache  : {dialer.cache.status()}')
     mounted = 'mounted' if storage.sdcard_mounted() else 'not mounted'
     self.say(f'SD-Card    : {ramdisk.instance.get_file()}')
+    baudrate = storage.sdcard_baudrate()
+    if baudrate:
+      self.say(f'SD clock   : {baudrate // 1000} kHz')
+    if modem.instance and modem.instance.bridge.open:
+      self.say(f'Modem link : {modem.instance.bridge.status()}')
+
+
+  def cmd_show_log(self, args):
+    if len(args) > 1 or (args and not NUMBER_RE.match(args[0])):
+      self.say(f'Incorrect arguments to "show log", try "help"')
+      return
+    count = int(args[0]) if args else 20
+    for line in log.lines(count):
+      self.say(line)
+
+
+  def cmd_show_modem(self, args):
+    if len(args) != 0:
+      self.say(f'Extra argument(s) to "show modem", try "help"')
+      return
+    instance = modem.instance
+    if not instance:
+      self.say('Modem not initialized')
+      return
+    self.say(f'Modem state: {modem.State.get_name(instance.state)}')
+    self.say(f'State               Visits  Time (ms)  Events  Ignored')
+    self.say(f'------------------------------------------------------')
+    for name, visits, time_ms, events, ignored in instance.state_stats():
+      self.say(f'{name:<19} {visits:>6} {time_ms:>10} {events:>7} {ignored:>8}')
 
 
   def cmd_set_wifi(self, args):
     if len(args) != 2:
       self.say(f'Incorrect arguments to "set wifi", need SSID and key')
       return
-    config.set('wifi', args)
+    wifi.credentials.set(args)
     wifi.connect()
 
 
@@ -88,11 +167,9 @@ quit                                   Exit configuration""")
       return
     port = int(port)
     # fixme check number and port for digits only
-    phonebook = config.get('phonebook', {})
+    phonebook = modem.phonebook.value
     phonebook[number] = [host, port]
-
-    config.set('phonebook', phonebook)
-    config.save()
+    modem.phonebook.set(phonebook)
     self.say(f'Phonebook entry for number {number} saved')
 
 
@@ -100,8 +177,8 @@ quit                                   Exit configuration""")
     if len(args) != 0:
       self.say(f'Extra argument(s) to "show phonebook", try "help"')
       return
-    phonebook = config.get('phonebook', None)
-    if phonebook == None:
+    phonebook = modem.phonebook.value
+    if not phonebook:
       self.say('No phonebook entries defined')
     else:
       self.say(f'Number     Host')
@@ -116,8 +193,7 @@ quit                                   Exit configuration""")
       self.say(f'Extra argument(s) to "ls", try "help"')
       return
 
-    storage.umount_sdcard()
-    if not storage.mount_sdcard():
+    if not storage.card_present() and not storage.mount_sdcard():
       self.say('No SD-Card found')
       return
     files = storage.listdir()
@@ -143,28 +219,74 @@ quit                                   Exit configuration""")
     self.say(f'RAM-Disk file {name} mounted')
 
 
-  def cmd__set(self, args):
-    if len(args) == 0:
-      self.say(f'Missing argument to "set", try "help"')
+  def cmd_show_ramdisk(self, args):
+    if len(args) != 0:
+      self.say(f'Extra argument(s) to "show ramdisk", try "help"')
+      return
+    instance = ramdisk.instance
+    self.say(f'File                 State')
+    self.say(f'-------------------------------')
+    for name in instance.get_images():
+      if name == instance.get_file():
+        state = 'active'
+      elif instance.image_open(name):
+        state = 'open'
+      else:
+        state = ''
+      self.say(f'{name:<20} {state}')
+
+
+  def cmd__snapshot(self, args):
+    if len(args) != 1 or not SNAPSHOT_RE.match(args[0]):
+      self.say('"snapshot" needs a name of up to 8 letters and digits')
       return
-    command, *args = args
-    if command in self.set_abbrevs:
-      method = self.set_abbrevs[command]
-      method(args)
+    instance = ramdisk.instance
+    if instance.read_only:
+      self.say('RAM-Disk is read-only')
+      return
+    if instance.get_snapshot():
+      self.say(f'RAM-Disk already has snapshot {instance.get_snapshot()}, "commit" or "rollback" first')
+      return
+    instance.take_snapshot(args[0])
+    self.say(f'Snapshot {args[0]} of {instance.get_file()} taken')
+
+
+  def end_snapshot(self, args, commit):
+    command = 'commit' if commit else 'rollback'
+    if len(args) != 0:
+      self.say(f'Unexpected argument(s) to "{command}", try "help"')
+      return
+    instance = ramdisk.instance
+    name = instance.get_snapshot()
+    if not name or not instance.overlay:
+      self.say('RAM-Disk has no snapshot')
+      return
+    count = instance.snapshot_sectors()
+    instance.drop_snapshot(commit)
+    if commit:
+      self.say(f'{count} sector(s) changed since snapshot {name} committed')
     else:
-      self.say(f'Unknown command "set {command}", try "help"')
+      self.say(f'RAM-Disk rolled back to snapshot {name}, {count} sector(s) discarded')
+
+
+  def cmd__rollback(self, args):
+    self.end_snapshot(args, False)
+
+
+  def cmd__commit(self, args):
+    self.end_snapshot(args, True)
 
 
-  def cmd__show(self, args):
-    if len(args) == 0:
-      self.say(f'Missing argument to "show", try "help"')
+  def cmd_show_snapshot(self, args):
+    if len(args) != 0:
+      self.say(f'Extra argument(s) to "show snapshot", try "help"')
       return
-    command, *args = args
-    if command in self.show_abbrevs:
-      method = self.show_abbrevs[command]
-      method(args)
+    instance = ramdisk.instance
+    name = instance.get_snapshot()
+    if not name:
+      self.say('RAM-Disk has no snapshot')
     else:
-      self.say(f'Unknown command "show {command}", try "help"')
+      self.say(f'Snapshot {name} of {instance.get_file()}, {instance.snapshot_sectors()} sector(s) changed')
 
 
   def cmd__quit(self, args):
@@ -175,18 +297,54 @@ quit                                   Exit configuration""")
     self.done = True
 
   def execute_command(self, command, args):
-    if command in self.cmd_abbrevs:
-      method = self.cmd_abbrevs[command]
-      method(args)
-    else:
-      self.say(f'Unknown command "{command}", try "help"')
+    # command groups ("set", "show") are nested tries
+    commands = self.commands
+    group = ''
+    while True:
+      method, candidates = commands.lookup(command)
+      if method is None:
+        if len(candidates) > 1:
+          self.say(f'Ambiguous command "{group}{command}", could be {", ".join(candidates)}')
+        else:
+          self.say(f'Unknown command "{group}{command}", try "help"')
+        return
+      if not isinstance(method, CommandTrie):
+        method(self, args)
+        return
+      group += candidates[0] + ' '
+      if len(args) == 0:
+        self.say(f'Missing argument to "{group.strip()}", try "help"')
+        return
+      commands = method
+      command, *args = args
+
+
+  def complete_input(self):
+    words = SPLIT_RE.split(self.line_buffer.lstrip())
+    commands = self.commands
+    for word in words[:-1]:
+      commands, _ = commands.lookup(word)
+      if not isinstance(commands, CommandTrie):
+        self.output.write('\x07')                         # only command names are completed
+        return
+    completion, candidates = commands.complete(words[-1])
+    if not candidates:
+      self.output.write('\x07')
+      return
+    if len(candidates) == 1:
+      completion += ' '
+    elif not completion:
+      self.output.write('\r\n' + '  '.join(candidates) + '\r\n' + PROMPT + self.line_buffer)
+      return
+    self.output.write(completion)
+    self.line_buffer += completion
 
 
   def erase_input(self):
     count = len(self.line_buffer)
-    self.terminal.write('\b' * count)
-    self.terminal.write(' ' * count)
-    self.terminal.write('\b' * count)
+    self.output.write('\b' * count)
+    self.output.write(' ' * count)
+    self.output.write('\b' * count)
     self.line_buffer = ''
 
 
@@ -194,12 +352,14 @@ quit                                   Exit configuration""")
     if isinstance(c, int):
       c = chr(c)
     if ord(c) >= 32 and ord(c) < 127:
-      self.terminal.write(c)
+      self.output.write(c)
       self.line_buffer += c
     elif c == '\b' or c == '\x7f':                          # BS and DEL delete char
       if self.line_buffer != '':
-        self.terminal.write('\b \b')
+        self.output.write('\b \b')
         self.line_buffer = self.line_buffer[:-1]
+    elif c == '\t':                                         # Tab completes the command name
+      self.complete_input()
     elif c == '\x15':                                       # Ctrl-U erase input
       self.erase_input()
     elif c == '\x10':                                       # Ctrl-P previous history entry
@@ -209,9 +369,9 @@ quit                                   Exit configuration""")
         self.history_pointer += 1
         self.erase_input()
         self.line_buffer = self.history[self.history_pointer]
-        self.terminal.write(self.line_buffer)
+        self.output.write(self.line_buffer)
       else:
-        self.terminal.write('\x07')                         # Beep
+        self.output.write('\x07')                         # Beep
     elif c == '\x0e':                                       # Ctrl-N next history entry
       if self.history_pointer >= 0:
         self.history_pointer -= 1
@@ -220,9 +380,9 @@ quit                                   Exit configuration""")
           self.line_buffer = self.save_input
         else:
           self.line_buffer = self.history[self.history_pointer]
-        self.terminal.write(self.line_buffer)
+        self.output.write(self.line_buffer)
     elif c == '\x0d':                                       # CR
-      self.terminal.write('\r\n')
+      self.output.write('\r\n')
       input = re.sub(CLEAN_RE, r'\1', self.line_buffer)
       if input != '':
         if not len(self.history) or input != self.history[0]:
@@ -237,16 +397,27 @@ quit                                   Exit configuration""")
   def userinput(self, data):
     for c in data:
       self.handle_user_char(c)
+    self.output.flush()
     return self.done
 
 
+  def flush(self):
+    """Send more of the output, called from the main loop while the
+    output is pending."""
+    return self.output.flush()
+
+
+  def output_pending(self):
+    return self.output.pending()
+
+
 if __name__ == '__main__':
   import tty
   import termios
   import sys
   save_attr = termios.tcgetattr(0)
   tty.setraw(0)
-  cp = CommandProcessor(sys.stdout)
+  cp = CommandProcessor(sys.stdout.buffer)
   sys.stdout.flush()
   try:
     while True:
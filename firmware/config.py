@@ -1,29 +1,162 @@
 import json
 import errno
+import binascii
+import os
+import time
+import log
 
-def load():
+# The configuration is kept in config.json.  Changes are written back
+# by flush(), called when the main loop is idle, FLUSH_DELAY ms after
+# the last one, so that a burst of changes costs one write.  The new
+# contents go to a temporary file first, followed by a line with their
+# CRC32, and replace config.json by renaming; the previous version is
+# kept as a backup.  load() takes the first of config.json, the
+# temporary file and the backup whose checksum matches, so a power
+# loss during a write leaves either the old or the new configuration.
+#
+# Modules declare their settings with setting(), which checks the type
+# (and the allowed values) of what was loaded and of every change.  A
+# Setting's value attribute is kept up to date, so readers don't look
+# the key up each time.
+
+CONFIG_FILE = 'config.json'
+TEMP_FILE = 'config.json.tmp'
+BACKUP_FILE = 'config.json.bak'
+FLUSH_DELAY = 2000           # ms without changes before they are written
+
+CHECKSUM_PREFIX = '#crc32 '
+
+
+def checksum(text):
+  return '%08x' % (binascii.crc32(text.encode()) & 0xffffffff)
+
+
+def read(filename):
+  """Return the configuration in filename, or None if it is missing or
+  its checksum does not match.  Files without a checksum line are
+  accepted, they were written before checksums were added."""
   try:
-    with open("config.json", "r") as f:
-      return json.loads(f.read())
+    with open(filename, 'r') as f:
+      text = f.read()
   except OSError as exc:
     if exc.errno == errno.ENOENT:
-      return {}
-    else:
-      raise exc
+      return None
+    raise exc
+  end = text.rfind('\n' + CHECKSUM_PREFIX)
+  if end >= 0:
+    if text[end + 1 + len(CHECKSUM_PREFIX):].strip() != checksum(text[:end]):
+      log.warning('%s: checksum mismatch', filename)
+      return None
+    text = text[:end]
+  try:
+    return json.loads(text)
+  except ValueError:
+    log.warning('%s: not valid JSON', filename)
+    return None
+
+
+def load():
+  for filename in (CONFIG_FILE, TEMP_FILE, BACKUP_FILE):
+    values = read(filename)
+    if values is not None:
+      if filename != CONFIG_FILE:
+        log.warning('Configuration restored from %s', filename)
+      return values
+  return {}
+
+
+def remove(filename):
+  try:
+    os.remove(filename)
+  except OSError:
+    pass
+
 
 def save():
-  with open("config.json", "w") as f:
-    f.write(json.dumps(config))
+  """Write the configuration now."""
+  global dirty
+  text = json.dumps(config)
+  with open(TEMP_FILE, 'w') as f:
+    f.write(text)
+    f.write('\n' + CHECKSUM_PREFIX + checksum(text) + '\n')
+  remove(BACKUP_FILE)
+  try:
+    os.rename(CONFIG_FILE, BACKUP_FILE)
+  except OSError:
+    pass                                                    # first save
+  os.rename(TEMP_FILE, CONFIG_FILE)
+  dirty = False
+
+
+def flush():
+  """Write pending changes once FLUSH_DELAY has passed since the last one."""
+  if dirty and time.ticks_diff(time.ticks_ms(), changed) >= FLUSH_DELAY:
+    save()
+
+
+def changed_now():
+  global dirty, changed
+  dirty = True
+  changed = time.ticks_ms()
+
+
+class Setting:
+  def __init__(self, key, type, default, choices=None, check=None):
+    self.key = key
+    self.type = type
+    self.default = default
+    self.choices = choices
+    self.check = check
+    self.value = default
+    if key in config:
+      try:
+        self.validate(config[key])
+        self.value = config[key]
+      except ValueError as e:
+        log.warning('Ignoring configured %s: %s', key, e)
+
+  def validate(self, value):
+    if value is None and self.default is None:
+      return
+    if not isinstance(value, self.type):
+      raise ValueError(f'{self.key} must be a {self.type.__name__}')
+    if self.choices and value not in self.choices:
+      raise ValueError(f'{self.key} must be one of {", ".join(str(choice) for choice in self.choices)}')
+    if self.check and not self.check(value):
+      raise ValueError(f'invalid {self.key} {value!r}')
+
+  def set(self, value):
+    """Raises ValueError if value does not fit the setting."""
+    self.validate(value)
+    self.value = value
+    config[self.key] = value
+    changed_now()
+
 
-  
 config = load()
+dirty = False
+changed = time.ticks_ms()
+settings = {}
+
+
+def setting(key, type, default, choices=None, check=None):
+  """Declare the setting key and return its Setting."""
+  settings[key] = Setting(key, type, default, choices, check)
+  return settings[key]
+
 
 def get(key, default):
+  if key in settings:
+    return settings[key].value
   if key in config:
     return config[key]
   else:
     return default
 
+
 def set(key, value):
-  config[key] = value
-  save()
+  if key in settings:
+    settings[key].set(value)
+  else:
+    config[key] = value
+    changed_now()
@@ -1,4 +1,5 @@
 from machine import Pin, UART
+import array
 import rp2
 from rp2 import PIO
 
@@ -9,20 +10,24 @@ PIN_DIR = Pin(11, Pin.OUT, Pin.PULL_DOWN)
 PIN_STB = Pin(12, Pin.OUT, Pin.PULL_DOWN)
 PIN_ADDR = [Pin(i, Pin.OUT) for i in range(13, 16)]
 
-ADDR_BITS_POS = 11 # relative to pin 2
+ADDR_BITS_POS = 12 # relative to pin 2, plus the wait flag bit
+DATA_BITS_POS = 1
 
 # Bit mask for 32 bit command word that is sent from MicroPython to
-# the PIO state machine.  The upper half of this command word defines
-# the direction bits, the lower half defines the data bits.  DIR, STB
-# and the ADDR bits are always configured as outputs.  When writing,
-# the data bits are also configured as outputs, and the DIR bit is set
-# to one.  The MSB is an additional read/write indicator that needs to
-# be set to 1 for read operations.  It is used by the PIO state
-# machine to skip reading from the data lines into the FIFO when
-# writing.
-STB_MASK   = 0b00111110_00000000_00000100_00000000
+# the PIO state machine.  Bit 0 is the wait flag: When it is set, the
+# state machine polls the IRQ register until the IBF bit is clear
+# before executing the command, so the PX-8 has picked up the previous
+# byte.  Bits 1-16 define the data bits, bits 17-30 the direction
+# bits.  DIR, STB and the ADDR bits are always configured as outputs.
+# When writing, the data bits are also configured as outputs, and the
+# DIR bit is set to one.  The MSB is an additional read/write
+# indicator that needs to be set to 1 for read operations.  It is used
+# by the PIO state machine to skip reading from the data lines into
+# the FIFO when writing.
+WAIT_MASK  = 0b00000000_00000000_00000000_00000001
+STB_MASK   = 0b01111100_00000000_00001000_00000000
 READ_MASK  = 0b10000000_00000000_00000000_00000000
-WRITE_MASK = 0b00000000_11111111_00000010_00000000
+WRITE_MASK = 0b00000001_11111110_00000100_00000000
 
 # IRQ register bits
 IRQ_TONE_DIALER     = 0x01
@@ -46,20 +51,48 @@ REG_IRQ             = 7
 # PIO program to communicate to the CPLD
 @rp2.asm_pio(out_shiftdir=PIO.SHIFT_RIGHT,
              out_init=(PIO.IN_LOW,)*8 + (PIO.IN_LOW, PIO.OUT_LOW, PIO.OUT_LOW) + (PIO.OUT_LOW,)*3,
+             set_init=(PIO.OUT_LOW,)*5,
              autopush=False, autopull=False)
 def cpld_interface():
     CLK_PIN = 8 # (GP10)
+    # Pull the IBF poll command word once, it is kept in Y
+    pull()
+    mov(y, osr)
+
+    wrap_target()
     # Pull 32-bit value from FIFO
     pull()
 
+    # Skip the IBF handshake unless the wait flag is set
+    out(x, 1)
+    jmp(not_x, "cycle")
+    mov(x, osr)
+
+    # Read the IRQ register until the IBF bit (jmp pin) reads as zero
+    label("poll")
+    mov(osr, y)
+    wait(0, pin, CLK_PIN)
+    wait(1, pin, CLK_PIN)
+    out(pins, 16)
+    out(pindirs, 14)
+    wait(0, pin, CLK_PIN)
+    jmp(pin, "poll")
+
+    # Drop STB for one cycle so that the CPLD stops driving the data
+    # lines before we drive them
+    wait(1, pin, CLK_PIN)
+    set(pins, 0)
+    mov(osr, x)
+
+    label("cycle")
     # Wait for rising edge on CLK
     wait(0, pin, CLK_PIN)
     wait(1, pin, CLK_PIN)
 
-    # Output data bits to pins (DATA, CLK, DIR, STB, ADDR + extra)
+    # Output data bits to pins (DATA, CLK, DIR, STB, ADDR)
     out(pins, 16)
     # Output pindirs bits to set pin directions
-    out(pindirs, 15)
+    out(pindirs, 14)
 
     # Wait for falling edge on CLK
     wait(0, pin, CLK_PIN)
@@ -84,16 +117,45 @@ def cpld_interface():
     out(pindirs, 16)
 
 
-# Create and configure the state machine
-cpld_sm = rp2.StateMachine(0, cpld_interface, freq=24_000_000, in_base=Pin(2), out_base=Pin(2))
+def read_command(address):
+    return (address << ADDR_BITS_POS) | STB_MASK | READ_MASK
+
+
+def write_command(address, data):
+    return (address << ADDR_BITS_POS) | STB_MASK | WRITE_MASK | (data << DATA_BITS_POS)
+
+
+# Create and configure the state machine.  The jmp pin is data bit 4,
+# which carries IRQ_RAMDISK_IBF while the IRQ register is read.
+cpld_sm = rp2.StateMachine(0, cpld_interface, freq=24_000_000, in_base=Pin(2), out_base=Pin(2),
+                           set_base=Pin(11), jmp_pin=Pin(6))
 cpld_sm.active(1)
+cpld_sm.put(read_command(REG_IRQ) >> 1)
+
+stream_buffer = array.array('I', [0] * 256)
 
 
 # Initialize the state machine
 def write_reg(address, data):
-    cpld_sm.put((address << ADDR_BITS_POS) | STB_MASK | WRITE_MASK | data)
+    cpld_sm.put(write_command(address, data))
 
 
 def read_reg(address):
-    cpld_sm.put((address << ADDR_BITS_POS) | STB_MASK | READ_MASK)
+    cpld_sm.put(read_command(address))
     return cpld_sm.get()
+
+
+# Queue all bytes in buf for writing to the register.  If wait_ibf is
+# true, the state machine waits for the PX-8 to read each byte before
+# writing the next one, so no IRQ register polling is needed here.
+def write_stream(address, buf, wait_ibf=True):
+    base = write_command(address, 0)
+    if wait_ibf:
+        base |= WAIT_MASK
+    count = len(buf)
+    if count > len(stream_buffer):
+        raise ValueError('stream too long')
+    words = stream_buffer
+    for i in range(count):
+        words[i] = base | (buf[i] << DATA_BITS_POS)
+    cpld_sm.put(memoryview(words)[:count])
@@ -0,0 +1,302 @@
+import socket
+import select
+import errno
+import struct
+import time
+
+import log
+
+# Call setup without blocking the main loop.  Host names are looked up
+# with a DNS query over UDP that is polled like the connection itself,
+# as getaddrinfo() would block until the name server answers.
+
+DNS_PORT = 53
+DNS_TIMEOUT = 1500           # ms to wait for an answer before asking again
+DNS_ATTEMPTS = 3
+CONNECT_TIMEOUT = 15000      # ms
+
+CACHE_SIZE = 16              # (host, port) entries kept, least recently used are evicted
+MIN_TTL = 60                 # s, bounds for the time an answer is kept
+MAX_TTL = 3600
+NEGATIVE_TTL = 60            # s that a failed lookup is kept
+
+TYPE_A = 1
+CLASS_IN = 1
+
+# Call.poll() results
+RESOLVING = 0
+CONNECTING = 1
+CONNECTED = 2
+FAILED_LOOKUP = 3
+FAILED_CONNECT = 4
+
+
+def is_ip_address(host):
+    parts = host.split('.')
+    return len(parts) == 4 and all(part.isdigit() and int(part) < 256 for part in parts)
+
+
+def build_query(query_id, host):
+    packet = bytearray(struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0))   # recursion desired
+    for label in host.split('.'):
+        packet.append(len(label))
+        packet.extend(label.encode())
+    packet.extend(struct.pack('!BHH', 0, TYPE_A, CLASS_IN))
+    return packet
+
+
+def skip_name(data, offset):
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xc0 == 0xc0:                           # compression pointer
+            return offset + 2
+        offset += length + 1
+
+
+def parse_response(data, query_id):
+    """Return (address, ttl) from a DNS response, or None if data is not
+    the answer to query_id.  Raises OSError if the name has no address."""
+    if len(data) < 12:
+        return None
+    response_id, flags, questions, answers = struct.unpack('!HHHH', data[:8])
+    if response_id != query_id or not flags & 0x8000:
+        return None
+    if flags & 0x000f:
+        raise OSError(errno.ENOENT)                         # NXDOMAIN, SERVFAIL, ...
+    offset = 12
+    for _ in range(questions):
+        offset = skip_name(data, offset) + 4
+    for _ in range(answers):
+        offset = skip_name(data, offset)
+        rtype, rclass, ttl, length = struct.unpack('!HHIH', data[offset:offset + 10])
+        offset += 10
+        if rtype == TYPE_A and rclass == CLASS_IN and length == 4:
+            return '.'.join(str(byte) for byte in data[offset:offset + 4]), ttl
+        offset += length
+    raise OSError(errno.ENOENT)
+
+
+class DnsQuery:
+    def __init__(self, host, server):
+        self.host = host
+        self.id = time.ticks_us() & 0xffff
+        self.packet = build_query(self.id, host)
+        self.server = (server, DNS_PORT)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.attempts = 0
+        self.send()
+
+    def send(self):
+        self.attempts += 1
+        self.deadline = time.ticks_add(time.ticks_ms(), DNS_TIMEOUT)
+        self.socket.sendto(self.packet, self.server)
+
+    def close(self):
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+    def poll(self):
+        """Return (address, ttl) once the answer has arrived, else None.
+        Raises OSError if the lookup failed."""
+        try:
+            data = self.socket.recv(512)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                self.close()
+                raise
+            if time.ticks_diff(time.ticks_ms(), self.deadline) >= 0:
+                if self.attempts >= DNS_ATTEMPTS:
+                    self.close()
+                    raise OSError(errno.ETIMEDOUT)
+                self.send()
+            return None
+        try:
+            result = parse_response(data, self.id)
+        except Exception:                                   # negative or malformed answer
+            self.close()
+            raise OSError(errno.ENOENT)
+        if result:
+            self.close()
+        return result
+
+
+class DnsCache:
+    """Addresses of recently called hosts, keyed by (host, port).
+
+    Answers are kept for their TTL (within MIN_TTL and MAX_TTL), failed
+    lookups for NEGATIVE_TTL.  prewarm() queues lookups for hosts that
+    are likely to be called, e.g. the phonebook when WiFi comes up;
+    they are run one at a time from poll()."""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.entries = {}                                   # (host, port) -> [address or None, expires, last used]
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.queue = []
+        self.query = None
+        self.dns_server = None
+
+    def lookup(self, host, port):
+        """Return the cached address, False for a cached failure or None
+        if the host is not in the cache."""
+        key = (host, port)
+        entry = self.entries.get(key)
+        now = time.ticks_ms()
+        if entry and time.ticks_diff(entry[1], now) <= 0:
+            del self.entries[key]
+            entry = None
+        if not entry:
+            self.misses += 1
+            return None
+        entry[2] = now
+        if entry[0] is None:
+            self.negative_hits += 1
+            return False
+        self.hits += 1
+        return entry[0]
+
+    def put(self, host, port, address, ttl=NEGATIVE_TTL):
+        """Store address for ttl seconds, or a failed lookup if address is None."""
+        key = (host, port)
+        if key not in self.entries and len(self.entries) >= self.size:
+            oldest = None
+            for other, entry in self.entries.items():
+                if oldest is None or time.ticks_diff(entry[2], self.entries[oldest][2]) < 0:
+                    oldest = other
+            del self.entries[oldest]
+        if address is not None:
+            ttl = min(max(ttl, MIN_TTL), MAX_TTL)
+        now = time.ticks_ms()
+        self.entries[key] = [address, time.ticks_add(now, ttl * 1000), now]
+
+    def prewarm(self, hosts, dns_server):
+        self.dns_server = dns_server
+        for host, port in hosts:
+            key = (host, port)
+            if not is_ip_address(host) and key not in self.entries and key not in self.queue:
+                self.queue.append(key)
+
+    def poll(self):
+        if not self.query:
+            if not self.queue or not self.dns_server:
+                return
+            host, port = self.queue.pop(0)
+            try:
+                self.query = DnsQuery(host, self.dns_server)
+            except OSError:
+                return
+            self.query_key = (host, port)
+        host, port = self.query_key
+        try:
+            result = self.query.poll()
+        except OSError as e:
+            log.info('prewarming %s failed: %s', host, e)
+            self.put(host, port, None)
+            self.query = None
+            return
+        if result:
+            address, ttl = result
+            self.put(host, port, (address, port), ttl)
+            self.query = None
+
+    def status(self):
+        return (f'{len(self.entries)} entries, {self.hits} hits, {self.negative_hits} negative hits, '
+                f'{self.misses} misses')
+
+
+cache = DnsCache()
+
+
+class Call:
+    """A TCP connection being set up to host:port.  poll() advances the
+    setup without blocking and returns one of RESOLVING, CONNECTING,
+    CONNECTED, FAILED_LOOKUP or FAILED_CONNECT."""
+
+    def __init__(self, host, port, dns_server, cache=None):
+        self.host = host
+        self.port = port
+        self.cache = cache
+        self.socket = None
+        self.poller = None
+        self.query = None
+        self.started = time.ticks_ms()
+        address = cache.lookup(host, port) if cache and not is_ip_address(host) else None
+        if is_ip_address(host):
+            self.connect(host)
+        elif address:
+            self.connect(address[0])
+        elif address is False:
+            self.fail(FAILED_LOOKUP, 'lookup failed recently')
+        elif dns_server:
+            self.state = RESOLVING
+            try:
+                self.query = DnsQuery(host, dns_server)
+            except OSError as e:
+                self.fail(FAILED_LOOKUP, e)
+        else:
+            self.fail(FAILED_LOOKUP, 'no name server')
+
+    def fail(self, state, reason):
+        log.info('call to %s:%d failed: %s', self.host, self.port, reason)
+        self.state = state
+        self.close()
+
+    def close(self):
+        """Give up the call.  A connected socket is closed too, unless the
+        caller has taken it over and set socket to None."""
+        if self.query:
+            self.query.close()
+            self.query = None
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+    def connect(self, address):
+        self.state = CONNECTING
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setblocking(False)
+        try:
+            self.socket.connect((address, self.port))
+        except OSError as e:
+            if e.errno != errno.EINPROGRESS:
+                self.fail(FAILED_CONNECT, e)
+                return
+        self.poller = select.poll()
+        self.poller.register(self.socket, select.POLLOUT | select.POLLERR | select.POLLHUP)
+
+    def poll(self):
+        if self.state == RESOLVING:
+            try:
+                result = self.query.poll()
+            except OSError as e:
+                if self.cache:
+                    self.cache.put(self.host, self.port, None)
+                self.fail(FAILED_LOOKUP, e)
+                return self.state
+            if result:
+                self.query = None
+                address, ttl = result
+                log.info('%s resolved to %s', self.host, address)
+                if self.cache:
+                    self.cache.put(self.host, self.port, (address, self.port), ttl)
+                self.connect(address)
+        elif self.state == CONNECTING:
+            for _, event in self.poller.poll(0):
+                if event & (select.POLLERR | select.POLLHUP):
+                    self.fail(FAILED_CONNECT, 'connection refused')
+                    return self.state
+                if event & select.POLLOUT:
+                    self.poller.unregister(self.socket)
+                    self.state = CONNECTED
+                    log.info('connected to %s:%d after %d ms', self.host, self.port,
+                             time.ticks_diff(time.ticks_ms(), self.started))
+                    return self.state
+            if time.ticks_diff(time.ticks_ms(), self.started) > CONNECT_TIMEOUT:
+                self.fail(FAILED_CONNECT, 'timeout')
+        return self.state
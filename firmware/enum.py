@@ -1,10 +1,40 @@
 class Enum():
+  # The value -> name table of a class is built on first use and stored
+  # in the class itself.  Lookups check cls.__dict__ rather than using
+  # getattr, so that a subclass does not pick up the table of its base.
+  _unknown = "UNKNOWN"
+
   @classmethod
   def _create_name_mapping(cls):
     return {value: name for name, value in cls.__dict__.items() if isinstance(value, int)}
 
+  @classmethod
+  def _names(cls):
+    names = cls.__dict__.get('_name_table')
+    if names is None:
+      names = cls._create_name_mapping()
+      cls._name_table = names
+    return names
+
+  @classmethod
+  def items(cls):
+    """(value, name) pairs of the members."""
+    return cls._names().items()
+
   @classmethod
   def get_name(cls, value):
-      name_mapping = cls._create_name_mapping()
-      return name_mapping.get(value, "UNKNOWN")
+    return cls._names().get(value, cls._unknown)
 
+  @classmethod
+  def get_names(cls, value):
+    """Names of the single bit members that are set in value, for flag
+    enums.  Visits only the set bits, lowest first."""
+    names = cls._names()
+    result = []
+    while value > 0:
+      bit = value & -value
+      name = names.get(bit)
+      if name:
+        result.append(name)
+      value ^= bit
+    return result
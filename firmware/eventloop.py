@@ -0,0 +1,149 @@
+import time
+import machine
+import cpld
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+# The CPLD has no interrupt line to the Pico, so the IRQ register is
+# still read in each pass.  After IDLE_PASSES passes without anything
+# to do, the loop calls machine.idle() between reads, which sleeps
+# until the next interrupt (UART, USB, timer) or for at most 1 ms.
+IDLE_PASSES = 50
+
+
+class Timer:
+    def __init__(self, loop, interval, callback, repeat):
+        self.loop = loop
+        self.interval = interval
+        self.callback = callback
+        self.repeat = repeat
+        self.deadline = time.ticks_add(time.ticks_ms(), interval)
+
+    def cancel(self):
+        if self in self.loop.timers:
+            self.loop.timers.remove(self)
+
+
+class EventLoop:
+    def __init__(self, read_irq=None, idle=None):
+        self.read_irq = read_irq or (lambda: cpld.read_reg(cpld.REG_IRQ))
+        self.idle = idle or machine.idle
+        self.irq_handlers = []
+        self.timers = []
+        self.pollers = []
+        self.idle_handlers = []
+        self.irq_mask = 0xff
+        self.empty_passes = 0
+        self.next_deadline = time.ticks_ms()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.passes = 0
+        self.irq_passes = 0
+        self.idle_calls = 0
+        self.idle_us = 0
+        self.stats_start = time.ticks_us()
+
+    def on_irq(self, mask, handler):
+        """Call handler() in every pass in which one of the IRQ bits in
+        mask is set.  Handlers run in the order they were registered."""
+        self.irq_handlers.append((mask, handler))
+
+    def enable_irq(self, mask, enable=True):
+        """Masked IRQ bits stay pending in the CPLD without keeping the
+        loop busy until they are enabled again."""
+        if enable:
+            self.irq_mask |= mask
+        else:
+            self.irq_mask &= ~mask
+
+    def add_timer(self, timer):
+        self.timers.append(timer)
+        if time.ticks_diff(timer.deadline, self.next_deadline) < 0:
+            self.next_deadline = timer.deadline
+        return timer
+
+    def every(self, interval, callback):
+        return self.add_timer(Timer(self, interval, callback, True))
+
+    def after(self, delay, callback):
+        return self.add_timer(Timer(self, delay, callback, False))
+
+    def poll(self, poller):
+        """Call poller() in every pass.  It returns a true value if it
+        found work to do, which keeps the loop from going idle."""
+        self.pollers.append(poller)
+
+    def when_idle(self, handler):
+        """Call handler() in passes in which the loop would go idle.  If
+        it returns a true value, the loop does not sleep in that pass."""
+        self.idle_handlers.append(handler)
+
+    def run_timers(self):
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self.next_deadline) < 0:
+            return
+        for timer in self.timers[:]:
+            if time.ticks_diff(now, timer.deadline) >= 0:
+                if timer.repeat:
+                    timer.deadline = time.ticks_add(timer.deadline, timer.interval)
+                    if time.ticks_diff(now, timer.deadline) >= 0:
+                        timer.deadline = time.ticks_add(now, timer.interval)    # don't try to catch up
+                else:
+                    timer.cancel()
+                timer.callback()
+        self.next_deadline = time.ticks_add(now, 60000)
+        for timer in self.timers:
+            if time.ticks_diff(timer.deadline, self.next_deadline) < 0:
+                self.next_deadline = timer.deadline
+
+    def step(self):
+        self.passes += 1
+        busy = False
+        irq = self.read_irq() & self.irq_mask
+        if irq:
+            self.irq_passes += 1
+            busy = True
+            for mask, handler in self.irq_handlers:
+                if irq & mask:
+                    handler()
+        for poller in self.pollers:
+            if poller():
+                busy = True
+        if self.timers:
+            self.run_timers()
+        if busy:
+            self.empty_passes = 0
+            return
+        self.empty_passes += 1
+        if self.empty_passes < IDLE_PASSES:
+            return
+        for handler in self.idle_handlers:
+            if handler():
+                return
+        start = time.ticks_us()
+        self.idle()
+        self.idle_calls += 1
+        self.idle_us += time.ticks_diff(time.ticks_us(), start)
+
+    def run(self):
+        while True:
+            self.step()
+
+    async def run_async(self):
+        """Run the loop as an asyncio task, giving the other tasks (the
+        telnet server) a turn after each pass."""
+        while True:
+            self.step()
+            await asyncio.sleep(0)
+
+    def stats(self):
+        elapsed = time.ticks_diff(time.ticks_us(), self.stats_start)
+        return {
+            'passes': self.passes,
+            'irq_passes': self.irq_passes,
+            'idle_calls': self.idle_calls,
+            'idle_percent': 100 * self.idle_us // elapsed if elapsed > 0 else 0,
+        }
@@ -0,0 +1,105 @@
+import time
+
+# Levelled logging into a fixed size ring buffer.  An entry keeps the
+# format string and its arguments, formatting happens only when the
+# entry is printed (drain(), called when the main loop is idle) or
+# shown with "show log", so logging from the RAM-Disk, modem and
+# telnet code does not wait for the USB console.
+
+DEBUG   = 10
+INFO    = 20
+WARNING = 30
+ERROR   = 40
+
+LEVEL_NAMES = {
+    DEBUG: 'DEBUG',
+    INFO: 'INFO',
+    WARNING: 'WARNING',
+    ERROR: 'ERROR',
+}
+
+SIZE = 64                        # number of entries kept
+DRAIN_ENTRIES = 2                # entries printed per drain() call
+
+level = DEBUG                    # entries below this level are not recorded
+console_level = INFO             # entries at or above this level are printed
+
+entries = [None] * SIZE
+sequence = 0                     # number of entries recorded so far
+printed = 0                      # sequence number of the next entry to print
+lost = 0                         # entries for the console overwritten before they were printed
+
+
+def log(entry_level, fmt, *args):
+    global sequence, printed, lost
+    if entry_level < level:
+        return
+    if sequence - printed >= SIZE:                         # overwriting an entry that drain() has not seen
+        if entries[printed % SIZE][1] >= console_level:
+            lost += 1
+        printed += 1
+    entries[sequence % SIZE] = (time.ticks_ms(), entry_level, fmt, args)
+    sequence += 1
+
+
+def debug(fmt, *args):
+    log(DEBUG, fmt, *args)
+
+
+def info(fmt, *args):
+    log(INFO, fmt, *args)
+
+
+def warning(fmt, *args):
+    log(WARNING, fmt, *args)
+
+
+def error(fmt, *args):
+    log(ERROR, fmt, *args)
+
+
+class Lazy:
+    """Argument that is computed only when the entry is formatted, e.g.
+    log.debug('%s', log.Lazy(Enum.get_names, byte))."""
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __str__(self):
+        return str(self.function(*self.args))
+
+
+def format_entry(entry):
+    ticks, entry_level, fmt, args = entry
+    try:
+        message = fmt % args if args else fmt
+    except (TypeError, ValueError):
+        message = f'{fmt} {args}'
+    return f'{ticks:>10} {LEVEL_NAMES.get(entry_level, entry_level):<7} {message}'
+
+
+def lines(count=SIZE, min_level=DEBUG):
+    """Return the last count entries at or above min_level, oldest first."""
+    result = []
+    for i in range(max(0, sequence - SIZE), sequence):
+        entry = entries[i % SIZE]
+        if entry[1] >= min_level:
+            result.append(format_entry(entry))
+    return result[-count:]
+
+
+def drain():
+    """Print up to DRAIN_ENTRIES entries that were not printed yet.
+    Returns True if there was something to print."""
+    global printed, lost
+    if lost:
+        print(f'log: {lost} entries lost')
+        lost = 0
+    count = 0
+    while printed < sequence and count < DRAIN_ENTRIES:
+        entry = entries[printed % SIZE]
+        printed += 1
+        if entry[1] >= console_level:
+            print(format_entry(entry))
+            count += 1
+    return count > 0
@@ -1,48 +1,28 @@
 import machine
 import cpld
-import rp2
 import time
-import socket
-import errno
 from machine import Pin
 
 from command_processor import CommandProcessor
 from enum import Enum
 import wifi
 import telnet
+import dialer
 import config
+from bridge import Bridge, FLOW_NONE, FLOW_XONXOFF
+from tones import (ToneEngine, CALL_PROGRESS_TONES, DIAL_TONE, INVALID_NUMBER_TONE, NO_NETWORK_TONE, BUSY_TONE,
+                   RING_TONE, ECHO_CANCEL_TONE, HANDSHAKE_ANSWER_TONE, HANDSHAKE_ORIGINATE_TONE, COMMAND_MODE_TONE)
+import log
 
 instance = None
 
 TICK_MS = 10
 TICKS_PER_SECOND = 1000 / TICK_MS
 
-@rp2.asm_pio(set_init=rp2.PIO.OUT_LOW)
-def tone_generator():
-    pull()
-    wrap_target()
-    set(pins, 1)
-    mov(x, osr)
-    label("delay_high")
-    jmp(x_dec, "delay_high")
-    set(pins, 0)
-    mov(x, osr)
-    label("delay_low")
-    jmp(x_dec, "delay_low")
-
-tone_generator1 = rp2.StateMachine(4, tone_generator, freq=10_000_000, set_base=Pin(28))
-tone_generator2 = rp2.StateMachine(5, tone_generator, freq=10_000_000, set_base=Pin(28))
-
-
-def set_freq(sm, f):
-    if f > 0:
-        sm.active(0)
-        delay = int(1/f/100e-9/2)-3
-        sm.restart()
-        sm.put(delay)
-        sm.active(1)
-    else:
-        sm.restart()                                        # restart to set output to low if running
+phonebook = config.setting('phonebook', dict, {})   # number -> [host, port]
+flow_control = config.setting('modem_flow', str, FLOW_NONE, (FLOW_NONE, FLOW_XONXOFF))
+
+tone_engine = ToneEngine(Pin(28))
 
 
 class Control(Enum):
@@ -55,14 +35,6 @@ class Control(Enum):
   PWR = 0x40
   CCT = 0x80
 
-  @classmethod
-  def get_names(cls, value):
-    result = []
-    for mask, name in cls._create_name_mapping().items():
-      if value & mask:
-        result.append(name)
-    return result
-
 
 class Status(Enum):
     RNG = 1
@@ -94,79 +66,240 @@ class State(Enum):
     DRAIN_UART = 10
     TELNET_MODE = 11
 
-class CallProgressTone:
-    def __init__(self, tones, repeats=False):
-        self.tones = tones
-        self.repeats = repeats
-        assert(len(self.tones) % 1 == 0)
-        self.reset()
+class TonePlayer:
+    def __init__(self, tone):
+        self.tone = tone
+        tone_engine.play(tone)
 
-    def reset(self):
-        self.pos = 0
+    def tick(self):
+        return tone_engine.poll()
+
+
+class StateHandler:
+    """Behaviour of the modem in one state.  Events are dispatched to
+    the method named like the event in lower case (tick, dtmf, uart_rx,
+    control_ohc, ...); the table is built once per handler, events
+    without a method are ignored.  enter() and exit() run on state
+    transitions.  The handler keeps the statistics shown by "show
+    modem"."""
+
+    def __init__(self, modem):
+        self.modem = modem
+        self.dispatch = {}
+        for value, name in Event.items():
+            method = getattr(self, name.lower(), None)
+            if method:
+                self.dispatch[value] = method
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.visits = 0
+        self.time_ms = 0
+        self.events = 0
+        self.ignored = 0
+
+    def enter(self):
+        pass
+
+    def exit(self):
+        pass
+
+
+class ToneState(StateHandler):
+    """A state that plays a call progress tone and moves on to the next
+    state when the tone is done.  Subclasses set TONE, or override
+    tone() if it depends on the call."""
+    TONE = None
+    next_state = None
+
+    def tone(self):
+        return self.TONE
+
+    def enter(self):
+        self.modem.tone_player = TonePlayer(self.tone())
+
+    def exit(self):
+        tone_engine.stop()
+        self.modem.tone_player = None
+
+    def tick(self, arg):
+        if self.modem.tone_player.tick():
+            self.done()
 
     def done(self):
-        return len(self.tones) == self.pos
+        self.modem.set_state(self.next_state)
 
-    def next(self):
-        frequency = self.tones[self.pos]
-        duration = self.tones[self.pos+1]
-        self.pos += 2
-        if self.repeats and len(self.tones) == self.pos:
-            self.pos = 0
-        return frequency, duration
 
+class IdleState(StateHandler):
+    def control_ohc(self, off_hook):
+        if off_hook:
+            self.modem.set_state(State.OFF_HOOK)
 
-CONNECT_DELAY = 3000 # time to wait before opening the data channel after carrier detect was signalled
+    def uart_rx(self, data):
+        self.modem.set_state(State.TELNET_MODE)
+        self.modem.handle_event(Event.UART_RX, data)        # send char to command processor
 
-INVALID_NUMBER_TONE = CallProgressTone((950, 330, 1450, 330, 1880, 330, 0, 1000), repeats=True)
-NO_NETWORK_TONE = CallProgressTone((425, 240, 0, 240), repeats=True)
-BUSY_TONE = CallProgressTone((425, 480, 0, 430), repeats=True)
-RING_TONE = CallProgressTone((425, 1000, 0, 4000))
-ECHO_CANCEL_TONE = CallProgressTone((2100, 430, 20, 20) * 6 + (2225, 430, 20, 20) * 6)
-HANDSHAKE_ANSWER_TONE = CallProgressTone((1650, CONNECT_DELAY))
-HANDSHAKE_ORIGINATE_TONE = CallProgressTone((980, CONNECT_DELAY))
-COMMAND_MODE_TONE = CallProgressTone((425, 240, 0, 240, 425, 240, 0, 3000))
 
+class OffHookState(StateHandler):
+    def enter(self):
+        tone_engine.play(DIAL_TONE)
+        self.modem.number_buffer = ''
 
-class TonePlayer:
-    def __init__(self, tone):
-        self.tone = tone
-        self.tone.reset()
-        self.play_next()
+    def dtmf(self, digit):
+        self.modem.number_buffer += digit
+        self.modem.set_state(State.DIALING)
 
-    def play_next(self):
-        frequency, duration = self.tone.next()
-        set_freq(tone_generator1, frequency)
-        self.ticks_remaining = duration / TICK_MS
 
-    def tick(self):
-        self.ticks_remaining -= 1
-        if self.ticks_remaining > 0:
-            return
-        if self.tone.done():
-            set_freq(tone_generator1, 0)
-            return True
-        self.play_next()
+class DialingState(StateHandler):
+    def enter(self):
+        self.modem.tick_count = 0
+
+    def dtmf(self, digit):
+        modem = self.modem
+        modem.tick_count = 0
+        modem.number_buffer += digit
+        if modem.number_buffer == '***':
+            modem.carrier_detected(True)
+            modem.set_state(State.ENTER_COMMAND_MODE)
+
+    def tick(self, arg):
+        modem = self.modem
+        modem.tick_count += 1
+        if modem.tick_count == TICKS_PER_SECOND:
+            modem.dial()
+
+
+class CallFailedState(ToneState):
+    # the failure tones repeat until the PX-8 hangs up, should one end
+    # the modem goes back to idle
+    next_state = State.IDLE
+
+    def tone(self):
+        return self.modem.failure_tone
+
+
+class RingingState(ToneState):
+    # the connection is set up while the ring tone plays
+    TONE = RING_TONE
+    next_state = State.ECHO_CANCEL
+
+    def tick(self, arg):
+        modem = self.modem
+        status = modem.call.poll()
+        if status == dialer.FAILED_LOOKUP:
+            modem.call_failed(NO_NETWORK_TONE)
+        elif status == dialer.FAILED_CONNECT:
+            modem.call_failed(BUSY_TONE)
+        elif modem.tone_player.tick():
+            if status == dialer.CONNECTED:
+                modem.socket = modem.call.socket
+                modem.call.socket = None                    # the modem owns it now
+                modem.call = None
+                self.done()
+            else:
+                modem.tone_player = TonePlayer(RING_TONE)   # still connecting, ring again
+
+
+class EchoCancelState(ToneState):
+    TONE = ECHO_CANCEL_TONE
+    next_state = State.HANDSHAKE
+
+    def done(self):
+        self.modem.carrier_detected(True)
+        super().done()
+
+
+class HandshakeState(ToneState):
+    next_state = State.CONNECTED
+
+    def tone(self):
+        return HANDSHAKE_ANSWER_TONE if self.modem.answer_mode else HANDSHAKE_ORIGINATE_TONE
+
+
+class ConnectedState(StateHandler):
+    # data is moved by the bridge, see Modem.poll()
+    def enter(self):
+        modem = self.modem
+        modem.bridge.start(modem.socket, flow_control.value)
+        try:
+            telnet.send_options(modem.socket)
+        except:
+            pass                                            # ignore errors during telnet option negotiation
+
+    def tick(self, arg):
+        bridge = self.modem.bridge
+        bridge.update_rates()
+        if not bridge.open:
+            self.modem.set_state(State.DRAIN_UART)
+
+
+class EnterCommandModeState(ToneState):
+    TONE = COMMAND_MODE_TONE
+    next_state = State.COMMAND_MODE
+
+
+class CommandModeState(StateHandler):
+    def enter(self):
+        self.modem.command_processor = CommandProcessor(self.modem.uart)
+
+    def uart_rx(self, data):
+        if self.modem.command_processor.userinput(data):
+            self.modem.set_state(State.DRAIN_UART)
+
+
+class DrainUartState(StateHandler):
+    def tick(self, arg):
+        modem = self.modem
+        output = modem.command_processor and modem.command_processor.output_pending()
+        if not modem.bridge.pending() and not output and modem.uart.txdone():
+            log.info('UART tx done, resetting modem')
+            modem.reset()
+
+
+class TelnetModeState(StateHandler):
+    pass
+
+
+STATE_HANDLERS = (
+    (State.IDLE, IdleState),
+    (State.OFF_HOOK, OffHookState),
+    (State.DIALING, DialingState),
+    (State.RINGING, RingingState),
+    (State.ECHO_CANCEL, EchoCancelState),
+    (State.HANDSHAKE, HandshakeState),
+    (State.CONNECTED, ConnectedState),
+    (State.ENTER_COMMAND_MODE, EnterCommandModeState),
+    (State.COMMAND_MODE, CommandModeState),
+    (State.CALL_FAILED, CallFailedState),
+    (State.DRAIN_UART, DrainUartState),
+    (State.TELNET_MODE, TelnetModeState),
+)
 
 
 class Modem:
-    def __init__(self, uart):
+    def __init__(self, uart, baudrate):
         global instance
         if instance:
             print('Warning: Modem instance already exists')
         instance = self
         self.uart = uart
         self.socket = None
-        self.last_tick = time.ticks_ms()
+        self.call = None
+        self.bridge = Bridge(uart, baudrate)
         self.tick_count = 0
+        self.handlers = {state: handler(self) for state, handler in STATE_HANDLERS}
+        self.state = None
+        self.handler = None
+        self.state_since = time.ticks_ms()
+        tone_engine.prepare(CALL_PROGRESS_TONES)
+        for key in Modem.DTMF_FREQ_MAP:
+            tone_engine.dtmf_tone(Modem.DTMF_LOW[key >> 2], Modem.DTMF_HIGH[key & 0x03])
         self.reset()
 
     def reset(self):
         self.status = Status.RNG | Status.CD
         cpld.write_reg(cpld.REG_MODEM_STATUS, self.status)
-        set_freq(tone_generator1, 0)
-        set_freq(tone_generator2, 0)
-        self.state = None
+        tone_engine.stop()
         self.set_state(State.IDLE)
         self.answer_mode = False
         self.old_modem_control = 0
@@ -174,17 +307,50 @@ class Modem:
         self.dtmf_digit = None
         self.number_buffer = ''
         self.tone_player = None
+        self.failure_tone = None
         self.command_processor = None
+        if self.call:
+            self.call.close()
+            self.call = None
         if self.socket:
             self.socket.close()
             self.socket = None
+        self.bridge.start(None, FLOW_NONE)
+
+    def set_baudrate(self, baudrate):
+        self.bridge.baudrate = baudrate
 
     def set_state(self, state):
-        print("Modem", State.get_name(self.state), "->", State.get_name(state))
+        log.info("Modem %s -> %s", State.get_name(self.state), State.get_name(state))
+        now = time.ticks_ms()
+        if self.handler:
+            self.handler.exit()
+            self.handler.time_ms += time.ticks_diff(now, self.state_since)
         self.state = state
+        self.state_since = now
+        self.handler = self.handlers[state]
+        self.handler.visits += 1
+        self.handler.enter()
+
+    def state_stats(self):
+        """(name, visits, time in ms, events handled, events ignored) per
+        state, including the time spent in the current state so far."""
+        result = []
+        for state, _ in STATE_HANDLERS:
+            handler = self.handlers[state]
+            time_ms = handler.time_ms
+            if handler is self.handler:
+                time_ms += time.ticks_diff(time.ticks_ms(), self.state_since)
+            result.append((State.get_name(state), handler.visits, time_ms, handler.events, handler.ignored))
+        return result
+
+    def reset_stats(self):
+        for handler in self.handlers.values():
+            handler.reset_stats()
+        self.state_since = time.ticks_ms()
 
     def call_failed(self, tone):
-        self.tone_player = TonePlayer(tone)
+        self.failure_tone = tone
         self.set_state(State.CALL_FAILED)
 
     def carrier_detected(self, on):
@@ -201,123 +367,35 @@ class Modem:
             self.status = self.status | Status.RNG
         cpld.write_reg(cpld.REG_MODEM_STATUS, self.status)
 
+    def dial(self):
+        if not wifi.connected():
+            self.call_failed(NO_NETWORK_TONE)
+            return
+        if not self.number_buffer in phonebook.value:
+            self.call_failed(INVALID_NUMBER_TONE)
+            return
+        phonebook_entry = phonebook.value[self.number_buffer]
+        host, port = phonebook_entry
+        self.call = dialer.Call(host, int(port), wifi.dns_server(), dialer.cache)
+        self.set_state(State.RINGING)
+
     def handle_event(self, event, arg):
-        if self.state == State.IDLE:
-            if event == Event.CONTROL_OHC and arg:
-                set_freq(tone_generator1, 425)
-                self.set_state(State.OFF_HOOK)
-                self.number_buffer = ''
-            if event == Event.UART_RX:
-                self.set_state(State.TELNET_MODE)
-                self.handle_event(event, arg)               # send char to command processor
-        elif self.state == State.OFF_HOOK:
-            if event == Event.DTMF:
-                self.number_buffer += arg
-                self.tick_count = 0
-                self.set_state(State.DIALING)
-        elif self.state == State.DIALING:
-            if event == Event.DTMF:
-                self.tick_count = 0
-                self.number_buffer += arg
-                if self.number_buffer == '***':
-                    self.carrier_detected(True)
-                    self.tone_player = TonePlayer(COMMAND_MODE_TONE)
-                    self.set_state(State.ENTER_COMMAND_MODE)
-            if event == Event.TICK:
-                self.tick_count += 1
-                if self.tick_count == TICKS_PER_SECOND:
-                    if not wifi.connected:
-                        self.call_failed(NO_NETWORK_TONE)
-                        return
-                    phonebook = config.get('phonebook', {})
-                    if not self.number_buffer in phonebook:
-                        self.call_failed(INVALID_NUMBER_TONE)
-                        return
-                    phonebook_entry = phonebook[self.number_buffer]
-                    host, port = phonebook_entry
-                    call_address = wifi.resolve(host, int(port))
-                    if not call_address:
-                        self.call_failed(NO_NETWORK_TONE)
-                        return
-                    self.socket = socket.socket(socket.IPPROTO_TCP)
-                    try:
-                        self.socket.connect(call_address)
-                    except OSError as e:
-                        print(f'call failed {e}')
-                        self.call_failed(BUSY_TONE)
-                        return
-                    self.socket.setblocking(False)
-                    self.tone_player = TonePlayer(RING_TONE)
-                    self.set_state(State.RINGING)
-        elif self.state == State.CALL_FAILED:
-            if event == Event.TICK:
-                self.tone_player.tick()
-        elif self.state == State.RINGING:
-            if event == Event.TICK:
-                if not self.tone_player.tick():
-                    return
-                self.tone_player = TonePlayer(ECHO_CANCEL_TONE)
-                self.set_state(State.ECHO_CANCEL)
-        elif self.state == State.ECHO_CANCEL:
-            if event == Event.TICK:
-                if not self.tone_player.tick():
-                    return
-                self.carrier_detected(True)
-                self.tone_player = TonePlayer(HANDSHAKE_ANSWER_TONE if self.answer_mode else HANDSHAKE_ORIGINATE_TONE)
-                self.set_state(State.HANDSHAKE)
-        elif self.state == State.HANDSHAKE:
-            if event == Event.TICK:
-                if not self.tone_player.tick():
-                    return
-                try:
-                    telnet.send_options(self.socket)
-                except:
-                    pass                                    # ignore errors during telnet option negotiation
-                self.set_state(State.CONNECTED)
-        elif self.state == State.CONNECTED:
-            if event == Event.UART_RX:
-                try:
-                    self.socket.write(arg)
-                except OSError as e:
-                    print(f'Error {e} writing to socket, closing connection')
-                    self.socket.close()
-                    self.reset()
-            if event == Event.TICK:
-                try:
-                    data = self.socket.recv(128)
-                    if data:
-                        data = telnet.process_options(self.socket, data)
-                        self.uart.write(data)
-                    else:
-                        self.set_state(State.DRAIN_UART)
-                except OSError as e:
-                    if e.errno != errno.EAGAIN:
-                        print(f'Error {e} reading from socket, closing connection')
-                        self.set_state(State.DRAIN_UART)
-        elif self.state == State.ENTER_COMMAND_MODE:
-            if event == Event.TICK:
-                if self.tone_player and self.tone_player.tick():
-                    self.tone_player = None
-                    self.command_processor = CommandProcessor(self.uart)
-                    self.set_state(State.COMMAND_MODE)
-        elif self.state == State.COMMAND_MODE:
-            if event == Event.UART_RX:
-                if self.command_processor.userinput(arg):
-                    self.set_state(State.DRAIN_UART)
-        elif self.state == State.DRAIN_UART:
-            if event == Event.TICK:
-                if self.uart.txdone():
-                    print('UART tx done, resetting modem')
-                    self.reset()
+        handler = self.handler
+        method = handler.dispatch.get(event)
+        if method:
+            handler.events += 1
+            method(arg)
+        else:
+            handler.ignored += 1
 
 
     def handle_control(self):
         byte = cpld.read_reg(cpld.REG_MODEM_CONTROL)
         if byte == 0:
-            print("Reset modem")
+            log.info("Reset modem")
             self.reset()
             return
-        print("Modem Control:", Control.get_names(byte))
+        log.debug("Modem Control: %s", log.Lazy(Control.get_names, byte))
         self.answer_mode = byte & Control.ANS
         if (byte ^ self.old_modem_control) & Control.OHC:
             self.handle_event(Event.CONTROL_OHC, byte & Control.OHC)
@@ -350,21 +428,27 @@ class Modem:
     def handle_tone_dialer(self):
         byte = cpld.read_reg(cpld.REG_TONE_DIALER)
         if byte & 0x10:
+            # keys the dialer has no digit for have no wave table either
+            self.dtmf_digit = Modem.DTMF_FREQ_MAP.get(byte & 0x0f)
+            if self.dtmf_digit is None:
+                log.warning('DTMF key %d ignored', byte & 0x0f)
+                return
             high = byte & 0x03
             low = (byte & 0x0c) >> 2
-            set_freq(tone_generator1, Modem.DTMF_LOW[low])
-            set_freq(tone_generator2, Modem.DTMF_HIGH[high])
-            self.dtmf_digit = Modem.DTMF_FREQ_MAP[byte & 0x0f]
-        else:
-            set_freq(tone_generator1, 0)
-            set_freq(tone_generator2, 0)
-            print(f'DTMF digit {self.dtmf_digit}')
+            tone_engine.play(tone_engine.dtmf_tone(Modem.DTMF_LOW[low], Modem.DTMF_HIGH[high]))
+        elif self.dtmf_digit is not None:
+            tone_engine.stop()
+            log.info('DTMF digit %s', self.dtmf_digit)
             self.handle_event(Event.DTMF, self.dtmf_digit)
 
     def poll(self):
+        if self.state == State.CONNECTED or self.state == State.DRAIN_UART and self.bridge.pending():
+            return self.bridge.poll()
+        if self.command_processor and self.command_processor.flush():
+            return True
         if self.uart.any() > 0:
             self.handle_event(Event.UART_RX, self.uart.read())
-        now = time.ticks_ms()
-        if time.ticks_diff(now, self.last_tick) >= TICK_MS:
-            self.last_tick = now
-            self.handle_event(Event.TICK, None)
+            return True
+
+    def tick(self):
+        self.handle_event(Event.TICK, None)
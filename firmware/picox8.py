@@ -1,63 +1,99 @@
 from machine import UART, Pin
-from modem import Modem
+from modem import Modem, State, TICK_MS, phonebook
 from telnet import TelnetServer
-from ramdisk import RamDisk
+from command_processor import CommandProcessor
+from ramdisk import RamDisk, FLUSH_INTERVAL
+from eventloop import EventLoop
 import cpld
 import wifi
+import dialer
 import storage
 import config
+import log
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
 
 DEFAULT_BAUDRATE = 4800
 
 storage.mount_sdcard()
 uart = UART(0, baudrate=DEFAULT_BAUDRATE, tx=Pin(0), rx=Pin(1))
 ramdisk = RamDisk()
-modem = Modem(uart)
-telnet_server = TelnetServer(uart)
+modem = Modem(uart, DEFAULT_BAUDRATE)
+telnet_server = TelnetServer(uart, console=CommandProcessor,
+                             uart_free=lambda: modem.state in (State.IDLE, State.TELNET_MODE))
+
+MODEM_RESET_DELAY = 1000     # ms after the PX-8 disabled the modem until it is reset
+WIFI_CHECK_INTERVAL = 100    # ms
+MODEM_IRQS = cpld.IRQ_TONE_DIALER | cpld.IRQ_MODEM_CONTROL | cpld.IRQ_BAUDRATE
+
+loop = None
+modem_enabled = False
+modem_reset_timer = None
 
 def main_loop():
+    global loop
     wifi.connect()
-    ramdisk_iterations = 0
-    modem_disable_delay = 0
-    modem_enabled = False
-    while True:
-        byte = cpld.read_reg(cpld.REG_IRQ)
-        if modem_enabled:
-            if byte & cpld.IRQ_TONE_DIALER:
-                modem.handle_tone_dialer()
-            if byte & cpld.IRQ_MODEM_CONTROL:
-                modem.handle_control()
-            if byte & cpld.IRQ_BAUDRATE:
-                handle_baudrate()
-        if byte & cpld.IRQ_MISC_CONTROL:
-            # fixme: handle all control bits (ser handshake, buttons)
-            misc_control = cpld.read_reg(cpld.REG_MISC_CONTROL)
-            # new_modem_enabled = (misc_control & 0x01) == 0
-            new_modem_enabled = (misc_control & 0x20) == 0
-            if new_modem_enabled != modem_enabled:
-                modem_enabled = new_modem_enabled
-                if modem_enabled:
-                    print('Enable modem')
-                    modem_disable_delay = 0
-                else:
-                    print('Disable modem')
-                    modem_disable_delay = 1000
-        if not modem_enabled and modem_disable_delay > 0:
-            modem_disable_delay -= 1
-            if modem_disable_delay == 0:
-                print('Resetting modem')
-                modem.reset()
-        if byte & cpld.IRQ_RAMDISK_COMMAND:
-            ramdisk.handle_command()
-        if byte & cpld.IRQ_RAMDISK_OBF:
-            ramdisk.handle_data()
-        ramdisk_iterations += 1
-        if ramdisk_iterations == 1000:
-            ramdisk_iterations = 0
-            ramdisk.maybe_flush_pending_writes()
+    loop = EventLoop()
+    loop.on_irq(cpld.IRQ_TONE_DIALER, modem.handle_tone_dialer)
+    loop.on_irq(cpld.IRQ_MODEM_CONTROL, modem.handle_control)
+    loop.on_irq(cpld.IRQ_BAUDRATE, handle_baudrate)
+    loop.enable_irq(MODEM_IRQS, modem_enabled)
+    loop.on_irq(cpld.IRQ_MISC_CONTROL, handle_misc_control)
+    loop.on_irq(cpld.IRQ_RAMDISK_COMMAND, ramdisk.handle_command)
+    loop.on_irq(cpld.IRQ_RAMDISK_OBF, ramdisk.handle_data)
+    loop.poll(poll_uart)
+    loop.every(TICK_MS, modem.tick)
+    loop.every(FLUSH_INTERVAL, ramdisk.flush_pending_writes)
+    loop.every(WIFI_CHECK_INTERVAL, check_wifi)
+    loop.when_idle(ramdisk.persist)
+    loop.when_idle(config.flush)
+    loop.when_idle(log.drain)
+    asyncio.run(run_tasks())
+
+async def run_tasks():
+    await telnet_server.start()
+    await loop.run_async()
+
+def poll_uart():
+    # while no call is up and a telnet client owns the UART, data from
+    # the PX-8 goes to the telnet server instead of the modem
+    if telnet_server.owns_uart():
+        return telnet_server.poll()
+    return modem.poll()
+
+def check_wifi():
+    # look up the phonebook hosts when WiFi comes up, so that dialing
+    # them does not have to wait for DNS
+    if wifi.check_connection():
+        dialer.cache.prewarm([(host, int(port)) for host, port in phonebook.value.values()], wifi.dns_server())
+    dialer.cache.poll()
+
+def handle_misc_control():
+    global modem_enabled, modem_reset_timer
+    # fixme: handle all control bits (ser handshake, buttons)
+    misc_control = cpld.read_reg(cpld.REG_MISC_CONTROL)
+    # new_modem_enabled = (misc_control & 0x01) == 0
+    new_modem_enabled = (misc_control & 0x20) == 0
+    if new_modem_enabled == modem_enabled:
+        return
+    modem_enabled = new_modem_enabled
+    loop.enable_irq(MODEM_IRQS, modem_enabled)
+    if modem_reset_timer:
+        modem_reset_timer.cancel()
+        modem_reset_timer = None
+    if modem_enabled:
+        log.info('Enable modem')
+    else:
+        log.info('Disable modem')
+        modem_reset_timer = loop.after(MODEM_RESET_DELAY, reset_modem)
 
-        modem.poll()
-        telnet_server.poll()
+def reset_modem():
+    global modem_reset_timer
+    modem_reset_timer = None
+    log.info('Resetting modem')
+    modem.reset()
 
 old_baud_control = 0
 
@@ -79,9 +115,10 @@ def handle_baudrate():
         return
     old_baud_control = baud_control
     if not baud_control in REG_TO_BAUD:
-        print(f'Unrecognized UART baud rate register value {baud_control}')
+        log.warning('Unrecognized UART baud rate register value %d', baud_control)
     baud = REG_TO_BAUD[baud_control]
-    print(f'UART baud rate: {baud}')
+    log.info('UART baud rate: %d', baud)
     uart.init(baud, bits=8, parity=None, stop=1)
+    modem.set_baudrate(baud)
 
 
@@ -2,19 +2,52 @@ import cpld
 import time
 import storage
 import json
+import config
+import log
+from array import array
+from enum import Enum
 from machine import Pin
 
 instance = None
 
 CONFIG_FILE    = 'picox-8.config.json'
-DEFAULT_FILE   = 'default-ramdisk.dsk'
+DEFAULT_FILE   = 'default-ramdisk.spd'
 
 IMAGE_KB       = 120             # size of a ramdisk image
 FLUSH_INTERVAL = 15000           # how often to flush ramdisk to flash
 
+SECTOR_SIZE    = 128             # PX-8 sector
+BLOCK_SIZE     = 512             # SD-Card block
+SECTORS_PER_BLOCK = BLOCK_SIZE // SECTOR_SIZE
+ALL_SECTORS    = (1 << SECTORS_PER_BLOCK) - 1
+MAX_DIRTY_BLOCKS = 16            # flush early when this many blocks are waiting
+PERSIST_DELAY  = 1000            # write back in the background after this many ms without writes
+PERSIST_BLOCKS = 2               # blocks written back per idle call
+CHECKSUM_SECTORS = 8             # sectors summed per idle call until the checksum is complete
+MAX_OPEN_IMAGES = 4              # image files kept open, so that switching does not reopen them
+FAILSAFE_FILE  = '/ramdisk.dsk'
+SNAPSHOT_SUFFIX = '.snp'         # overlay file of a snapshot
+
+# sparse image container, see SparseFile
+SPARSE_MAGIC   = b'PX8S'
+SPARSE_VERSION = 1
+SPARSE_HEADER  = 16              # magic, version, block size in KB, block count (16 bit), reserved
+SPARSE_BLOCK   = 1024
+SPARSE_DATA    = 512             # offset of the first data slot
+FIRST_SLOT     = 2               # block map entries below are filler blocks
+FILLERS        = (0x00, 0xe5)    # unused blocks of a new, and of a formatted image
+
+# config 'ramdisk_mode':
+MODE_FILE      = 'file'          # read from the image file, cache writes in BlockCache
+MODE_MEMORY    = 'memory'        # keep the whole image in a MemoryImage
+
+mode = config.setting('ramdisk_mode', str, MODE_FILE, (MODE_FILE, MODE_MEMORY))
+
 FAILSAFE_SWITCH = Pin(27, Pin.IN, Pin.PULL_UP)
 
-class Command:
+class Command(Enum):
+    _unknown = "UNKNOWN_COMMAND"
+
     RESET = 0
     READ = 1
     READB = 2
@@ -22,15 +55,409 @@ class Command:
     WRITEB = 4
     CKSUM = 5
 
-    @classmethod
-    def _create_name_mapping(cls):
-        # Create a dictionary mapping values to names
-        return {value: name for name, value in cls.__dict__.items() if not name.startswith('_') and isinstance(value, int)}
 
-    @classmethod
-    def get_name(cls, value):
-        name_mapping = cls._create_name_mapping()
-        return name_mapping.get(value, "UNKNOWN_COMMAND")
+def sector_mask(start, length):
+    first = start // SECTOR_SIZE
+    last = (start + length - 1) // SECTOR_SIZE
+    return ((2 << last) - 1) & ~((1 << first) - 1)
+
+
+class BlockCache:
+    """Write-back cache for the RAM-Disk image file.
+
+    Written data is collected in 512 byte buffers, one per SD-Card
+    block, together with a mask of the 128 byte sectors in the block
+    that are valid.  flush() writes every dirty block with a single
+    write, filling in the sectors that were not written from the file
+    first, so that the four PX-8 sectors sharing a block cost one SD
+    write instead of four read-modify-write cycles.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.blocks = {}                                         # block number -> [mask, bytearray]
+        self.spare = []                                          # buffers of flushed blocks for reuse
+        self.sector_writes = 0
+        self.block_writes = 0
+
+    def readinto(self, offset, buf):
+        entry = self.blocks.get(offset // BLOCK_SIZE)
+        start = offset % BLOCK_SIZE
+        if entry and start + len(buf) <= BLOCK_SIZE:
+            mask = sector_mask(start, len(buf))
+            if entry[0] & mask:
+                if entry[0] & mask != mask:
+                    self.fill(offset // BLOCK_SIZE, entry)
+                buf[:] = memoryview(entry[1])[start:start + len(buf)]
+                return
+        self.file.seek(offset)
+        self.file.readinto(buf)
+
+    def write(self, offset, data):
+        block_number = offset // BLOCK_SIZE
+        start = offset % BLOCK_SIZE
+        entry = self.blocks.get(block_number)
+        if not entry:
+            if len(self.blocks) >= MAX_DIRTY_BLOCKS:
+                self.flush()
+            entry = [0, self.spare.pop() if self.spare else bytearray(BLOCK_SIZE)]
+            self.blocks[block_number] = entry
+        mask = sector_mask(start, len(data))
+        if (start | len(data)) % SECTOR_SIZE and entry[0] & mask != mask:
+            self.fill(block_number, entry)                       # partial sector, the rest must be current
+        entry[1][start:start + len(data)] = data
+        entry[0] |= mask
+        self.sector_writes += 1
+
+    def fill(self, block_number, entry):
+        mask, buf = entry
+        mv = memoryview(buf)
+        for sector in range(SECTORS_PER_BLOCK):
+            if not mask & (1 << sector):
+                self.file.seek(block_number * BLOCK_SIZE + sector * SECTOR_SIZE)
+                self.file.readinto(mv[sector * SECTOR_SIZE:(sector + 1) * SECTOR_SIZE])
+        entry[0] = ALL_SECTORS
+
+    def dirty(self):
+        return len(self.blocks)
+
+    def flush(self, limit=None):
+        if not self.blocks:
+            return 0
+        count = 0
+        for block_number in sorted(self.blocks):
+            if count == limit:
+                break
+            entry = self.blocks.pop(block_number)
+            if entry[0] != ALL_SECTORS:
+                self.fill(block_number, entry)
+            self.file.seek(block_number * BLOCK_SIZE)
+            self.file.write(entry[1])
+            self.spare.append(entry[1])
+            count += 1
+        self.file.flush()
+        self.block_writes += count
+        return count
+
+
+class MemoryImage:
+    """RAM-Disk image that is held in memory completely.
+
+    The image file is read once when it is opened, so READ and WRITE
+    never have to wait for the SD-Card.  Written blocks are marked
+    dirty and written back to the file by flush(), which can be asked
+    to write only a few blocks at a time.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.data = bytearray(IMAGE_KB * 1024)
+        self.view = memoryview(self.data)
+        self.file.seek(0)
+        self.file.readinto(self.data)
+        self.dirty_blocks = bytearray(len(self.data) // BLOCK_SIZE)
+        self.dirty_count = 0
+        self.next_block = 0
+        self.sector_writes = 0
+        self.block_writes = 0
+
+    def readinto(self, offset, buf):
+        buf[:] = self.view[offset:offset + len(buf)]
+
+    def write(self, offset, data):
+        self.view[offset:offset + len(data)] = data
+        for block_number in range(offset // BLOCK_SIZE, (offset + len(data) - 1) // BLOCK_SIZE + 1):
+            if not self.dirty_blocks[block_number]:
+                self.dirty_blocks[block_number] = 1
+                self.dirty_count += 1
+        self.sector_writes += 1
+
+    def dirty(self):
+        return self.dirty_count
+
+    def flush(self, limit=None):
+        count = 0
+        blocks = len(self.dirty_blocks)
+        start = self.next_block                                  # continue where the last partial flush stopped
+        for i in range(blocks):
+            if not self.dirty_count or count == limit:
+                break
+            block_number = (start + i) % blocks
+            if self.dirty_blocks[block_number]:
+                self.dirty_blocks[block_number] = 0
+                self.dirty_count -= 1
+                self.file.seek(block_number * BLOCK_SIZE)
+                self.file.write(self.view[block_number * BLOCK_SIZE:(block_number + 1) * BLOCK_SIZE])
+                self.next_block = block_number + 1
+                count += 1
+        if count:
+            self.file.flush()
+            self.block_writes += count
+        return count
+
+
+class Overlay:
+    """Copy-on-write layer over an image, for snapshots.
+
+    The image below is not written while the overlay is in place; every
+    sector written goes to the delta file instead, as a record of the
+    sector number (2 bytes) and the 128 bytes of the sector.  A sector
+    that is written again is overwritten in its record, so the file
+    holds each changed sector once.  Dropping the file restores the
+    image as it was when the snapshot was taken, commit() copies the
+    changed sectors into it.  Accesses must not cross sectors, which
+    the RAM-Disk commands don't.
+    """
+
+    RECORD_SIZE = 2 + SECTOR_SIZE
+
+    def __init__(self, base, file):
+        self.base = base
+        self.file = file
+        self.index = {}                                          # sector -> position of its data in file
+        self.pending = 0
+        self.sector_writes = 0
+        header = bytearray(2)
+        position = 0
+        file.seek(0)
+        while file.readinto(header) == 2:
+            self.index[header[0] | header[1] << 8] = position + 2
+            position += self.RECORD_SIZE
+            file.seek(position)
+        self.end = position
+
+    def readinto(self, offset, buf):
+        sector, start = divmod(offset, SECTOR_SIZE)
+        position = self.index.get(sector)
+        if position is None:
+            self.base.readinto(offset, buf)
+        else:
+            self.file.seek(position + start)
+            self.file.readinto(buf)
+
+    def write(self, offset, data):
+        sector, start = divmod(offset, SECTOR_SIZE)
+        position = self.index.get(sector)
+        if position is None:
+            record = bytearray(self.RECORD_SIZE)
+            record[0] = sector & 0xff
+            record[1] = sector >> 8
+            contents = memoryview(record)[2:]
+            if len(data) != SECTOR_SIZE:
+                self.base.readinto(sector * SECTOR_SIZE, contents)
+            contents[start:start + len(data)] = data
+            self.file.seek(self.end)
+            self.file.write(record)
+            storage.invalidate()                                 # the file has grown
+            self.index[sector] = self.end + 2
+            self.end += self.RECORD_SIZE
+        else:
+            self.file.seek(position + start)
+            self.file.write(data)
+        self.pending += 1
+        self.sector_writes += 1
+
+    def dirty(self):
+        return self.pending
+
+    def flush(self, limit=None):
+        count = self.pending
+        if count:
+            self.file.flush()
+            self.pending = 0
+        return count
+
+    def commit(self):
+        """Write the changed sectors to the image below."""
+        buf = bytearray(SECTOR_SIZE)
+        for sector in sorted(self.index):
+            self.file.seek(self.index[sector])
+            self.file.readinto(buf)
+            self.base.write(sector * SECTOR_SIZE, buf)
+        self.base.flush()
+
+
+def sparse_image(fill=0):
+    """Contents of a sparse image file whose blocks all hold filler fill."""
+    blocks = IMAGE_KB * 1024 // SPARSE_BLOCK
+    data = bytearray(SPARSE_DATA)
+    data[:4] = SPARSE_MAGIC
+    data[4] = SPARSE_VERSION
+    data[5] = SPARSE_BLOCK // 1024
+    data[6] = blocks & 0xff
+    data[7] = blocks >> 8
+    entry = FILLERS.index(fill)
+    for block in range(blocks):
+        data[SPARSE_HEADER + 2 * block] = entry
+    return data
+
+
+class SparseFile:
+    """Sparse, deduplicating image container, read and written like the
+    flat image file it stands for.
+
+    After a header the file holds the block map, a 16 bit entry for
+    every 1K block of the image: 0 and 1 for blocks that are filled
+    with 0x00 or 0xE5 and are not stored, FIRST_SLOT + n for blocks
+    whose data is in the n-th 1K slot from SPARSE_DATA on.  Blocks with
+    the same contents can share a slot (tools/px8dsk.py "sparse"
+    converts flat images this way).  A write to a filler block or to a
+    shared slot first copies the block to a new slot at the end of the
+    file, so every other access is one map lookup and one seek.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.position = 0
+        header = bytearray(SPARSE_HEADER)
+        file.seek(0)
+        file.readinto(header)
+        if header[:4] != SPARSE_MAGIC or header[4] != SPARSE_VERSION or header[5] * 1024 != SPARSE_BLOCK:
+            raise OSError('unsupported sparse image')
+        entries = bytearray(2 * (header[6] | header[7] << 8))
+        file.readinto(entries)
+        self.map = array('H', (entries[i] | entries[i + 1] << 8 for i in range(0, len(entries), 2)))
+        self.users = {}                                          # slot -> number of blocks using it
+        for entry in self.map:
+            if entry >= FIRST_SLOT:
+                self.users[entry] = self.users.get(entry, 0) + 1
+        self.next_slot = max(self.users) + 1 if self.users else FIRST_SLOT
+        self.fills = [memoryview(bytearray([fill]) * SPARSE_BLOCK) for fill in FILLERS]
+        self.copy_buffer = bytearray(SPARSE_BLOCK)
+
+    def slot_offset(self, entry):
+        return SPARSE_DATA + (entry - FIRST_SLOT) * SPARSE_BLOCK
+
+    def seek(self, position):
+        self.position = position
+
+    def readinto(self, buf):
+        mv = memoryview(buf)
+        done = 0
+        while done < len(buf) and self.position < len(self.map) * SPARSE_BLOCK:
+            block, start = divmod(self.position, SPARSE_BLOCK)
+            count = min(len(buf) - done, SPARSE_BLOCK - start)
+            entry = self.map[block]
+            if entry < FIRST_SLOT:
+                mv[done:done + count] = self.fills[entry][:count]
+            else:
+                self.file.seek(self.slot_offset(entry) + start)
+                self.file.readinto(mv[done:done + count])
+            done += count
+            self.position += count
+        return done
+
+    def write(self, data):
+        mv = memoryview(data)
+        done = 0
+        while done < len(data):
+            block, start = divmod(self.position, SPARSE_BLOCK)
+            count = min(len(data) - done, SPARSE_BLOCK - start)
+            self.file.seek(self.slot_offset(self.own_slot(block)) + start)
+            self.file.write(mv[done:done + count])
+            done += count
+            self.position += count
+        return done
+
+    def own_slot(self, block):
+        """Return the slot of block, after giving it one of its own if it
+        has none or shares it."""
+        entry = self.map[block]
+        if entry >= FIRST_SLOT and self.users[entry] == 1:
+            return entry
+        if entry < FIRST_SLOT:
+            buf = self.fills[entry]
+        else:
+            buf = self.copy_buffer
+            self.file.seek(self.slot_offset(entry))
+            self.file.readinto(buf)
+            self.users[entry] -= 1
+        slot = self.next_slot
+        self.next_slot += 1
+        self.file.seek(self.slot_offset(slot))
+        self.file.write(buf)
+        storage.invalidate()                                     # the file has grown
+        self.users[slot] = 1
+        self.map[block] = slot
+        self.file.seek(SPARSE_HEADER + 2 * block)
+        self.file.write(bytes((slot & 0xff, slot >> 8)))
+        return slot
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def open_image_file(path):
+    """Open a flat or sparse image file for reading and writing."""
+    file = open(path, 'r+b')
+    magic = file.read(len(SPARSE_MAGIC))
+    if magic == SPARSE_MAGIC:
+        return SparseFile(file)
+    return file
+
+
+class Checksum:
+    """8 bit sum of all bytes of an image, for CKSUM.
+
+    The sum of every sector is held in a table, so a WRITE only has to
+    add up the 128 new bytes.  The table is filled from the idle loop
+    after the image is opened, CHECKSUM_SECTORS at a time; a CKSUM that
+    comes before it is complete reads the rest.
+
+    reference is the sum the image had when its writes were last
+    flushed, kept in the configuration under 'checksums'.  CKSUM replies
+    0 while the image matches it, which the PX-8 takes for an intact
+    (formatted) RAM-Disk, and the difference when the image was changed
+    behind its back, e.g. edited on a PC.  An image without a reference
+    is taken as it is.
+    """
+
+    def __init__(self, reference=None):
+        self.sums = bytearray(IMAGE_KB * 1024 // SECTOR_SIZE)
+        self.done = 0                                            # sectors in sums so far
+        self.total = 0                                           # sum of those
+        self.reference = reference
+        self.changed = reference is None                         # total is to be stored as the reference
+        self.buf = bytearray(SECTOR_SIZE)
+
+    def complete(self):
+        return self.done == len(self.sums)
+
+    def build(self, image, count=CHECKSUM_SECTORS):
+        """Sum up to count more sectors, return how many were summed."""
+        end = min(self.done + count, len(self.sums))
+        for sector in range(self.done, end):
+            image.readinto(sector * SECTOR_SIZE, self.buf)
+            self.sums[sector] = sum(self.buf) & 0xff
+            self.total = (self.total + self.sums[sector]) & 0xff
+        count = end - self.done
+        self.done = end
+        return count
+
+    def value(self, image):
+        """The CKSUM reply."""
+        self.build(image, len(self.sums))
+        if self.reference is None:
+            self.reference = self.total
+        return (self.total - self.reference) & 0xff
+
+    def update(self, image, offset, data):
+        """Account for data about to be written at offset."""
+        self.changed = True
+        sector = offset // SECTOR_SIZE
+        if sector >= self.done:
+            return                                               # summed with the new data later
+        if len(data) == SECTOR_SIZE:
+            new = sum(data) & 0xff
+        else:
+            old = bytearray(len(data))
+            image.readinto(offset, old)
+            new = (self.sums[sector] + sum(data) - sum(old)) & 0xff
+        self.total = (self.total + new - self.sums[sector]) & 0xff
+        self.sums[sector] = new
 
 
 class RamDisk:
@@ -44,13 +471,20 @@ class RamDisk:
         self.read_pointer = None
         self.px8_buffer = bytearray(131)                         # maximum number of bytes that are exchanged with host in one command
         self.file_buffer = bytearray(128)
-        self.cksum = 0                                           # formatted
-        self.pending_writes = False
-        self.last_flush = time.ticks_ms()
         self.read_only = False
-        self.file = None
+        self.handles = {}                                        # path -> [file, BlockCache, Checksum]
+        self.recent = []                                         # paths in self.handles, least recently used first
+        self.path = None                                         # of the active image
+        self.image = None
+        self.checksum = None
+        self.overlay = None                                      # of the active image's snapshot
+        self.generation = storage.generation                     # of the SD-Card mount the images were opened on
+        self.last_write = time.ticks_ms()
         self.read_config()
-        self.reopen_file()
+        for name in self.get_images():
+            if len(self.handles) < MAX_OPEN_IMAGES and storage.exists(name):
+                self.open_image(storage.path(name))
+        self.select_image()
 
     def read_config(self):
         if storage.exists(CONFIG_FILE):
@@ -58,64 +492,204 @@ class RamDisk:
         else:
             self.init_storage()
 
-    def write_config(self):
+    def write_config(self, quiet=False):
         storage.spit(CONFIG_FILE, json.dumps(self.config))
-        print(f'RAM-Disk configuration file {CONFIG_FILE} saved')
+        if not quiet:
+            print(f'RAM-Disk configuration file {CONFIG_FILE} saved')
 
     def init_storage(self):
-        self.config = { 'ramdisk': DEFAULT_FILE }
+        self.config = { 'ramdisk': DEFAULT_FILE, 'images': [DEFAULT_FILE] }
         name = self.config['ramdisk']
         if not storage.exists(name):
-            buf = bytearray(1024)
-            with open(storage.path(name), 'wb') as f:
-                for i in range(IMAGE_KB):
-                    f.write(buf)
+            with storage.open_file(name, 'wb') as f:
+                f.write(sparse_image())
             print(f'RAM-Disk file {name} initialized')
         self.write_config()
 
-    def reopen_file(self):
-        if self.file != None:
-            try:
-                self.file.close()
-            except OSError as e:
-                print(f'Error {e} closing file')
+    # The image files listed in the configuration are kept open in a
+    # pool of up to MAX_OPEN_IMAGES handles, so that switching images
+    # and RESET, which only checks that the configured image is the
+    # active one, do not have to close and open files.  Only the active
+    # image can have unwritten data; it is flushed before another one
+    # becomes active.
+
+    def open_image(self, path):
+        """Return the [file, BlockCache, Checksum] of path, opening it if needed."""
+        handle = self.handles.get(path)
+        if handle:
+            self.recent.remove(path)
+        else:
+            if len(self.handles) >= MAX_OPEN_IMAGES:
+                self.close_image(self.recent[0])
+            file = open_image_file(path)
+            checksum = Checksum(self.config.get('checksums', {}).get(path))
+            handle = self.handles[path] = [file, BlockCache(file), checksum]
+        self.recent.append(path)
+        return handle
+
+    def close_image(self, path):
+        file, cache, checksum = self.handles.pop(path)
+        self.recent.remove(path)
+        try:
+            cache.flush()
+            file.close()
+            self.store_checksum(path, checksum)
+        except OSError as e:
+            log.error('Error %s closing file', e)
+
+    def close_images(self):
+        """Close all image files, for a new SD-Card."""
+        try:
+            self.flush_pending_writes()
+            self.close_overlay()
+        except OSError as e:
+            log.error('Error %s flushing RAM-Disk', e)
+        self.overlay = None
+        for path in list(self.handles):
+            self.close_image(path)
+        self.path = None
+        self.image = None
+        self.checksum = None
+
+    def select_image(self):
+        """Make the configured image the active one, unless it already is."""
         if FAILSAFE_SWITCH.value() == 0:
-            path = '/ramdisk.dsk'
+            path = FAILSAFE_FILE
             self.read_only = True
-            print(f'Failsafe mode, RAM-Disk in Read-only mode')
         else:
             path = storage.path(self.config['ramdisk'])
             self.read_only = False
-        self.file = open(path, 'r+b')
-        print(f'RAM-Disk file {path} mounted')
+        if self.handles and storage.generation != self.generation:  # card remounted, e.g. by a listing
+            self.close_images()
+        if path == self.path:
+            return
+        self.flush_pending_writes()
+        self.close_overlay()
+        file, cache, self.checksum = self.open_image(path)
+        self.path = path
+        self.generation = storage.generation
+        self.image = None
+        if mode.value == MODE_MEMORY:
+            try:
+                self.image = MemoryImage(file)
+            except MemoryError:
+                log.warning('Not enough memory to hold the RAM-Disk image, using file mode')
+        if not self.image:
+            self.image = cache
+        if not self.read_only:
+            self.open_overlay()
+        if self.read_only:
+            log.warning('Failsafe mode, RAM-Disk in Read-only mode')
+        log.info('RAM-Disk file %s mounted', path)
 
     def valid_file(self, name):
         size = storage.file_size(name)
-        return size == IMAGE_KB * 1024
+        if size == IMAGE_KB * 1024:
+            return True
+        if size < SPARSE_DATA:
+            return False
+        with storage.open_file(name) as f:
+            return f.read(len(SPARSE_MAGIC)) == SPARSE_MAGIC
 
     def set_file(self, name):
         if not self.valid_file(name):
             print(f'Invalid RAM-Disk image file {name}')
             return
+        images = self.get_images()
         self.config['ramdisk'] = name
+        if name not in images:
+            self.config['images'] = images + [name]
         self.write_config()
-        self.reopen_file()
+        self.select_image()
 
     def get_file(self):
         return self.config['ramdisk']
 
+    def get_images(self):
+        """The image files to keep open, the active one included."""
+        return self.config.get('images', [self.config['ramdisk']])
+
+    def image_open(self, name):
+        return storage.path(name) in self.handles
+
+    # A snapshot keeps the active image as it was when it was taken:
+    # from then on the writes go to an Overlay in <image>.<name>.snp,
+    # until the snapshot is rolled back (the overlay is dropped) or
+    # committed (the overlay is written to the image).  The snapshot of
+    # each image is recorded under 'snapshots' in the configuration.
+
+    def get_snapshot(self):
+        """Name of the active image's snapshot, or None."""
+        return self.config.get('snapshots', {}).get(self.get_file())
+
+    def set_snapshot(self, name):
+        snapshots = self.config.setdefault('snapshots', {})
+        if name:
+            snapshots[self.get_file()] = name
+        else:
+            snapshots.pop(self.get_file(), None)
+        self.write_config()
+
+    def overlay_file(self, name):
+        return f'{self.get_file()}.{name}{SNAPSHOT_SUFFIX}'
+
+    def open_overlay(self, new=False):
+        """Put the overlay of the active image's snapshot in place.  A new
+        snapshot starts with an empty file, whatever an earlier one left."""
+        name = self.get_snapshot()
+        if name:
+            path = self.overlay_file(name)
+            if not new and not storage.exists(path):
+                log.warning('RAM-Disk snapshot file %s missing, changes since %s are lost', path, name)
+                new = True
+            file = storage.open_file(path, 'w+b' if new else 'r+b')
+            self.overlay = self.image = Overlay(self.image, file)
+            log.info('RAM-Disk snapshot %s, %d sectors changed', name, len(self.overlay.index))
+
+    def close_overlay(self):
+        if self.overlay:
+            self.overlay.file.close()
+            self.image = self.overlay.base
+            self.overlay = None
+
+    def take_snapshot(self, name):
+        self.flush_pending_writes()
+        self.set_snapshot(name)
+        self.open_overlay(new=True)
+
+    def drop_snapshot(self, commit):
+        """End the snapshot of the active image, keeping the changes made
+        since it was taken if commit is set."""
+        name = self.get_snapshot()
+        overlay = self.overlay
+        self.flush_pending_writes()
+        if commit:
+            overlay.commit()
+        self.close_overlay()
+        if not commit:
+            self.handles[self.path][2] = self.checksum = Checksum()
+        self.set_snapshot(None)
+        storage.remove(self.overlay_file(name))
+
+    def snapshot_sectors(self):
+        return len(self.overlay.index) if self.overlay else 0
+
     def handle_command(self):
         self.command = cpld.read_reg(cpld.REG_RAMDISK_CONTROL)
         self.read_pointer = 0
         self.read_count = 0
         if self.command == Command.RESET:
-            print("RAM-Disk RESET")
+            log.info("RAM-Disk RESET")
+            self.flush_pending_writes()
             self.command = None
             status = 1                            # 1 == 120K ram Disk
             if FAILSAFE_SWITCH.value() == 0:
                 status |= 2                       # 2 == Write Protect
             cpld.write_reg(cpld.REG_RAMDISK_DATA, status)
-            self.reopen_file()
+            try:
+                self.select_image()
+            except OSError as e:
+                log.error('Error %s opening RAM-Disk image', e)
         elif self.command == Command.READ:
             self.read_count = 2
         elif self.command == Command.READB:
@@ -125,15 +699,19 @@ class RamDisk:
         elif self.command == Command.WRITEB:
             self.read_count = 4
         elif self.command == Command.CKSUM:
-            print("RAM-Disk CKSUM")
+            log.info("RAM-Disk CKSUM")
             try:
-                storage.umount_sdcard()
-                storage.mount_sdcard()
-                self.reopen_file()
+                self.flush_pending_writes()
+                if not storage.card_present():                # only remount a card that was changed
+                    self.close_images()
+                    storage.mount_sdcard()
+                self.select_image()                           # reopens the files of a reseated card
+                cksum = self.checksum.value(self.image)
             except Exception as e:
-                print(f'Error {e} remounting SD-Card')
+                log.error('Error %s checking SD-Card', e)
+                cksum = 0
             self.command = None
-            cpld.write_reg(cpld.REG_RAMDISK_DATA, self.cksum)
+            cpld.write_reg(cpld.REG_RAMDISK_DATA, cksum)
         else:
             self.command = None
 
@@ -146,60 +724,54 @@ class RamDisk:
     def execute_current_command(self):
         if self.command == Command.READ:
             offset = self.get_sector_offset()
-            print("RAM-Disk READ", offset)
+            log.debug("RAM-Disk READ %d", offset)
             try:
-                self.file.seek(offset)
-                self.file.readinto(self.file_buffer)
+                self.image.readinto(offset, self.file_buffer)
                 cpld.write_reg(cpld.REG_RAMDISK_DATA, 0)                 # status OK
             except Exception as e:
-                print(f'Error {e} while reading')
+                log.error('Error %s while reading', e)
                 cpld.write_reg(cpld.REG_RAMDISK_DATA, 255)                 # status failed
-            for byte in self.file_buffer:
-                while True:
-                    if not cpld.read_reg(cpld.REG_IRQ) & cpld.IRQ_RAMDISK_IBF:
-                        break
-                cpld.write_reg(cpld.REG_RAMDISK_DATA, byte)
+            cpld.write_stream(cpld.REG_RAMDISK_DATA, self.file_buffer)
         elif self.command == Command.READB:
             offset = self.get_byte_offset()
-            print("RAM-Disk READB", offset)
+            log.debug("RAM-Disk READB %d", offset)
             try:
-                self.file.seek(offset)
-                byte = self.file.read(1)
+                byte = self.file_buffer[:1]
+                self.image.readinto(offset, byte)
                 cpld.write_reg(cpld.REG_RAMDISK_DATA, 0)                 # status OK
             except Exception as e:
-                print(f'Error {e} while writing')
+                log.error('Error %s while reading', e)
                 cpld.write_reg(cpld.REG_RAMDISK_DATA, 255)               # status failed
-            while True:
-                if not cpld.read_reg(cpld.REG_IRQ) & cpld.IRQ_RAMDISK_IBF:
-                    break
-            cpld.write_reg(cpld.REG_RAMDISK_DATA, byte)
+            cpld.write_stream(cpld.REG_RAMDISK_DATA, byte)
         elif self.command == Command.WRITE:
             if self.read_only:
                 cpld.write_reg(cpld.REG_RAMDISK_DATA, 0x04)              # status write protected
                 return
             offset = self.get_sector_offset()
-            print("RAM-Disk WRITE", offset)
-            self.file.seek(offset)
-            self.file.write(self.px8_buffer[2:130])
+            log.debug("RAM-Disk WRITE %d", offset)
+            data = memoryview(self.px8_buffer)[2:130]
+            self.checksum.update(self.image, offset, data)
+            self.image.write(offset, data)
+            self.last_write = time.ticks_ms()
             cpld.write_reg(cpld.REG_RAMDISK_DATA, 0)                     # status OK
-            self.pending_writes = True
         elif self.command == Command.WRITEB:
             if self.read_only:
                 cpld.write_reg(cpld.REG_RAMDISK_DATA, 0x04)              # status write protected
                 return
             offset = self.get_byte_offset()
-            print("RAM-Disk WRITEB", offset)
-            self.file.seek(offset)
-            self.file.write(self.px8_buffer[3])
+            log.debug("RAM-Disk WRITEB %d", offset)
+            data = memoryview(self.px8_buffer)[3:4]
+            self.checksum.update(self.image, offset, data)
+            self.image.write(offset, data)
+            self.last_write = time.ticks_ms()
             cpld.write_reg(cpld.REG_RAMDISK_DATA, 0)                     # status OK
-            self.pending_writes = True
         else:
-            print("don't know how to execute command", self.command)
+            log.warning("don't know how to execute command %s", self.command)
 
     def handle_data(self):
         byte = cpld.read_reg(cpld.REG_RAMDISK_DATA)
         if self.read_count == 0:
-            print("unexpected data from host:", byte)
+            log.warning("unexpected data from host: %d", byte)
             return
         self.px8_buffer[self.read_pointer] = byte
         self.read_pointer = self.read_pointer + 1
@@ -208,13 +780,29 @@ class RamDisk:
             self.execute_current_command()
 
     def flush_pending_writes(self):
-        if self.pending_writes:
-            print("RAM-Disk flushing writes")
-            self.pending_writes = False
+        if self.image and self.image.dirty():
+            count = self.image.flush()
+            log.info('RAM-Disk flushed %d blocks', count)
+        if self.checksum:
+            self.store_checksum(self.path, self.checksum)
 
-    def maybe_flush_pending_writes(self):
-        now = time.ticks_ms()
-        if now < self.last_flush or now > self.last_flush + FLUSH_INTERVAL:
-            self.flush_pending_writes()
-            self.last_flush = now
+    def store_checksum(self, path, checksum):
+        """Make the sum of an image whose writes are on the card its reference."""
+        if checksum.changed and checksum.complete():
+            checksum.reference = checksum.total
+            checksum.changed = False
+            self.config.setdefault('checksums', {})[path] = checksum.total
+            self.write_config(quiet=True)
+
+    def persist(self):
+        # called when the main loop is idle, writes back a few blocks
+        # once the PX-8 has stopped writing for a while, and sums up a
+        # newly opened image for CKSUM
+        if self.image and self.image.dirty() and time.ticks_diff(time.ticks_ms(), self.last_write) >= PERSIST_DELAY:
+            count = self.image.flush(PERSIST_BLOCKS)
+            if not self.image.dirty():
+                self.store_checksum(self.path, self.checksum)
+            return count
+        if self.checksum and not self.checksum.complete():
+            return self.checksum.build(self.image)
 
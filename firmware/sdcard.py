@@ -25,6 +25,8 @@ import time
 
 
 _CMD_TIMEOUT = const(100)
+_TOKEN_TIMEOUT_MS = const(100)
+_VERIFY_READS = const(16)
 
 _R1_IDLE_STATE = const(1 << 0)
 # R1_ERASE_RESET = const(1 << 1)
@@ -38,14 +40,46 @@ _TOKEN_STOP_TRAN = const(0xFD)
 _TOKEN_DATA = const(0xFE)
 
 
+def crc7(data):
+    crc = 0
+    for byte in data:
+        for bit in range(7, -1, -1):
+            crc <<= 1
+            if ((byte >> bit) ^ (crc >> 7)) & 1:
+                crc ^= 0x09
+        crc &= 0x7F
+    return crc
+
+
+def crc16(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+    return crc
+
+
 class SDCard:
-    def __init__(self, spi, cs, baudrate=1320000):
+    def __init__(self, spi, cs, baudrate=1320000, readahead=4):
         self.spi = spi
         self.cs = cs
+        self.baudrate = baudrate
+
+        # read-ahead cache: when single blocks are read sequentially,
+        # the next `readahead` blocks are fetched with one CMD18
+        self.readahead = readahead
+        self.cachebuf = bytearray(readahead * 512)
+        self.cache_start = 0
+        self.cache_count = 0
+        self.next_block = -1
+        self.cache_hits = 0
+        self.cache_misses = 0
 
         self.cmdbuf = bytearray(6)
         self.dummybuf = bytearray(512)
         self.tokenbuf = bytearray(1)
+        self.crcbuf = bytearray(2)
         for i in range(512):
             self.dummybuf[i] = 0xFF
         self.dummybuf_memoryview = memoryview(self.dummybuf)
@@ -92,10 +126,13 @@ class SDCard:
 
         # get the number of sectors
         # CMD9: response R2 (R1 byte + 16-byte block read)
-        if self.cmd(9, 0, 0, 0, False) != 0:
+        csd = self.read_register(9)
+        if csd is None:
             raise OSError("no response from SD card")
-        csd = bytearray(16)
-        self.readinto(csd)
+        self.csd = csd
+        self.cid = self.read_register(10)
+        if self.cid is None:
+            raise OSError("can't read SD card CID")
         if csd[0] & 0xC0 == 0x40:  # CSD version 2.0
             self.sectors = ((csd[8] << 8 | csd[9]) + 1) * 1024
         elif csd[0] & 0xC0 == 0x00:  # CSD version 1.0 (old, <=2GB)
@@ -150,10 +187,10 @@ class SDCard:
         # create and send the command
         buf = self.cmdbuf
         buf[0] = 0x40 | cmd
-        buf[1] = arg >> 24
-        buf[2] = arg >> 16
-        buf[3] = arg >> 8
-        buf[4] = arg
+        buf[1] = (arg >> 24) & 0xFF
+        buf[2] = (arg >> 16) & 0xFF
+        buf[3] = (arg >> 8) & 0xFF
+        buf[4] = arg & 0xFF
         buf[5] = crc
         self.spi.write(buf)
 
@@ -185,15 +222,16 @@ class SDCard:
     def readinto(self, buf):
         self.cs(0)
 
-        # read until start byte (0xff)
-        for i in range(_CMD_TIMEOUT):
+        # read until start byte (0xfe), polling without sleeping as the
+        # token usually arrives within a few bytes
+        start = time.ticks_ms()
+        while True:
             self.spi.readinto(self.tokenbuf, 0xFF)
             if self.tokenbuf[0] == _TOKEN_DATA:
                 break
-            time.sleep_ms(1)
-        else:
-            self.cs(1)
-            raise OSError("timeout waiting for response")
+            if time.ticks_diff(time.ticks_ms(), start) > _TOKEN_TIMEOUT_MS:
+                self.cs(1)
+                raise OSError("timeout waiting for response")
 
         # read data
         mv = self.dummybuf_memoryview
@@ -202,12 +240,71 @@ class SDCard:
         self.spi.write_readinto(mv, buf)
 
         # read checksum
-        self.spi.write(b"\xff")
-        self.spi.write(b"\xff")
+        self.spi.write_readinto(b"\xff\xff", self.crcbuf)
 
         self.cs(1)
         self.spi.write(b"\xff")
 
+    def read_register(self, cmd):
+        # read the CSD (CMD9) or CID (CMD10) and return it if both its
+        # CRC7 and the CRC16 of the data block are valid, else None
+        if self.cmd(cmd, 0, 0, 0, False) != 0:
+            self.cs(1)
+            self.spi.write(b"\xff")
+            return None
+        buf = bytearray(16)
+        try:
+            self.readinto(buf)
+        except OSError:
+            return None
+        if crc16(buf) != (self.crcbuf[0] << 8 | self.crcbuf[1]):
+            return None
+        if buf[15] != (crc7(memoryview(buf)[:15]) << 1 | 1):
+            return None
+        return buf
+
+    def present(self):
+        # CMD13 (SEND_STATUS) answers with an R2, the R1 byte and one more
+        # status byte.  A card that was pulled, or replaced by one that
+        # is not initialized, does not answer with R1 == 0.
+        return self.cmd(13, 0, 0, 1) == 0
+
+    def reinit(self):
+        # initialise a card that stopped answering again and return True
+        # if it is the same card, i.e. its CID did not change
+        cid = self.cid
+        self.cache_count = 0
+        self.next_block = -1
+        self.init_card(self.baudrate)
+        return self.cid == cid
+
+    def verify_clock(self, baudrate):
+        # switch the bus to baudrate and check that the CSD and CID can
+        # be read back repeatedly with valid CRCs and unchanged contents
+        self.init_spi(baudrate)
+        for _ in range(_VERIFY_READS):
+            if self.read_register(9) != self.csd or self.read_register(10) != self.cid:
+                return False
+        return True
+
+    def negotiate_clock(self, baudrates, preferred=None):
+        # try the preferred clock first, else step up through baudrates
+        # (ascending) until a step fails verification.  The bus is left
+        # at the highest clock that worked, which is returned.
+        if preferred and self.verify_clock(preferred):
+            best = preferred
+        else:
+            best = self.baudrate
+            for baudrate in baudrates:
+                if baudrate <= best:
+                    continue
+                if not self.verify_clock(baudrate):
+                    break
+                best = baudrate
+        self.init_spi(best)
+        self.baudrate = best
+        return best
+
     def write(self, token, buf):
         self.cs(0)
 
@@ -242,12 +339,33 @@ class SDCard:
         self.spi.write(b"\xff")
 
     def readblocks(self, block_num, buf):
+        nblocks = len(buf) // 512
+        assert nblocks and not len(buf) % 512, "Buffer length is invalid"
+        sequential = block_num == self.next_block
+        self.next_block = block_num + nblocks
+        if nblocks == 1 and self.readahead:
+            index = block_num - self.cache_start
+            if 0 <= index < self.cache_count:
+                self.cache_hits += 1
+                buf[:] = memoryview(self.cachebuf)[index * 512 : (index + 1) * 512]
+                return
+            self.cache_misses += 1
+            if sequential:
+                count = min(self.readahead, self.sectors - block_num)
+                self.cache_count = 0
+                self.read_multiple(block_num, memoryview(self.cachebuf)[: count * 512])
+                self.cache_start = block_num
+                self.cache_count = count
+                buf[:] = memoryview(self.cachebuf)[:512]
+                return
+        self.read_multiple(block_num, buf)
+
+    def read_multiple(self, block_num, buf):
         # workaround for shared bus, required for (at least) some Kingston
         # devices, ensure MOSI is high before starting transaction
         self.spi.write(b"\xff")
 
         nblocks = len(buf) // 512
-        assert nblocks and not len(buf) % 512, "Buffer length is invalid"
         if nblocks == 1:
             # CMD17: set read address for single block
             if self.cmd(17, block_num * self.cdv, 0, release=False) != 0:
@@ -298,6 +416,16 @@ class SDCard:
                 offset += 512
                 nblocks -= 1
             self.write_token(_TOKEN_STOP_TRAN)
+        self.update_cache(block_num, buf)
+
+    def update_cache(self, block_num, buf):
+        # keep read-ahead blocks in sync with blocks that are written
+        nblocks = len(buf) // 512
+        first = max(block_num, self.cache_start)
+        last = min(block_num + nblocks, self.cache_start + self.cache_count)
+        if first < last:
+            self.cachebuf[(first - self.cache_start) * 512 : (last - self.cache_start) * 512] = \
+                memoryview(buf)[(first - block_num) * 512 : (last - block_num) * 512]
 
     def ioctl(self, op, arg):
         if op == 4:  # get number of blocks
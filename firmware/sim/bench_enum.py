@@ -0,0 +1,77 @@
+"""Compare the cost of enum name lookups with cached tables against
+rebuilding the value -> name mapping on every call, as enum.py did
+before."""
+
+import timeit
+
+import hostenv
+
+Enum = hostenv.load_enum().Enum
+
+
+class OldEnum:
+    @classmethod
+    def _create_name_mapping(cls):
+        return {value: name for name, value in cls.__dict__.items() if isinstance(value, int)}
+
+    @classmethod
+    def get_name(cls, value):
+        return cls._create_name_mapping().get(value, "UNKNOWN")
+
+    @classmethod
+    def get_names(cls, value):
+        result = []
+        for mask, name in cls._create_name_mapping().items():
+            if value & mask:
+                result.append(name)
+        return result
+
+
+def members(base):
+    class State(base):
+        IDLE = 0
+        OFF_HOOK = 1
+        DIALING = 2
+        RINGING = 3
+        ECHO_CANCEL = 4
+        HANDSHAKE = 5
+        CONNECTED = 6
+        ENTER_COMMAND_MODE = 7
+        COMMAND_MODE = 8
+        CALL_FAILED = 9
+        DRAIN_UART = 10
+        TELNET_MODE = 11
+
+    class Control(base):
+        OHC = 0x01
+        HSC = 0x02
+        MON = 0x04
+        TXC = 0x08
+        ANS = 0x10
+        TEST = 0x20
+        PWR = 0x40
+        CCT = 0x80
+
+    return State, Control
+
+
+def run(number=100_000):
+    old_state, old_control = members(OldEnum)
+    state, control = members(Enum)
+    for value in range(256):
+        assert control.get_names(value) == old_control.get_names(value), value
+    for value in range(-1, 13):
+        assert state.get_name(value) == old_state.get_name(value), value
+    cases = (
+        ('get_name', lambda cls: cls.get_name(6), old_state, state),
+        ('get_names', lambda cls: cls.get_names(0x5b), old_control, control),
+    )
+    for name, call, old, new in cases:
+        old_time = timeit.timeit(lambda: call(old), number=number) / number
+        new_time = timeit.timeit(lambda: call(new), number=number) / number
+        print(f'{name:<10} rebuilt {old_time * 1e9:6.0f} ns, cached {new_time * 1e9:6.0f} ns, '
+              f'{old_time / new_time:.1f}x')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,140 @@
+"""Benchmark the firmware on the host with a simulated PX-8.
+
+    python firmware/sim/bench_firmware.py [sectors] [modem bytes]
+
+RAM-Disk: the PX-8 writes and then reads back sectors spread over the
+whole image and checks the data.  Modem: the PX-8 dials a phonebook
+entry at 19200 baud that points to a listener on localhost, which
+sends a block of data; then the PX-8 sends a block back at line rate.
+At the end the time each IRQ was pending until the firmware read its
+register is reported.  The figures are host timings and only useful
+for comparing changes to the firmware with each other.
+"""
+
+import random
+import socket
+import sys
+import threading
+import time
+
+import px8sim
+
+BAUDRATE = 19200
+TRACKS = 15
+SECTORS_PER_TRACK = 64
+
+
+IAC = 0xff
+
+
+class Listener(threading.Thread):
+    """Takes one call, sends payload and collects what comes back, minus
+    the telnet option negotiation the modem starts with."""
+
+    def __init__(self, payload, expected):
+        super().__init__(daemon=True)
+        self.payload = payload
+        self.expected = expected
+        self.received = bytearray()
+        self.option = 0                                     # bytes left of a telnet command
+        self.done_at = None
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(1)
+        self.port = self.socket.getsockname()[1]
+        self.start()
+
+    def run(self):
+        connection, _ = self.socket.accept()
+        connection.sendall(self.payload)
+        while len(self.received) < self.expected:
+            data = connection.recv(4096)
+            if not data:
+                break
+            for byte in data:
+                if self.option:
+                    self.option -= 1
+                elif byte == IAC:
+                    self.option = 2
+                else:
+                    self.received.append(byte)
+        self.done_at = time.perf_counter()
+        connection.close()
+
+
+def ramdisk_script(count, results):
+    def script(px8):
+        rng = random.Random(1)
+        sectors = rng.sample([(t, s) for t in range(TRACKS) for s in range(SECTORS_PER_TRACK)], count)
+        data = {sector: bytes(rng.randrange(256) for _ in range(px8sim.SECTOR_SIZE)) for sector in sectors}
+        start = time.perf_counter()
+        for track, sector in sectors:
+            yield from px8.write_sector(track, sector, data[track, sector])
+        results['write'] = count / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for track, sector in sectors:
+            if (yield from px8.read_sector(track, sector)) != data[track, sector]:
+                raise RuntimeError(f'sector {track}/{sector} read back wrong')
+        results['read'] = count / (time.perf_counter() - start)
+    return script
+
+
+def modem_script(listener, count, results):
+    def script(px8):
+        yield from px8.enable_modem()
+        yield from px8.set_baudrate(BAUDRATE)
+        yield from px8.dial('1')
+        yield from px8.wait_carrier()
+        px8.received.clear()
+        start = time.perf_counter()
+        yield lambda bus: len(px8.received) >= count
+        results['to_px8'] = count / (time.perf_counter() - start)
+        if bytes(px8.received[:count]) != listener.payload:
+            raise RuntimeError('data received by the PX-8 differs from what was sent')
+        # send at line rate, like the PX-8's UART would
+        upstream = bytes(random.Random(2).randrange(0xff) for _ in range(count))
+        start = time.perf_counter()
+        sent = 0
+        while sent < count:
+            due = min(count, int((time.perf_counter() - start) * BAUDRATE / 10) + 1)
+            px8.send(upstream[sent:due])
+            sent = due
+            yield from px8.sleep(0.001)
+        yield lambda bus: listener.done_at is not None
+        results['from_px8'] = count / (listener.done_at - start)
+        if bytes(listener.received) != upstream:
+            raise RuntimeError('data received by the listener differs from what was sent')
+        yield from px8.hang_up()
+    return script
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    sectors = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    modem_bytes = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    payload = bytes(random.Random(3).randrange(0xff) for _ in range(modem_bytes))   # no IAC
+    listener = Listener(payload, modem_bytes)
+    simulation = px8sim.Simulation(phonebook={'1': ['bench.sim', listener.port]})
+
+    results = {}
+    simulation.run(ramdisk_script(sectors, results))
+    print(f'RAM-Disk: {sectors} sectors, write {results["write"]:.0f} sectors/s, read {results["read"]:.0f} sectors/s')
+
+    simulation.run(modem_script(listener, modem_bytes, results))
+    line_rate = BAUDRATE / 10
+    print(f'Modem at {BAUDRATE} baud: {modem_bytes} bytes, to PX-8 {results["to_px8"]:.0f} bytes/s, '
+          f'from PX-8 {results["from_px8"]:.0f} bytes/s (line rate {line_rate:.0f}), '
+          f'{simulation.uart.blocked_writes} blocking UART writes')
+
+    print('IRQ latency (us)     count  median     p99     max')
+    for name, latencies in simulation.irq_latencies():
+        latencies = sorted(latency * 1e6 for latency in latencies)
+        print(f'{name:<18} {len(latencies):7d} {percentile(latencies, 0.5):7.0f} '
+              f'{percentile(latencies, 0.99):7.0f} {latencies[-1]:7.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Run the modem's UART bridge against a local socket pair.
+
+The remote end sends as fast as the socket takes data while the PX-8
+sends at line speed.  The UART stand-in models the line timing, so the
+run shows whether the bridge keeps the line busy without blocking in
+uart.write().  With XON/XOFF, the PX-8 stops the data for a while.
+"""
+
+import random
+import socket
+import sys
+import time
+
+import hostenv
+from machine import UART
+
+(bridge,) = hostenv.load('bridge')
+
+UART.line_timing = True
+
+DURATION = 3.0
+
+
+def run(baudrate, flow, duration):
+    uart = UART(0, baudrate)
+    local, remote = socket.socketpair()
+    local.setblocking(False)
+    remote.setblocking(False)
+    b = bridge.Bridge(uart, baudrate)
+    b.start(local, flow)
+
+    random.seed(1)
+    downstream = bytes(random.randrange(256) for _ in range(baudrate)).replace(b'\xff', b'\xfe')
+    upstream = bytes(random.randrange(256) for _ in range(baudrate)).replace(b'\x11', b'\x10').replace(b'\x13', b'\x12')
+    sent_down = 0
+    sent_up = 0
+    received_up = bytearray()
+    start = time.perf_counter()
+    pause = (start + duration / 3, start + duration / 2) if flow == bridge.FLOW_XONXOFF else None
+    paused_bytes = None
+    while time.perf_counter() - start < duration:
+        now = time.perf_counter()
+        if sent_down < len(downstream):
+            try:
+                sent_down += remote.send(downstream[sent_down:sent_down + 4096])
+            except BlockingIOError:
+                pass
+        # the PX-8 sends at line speed
+        due = min(len(upstream), int((now - start) * baudrate / 10))
+        if due > sent_up:
+            uart.feed(upstream[sent_up:due])
+            sent_up = due
+        if pause and now >= pause[0] and paused_bytes is None:
+            uart.feed(bytes([bridge.XOFF]))
+            paused_bytes = len(uart.tx)
+        if pause and now >= pause[1] and paused_bytes is not None and pause[0]:
+            assert len(uart.tx) - paused_bytes <= bridge.TX_BURST, 'bridge did not stop on XOFF'
+            uart.feed(bytes([bridge.XON]))
+            pause = (0, 0)
+        try:
+            received_up += remote.recv(4096)
+        except BlockingIOError:
+            pass
+        b.poll()
+        b.update_rates()
+        time.sleep(0.0002)
+    elapsed = time.perf_counter() - start
+    to_px8 = bytes(uart.tx)
+    assert to_px8 == downstream[:len(to_px8)], 'data to the PX-8 corrupted'
+    escaped_up = upstream.replace(b'\xff', b'\xff\xff')             # IAC escaping for telnet
+    assert bytes(received_up) == escaped_up[:len(received_up)], 'data from the PX-8 corrupted'
+    busy_time = elapsed - (duration / 6 if flow == bridge.FLOW_XONXOFF else 0)
+    print(f'{baudrate} baud, flow {flow}: to PX-8 {len(to_px8) / busy_time:.0f} bytes/s, '
+          f'from PX-8 {len(received_up) / elapsed:.0f} bytes/s (line {baudrate // 10}), '
+          f'blocked UART writes {uart.blocked_writes}, status: {b.status()}')
+    assert uart.blocked_writes == 0
+    local.close()
+    remote.close()
+
+
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else DURATION
+    for baudrate in (4800, 19200):
+        run(baudrate, bridge.FLOW_NONE, duration)
+    run(19200, bridge.FLOW_XONXOFF, duration)
@@ -0,0 +1,58 @@
+"""Check cpld.write_stream() against the CPLD model.
+
+A PX-8 that picks up RAM-Disk data bytes after a random number of bus
+cycles reads a burst.  The bytes must arrive in order and the Pico
+must never overwrite a byte that the PX-8 has not read yet.
+"""
+
+import random
+
+import hostenv
+import px8bus
+import rp2
+
+cpld_model = px8bus.CPLD()
+rp2.attach('cpld_interface', px8bus.CPLDInterface(cpld_model))
+cpld, = hostenv.load('cpld')
+
+
+class SlowReader:
+    def __init__(self, max_delay):
+        self.max_delay = max_delay
+        self.delay = 0
+        self.received = bytearray()
+
+    def clock(self, bus):
+        if not bus.irq & px8bus.IRQ_RAMDISK_IBF:
+            return
+        if self.delay:
+            self.delay -= 1
+            return
+        self.received.append(bus.px8_in(px8bus.PX8_RAMDISK_DATA))
+        self.delay = random.randint(0, self.max_delay)
+
+
+def check(max_delay, data):
+    reader = SlowReader(max_delay)
+    cpld_model.px8 = reader
+    cpld_model.overruns = 0
+    start = cpld_model.cycles
+    cpld.write_stream(cpld.REG_RAMDISK_DATA, data)
+    while cpld_model.irq & px8bus.IRQ_RAMDISK_IBF:
+        cpld_model.clock()
+    assert reader.received == data, f'bytes received out of order: {bytes(reader.received)!r}'
+    assert cpld_model.overruns == 0, f'{cpld_model.overruns} bytes overwritten before the PX-8 read them'
+    print(f'max delay {max_delay:3}: {len(data)} bytes in {cpld_model.cycles - start} bus cycles')
+
+
+if __name__ == '__main__':
+    random.seed(8)
+    sector = bytes(random.randrange(256) for _ in range(128))
+    for max_delay in (0, 1, 5, 50):
+        check(max_delay, sector)
+    check(3, b'\x00')
+    cpld.write_reg(cpld.REG_MODEM_STATUS, 0x05)
+    assert cpld_model.modem_status == 0x05
+    cpld_model.tone_dialer = 0x13
+    assert cpld.read_reg(cpld.REG_TONE_DIALER) == 0x13
+    print('ok')
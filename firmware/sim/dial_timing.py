@@ -0,0 +1,110 @@
+"""Time the modem's call setup against local stand-ins.
+
+A UDP name server on localhost answers queries for *.test after a
+delay (and with NXDOMAIN for other names), a TCP listener takes the
+calls.  Call.poll() is called like on every modem tick, and the
+longest single poll is reported: that is how long the main loop (and
+the RAM-Disk) waits, compared with the whole setup time that a
+blocking getaddrinfo() and connect() would stall it for.  Redials go
+through the DNS cache and skip the name server.
+"""
+
+import socket
+import struct
+import threading
+import time
+
+import hostenv
+
+(dialer,) = hostenv.load('dialer')
+
+DNS_DELAY = 0.3
+
+
+class NameServer(threading.Thread):
+    def __init__(self, delay, answer=True):
+        super().__init__(daemon=True)
+        self.delay = delay
+        self.answer = answer
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.port = self.socket.getsockname()[1]
+        self.start()
+
+    def run(self):
+        while True:
+            query, client = self.socket.recvfrom(512)
+            if not self.answer:
+                continue
+            time.sleep(self.delay)
+            name_end = query.index(0, 12) + 5
+            known = b'\x04test\x00' in query[12:name_end]
+            flags = 0x8180 if known else 0x8183
+            header = struct.pack('!HHHHHH', struct.unpack('!H', query[:2])[0], flags, 1, 1 if known else 0, 0, 0)
+            response = header + query[12:name_end]
+            if known:
+                response += struct.pack('!HHHIH', 0xc00c, dialer.TYPE_A, dialer.CLASS_IN, 60, 4) + bytes([127, 0, 0, 1])
+            self.socket.sendto(response, client)
+
+
+def listener():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(4)
+    return server
+
+
+def closed_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def call(name, host, port, expected, tick=0.01, cache=None):
+    started = time.perf_counter()
+    setup = dialer.Call(host, port, '127.0.0.1', cache)
+    longest = time.perf_counter() - started
+    status = setup.state
+    while status in (dialer.RESOLVING, dialer.CONNECTING):
+        time.sleep(tick)
+        poll_start = time.perf_counter()
+        status = setup.poll()
+        longest = max(longest, time.perf_counter() - poll_start)
+    total = time.perf_counter() - started
+    names = {dialer.CONNECTED: 'connected', dialer.FAILED_LOOKUP: 'lookup failed',
+             dialer.FAILED_CONNECT: 'connect failed'}
+    print(f'{name:<22} {names[status]:<15} setup {total * 1000:7.1f} ms, '
+          f'longest poll {longest * 1e6:5.0f} us')
+    assert status == expected, f'expected {names[expected]}'
+    if setup.socket:
+        setup.socket.close()
+
+
+if __name__ == '__main__':
+    server = listener()
+    port = server.getsockname()[1]
+    dialer.DNS_TIMEOUT = 500
+    dialer.DNS_PORT = NameServer(DNS_DELAY).port
+    call('IP address', '127.0.0.1', port, dialer.CONNECTED)
+    call('name', 'bbs.test', port, dialer.CONNECTED)
+    call('unknown name', 'bbs.example', port, dialer.FAILED_LOOKUP)
+    call('refused', '127.0.0.1', closed_port(), dialer.FAILED_CONNECT)
+    dialer.DNS_PORT = NameServer(0, answer=False).port
+    call('name server silent', 'bbs.test', port, dialer.FAILED_LOOKUP)
+
+    dialer.DNS_PORT = NameServer(DNS_DELAY).port
+    cache = dialer.DnsCache()
+    call('name, cache miss', 'bbs.test', port, dialer.CONNECTED, cache=cache)
+    call('redial, cache hit', 'bbs.test', port, dialer.CONNECTED, cache=cache)
+    call('unknown, cache miss', 'bbs.example', port, dialer.FAILED_LOOKUP, cache=cache)
+    call('unknown, negative hit', 'bbs.example', port, dialer.FAILED_LOOKUP, cache=cache)
+    cache.prewarm([('other.test', port)], '127.0.0.1')
+    while cache.queue or cache.query:
+        cache.poll()
+        time.sleep(0.01)
+    call('prewarmed', 'other.test', port, dialer.CONNECTED, cache=cache)
+    print(f'cache: {cache.status()}')
+    assert (cache.hits, cache.negative_hits) == (2, 1)
+    print('ok')
@@ -0,0 +1,79 @@
+"""Run firmware modules under CPython.
+
+The modules in this directory stand in for the MicroPython ports
+(machine, rp2, ...), so scripts that use the firmware are started from
+here, e.g. "python firmware/sim/cpld_stream.py".  The firmware's
+enum.py shadows the standard library module that re, socket and
+asyncio depend on, so load() imports the requested firmware modules
+with the firmware enum module swapped in only temporarily.
+"""
+
+import enum                                                 # the standard library one, before FIRMWARE_DIR is on sys.path
+import importlib
+import importlib.util
+import os
+import sys
+import time
+
+FIRMWARE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# MicroPython's time functions
+START = time.monotonic_ns()
+TICKS_PERIOD = 1 << 30
+
+
+def ticks_ms():
+    return ((time.monotonic_ns() - START) // 1_000_000) % TICKS_PERIOD
+
+
+def ticks_us():
+    return ((time.monotonic_ns() - START) // 1_000) % TICKS_PERIOD
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) % TICKS_PERIOD
+
+
+def ticks_diff(end, start):
+    return ((end - start + TICKS_PERIOD // 2) % TICKS_PERIOD) - TICKS_PERIOD // 2
+
+
+time.ticks_ms = ticks_ms
+time.ticks_us = ticks_us
+time.ticks_add = ticks_add
+time.ticks_diff = ticks_diff
+time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+time.sleep_us = lambda us: time.sleep(us / 1_000_000)
+
+# Standard library modules that the firmware imports (json through re)
+# and that import enum themselves.  They are imported before the
+# firmware enum module is swapped in.
+STDLIB_MODULES = ('asyncio', 're', 'socket')
+
+firmware_enum = None
+
+
+def load_enum():
+    global firmware_enum
+    if firmware_enum:
+        return firmware_enum
+    spec = importlib.util.spec_from_file_location('enum', os.path.join(FIRMWARE_DIR, 'enum.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    firmware_enum = module
+    return module
+
+
+def load(*names):
+    """Import the firmware modules in names and return them as a tuple."""
+    for name in STDLIB_MODULES:
+        importlib.import_module(name)
+    sys.modules['enum'] = load_enum()
+    if FIRMWARE_DIR not in sys.path:
+        sys.path.insert(1, FIRMWARE_DIR)
+    try:
+        modules = tuple(importlib.import_module(name) for name in names)
+    finally:
+        sys.modules['enum'] = enum
+    return modules
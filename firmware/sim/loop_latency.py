@@ -0,0 +1,72 @@
+"""Measure wake-up latency and idle time of the firmware event loop.
+
+A simulated PX-8 writes to the tone dialer port at random times, the
+loop's handler reads the register back and records how long the IRQ
+was pending.  A 10 ms timer stands in for the modem tick.  The same
+load is run once with the idle backoff and once as a busy loop.
+"""
+
+import random
+import sys
+import time
+
+import hostenv
+import px8bus
+import rp2
+
+cpld_model = px8bus.CPLD()
+rp2.attach('cpld_interface', px8bus.CPLDInterface(cpld_model))
+cpld, eventloop = hostenv.load('cpld', 'eventloop')
+IDLE_PASSES = eventloop.IDLE_PASSES
+
+
+class RandomDialer:
+    def __init__(self, mean_interval):
+        self.mean_interval = mean_interval
+        self.raised = None
+        self.next_event = time.perf_counter() + random.expovariate(1 / mean_interval)
+
+    def clock(self, bus):
+        now = time.perf_counter()
+        if self.raised is None and now >= self.next_event:
+            bus.px8_out(px8bus.PX8_TONE_DIALER, 0x10)
+            self.raised = self.next_event
+            self.next_event = now + random.expovariate(1 / self.mean_interval)
+
+
+def measure(duration, idle, mean_interval=0.005):
+    dialer = RandomDialer(mean_interval)
+    cpld_model.px8 = dialer
+    latencies = []
+    ticks = []
+
+    def handle_tone_dialer():
+        cpld.read_reg(cpld.REG_TONE_DIALER)
+        latencies.append(time.perf_counter() - dialer.raised)
+        dialer.raised = None
+
+    eventloop.IDLE_PASSES = IDLE_PASSES if idle else sys.maxsize
+    loop = eventloop.EventLoop()
+    loop.on_irq(cpld.IRQ_TONE_DIALER, handle_tone_dialer)
+    loop.every(10, lambda: ticks.append(time.perf_counter()))
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        # the host has no interrupt to end machine.idle() early, so the
+        # PX-8 side is given a chance to run before each pass
+        cpld_model.clock()
+        loop.step()
+    stats = loop.stats()
+    latencies.sort()
+    jitter = [abs(b - a - 0.010) for a, b in zip(ticks, ticks[1:])]
+    print(f'{"idle" if idle else "busy"}: {len(latencies)} IRQs, '
+          f'latency median {latencies[len(latencies) // 2] * 1e6:.0f} us, '
+          f'max {latencies[-1] * 1e6:.0f} us, '
+          f'tick jitter max {max(jitter) * 1e3:.2f} ms, '
+          f'{stats["passes"] / duration:.0f} passes/s, idle {stats["idle_percent"]}%')
+
+
+if __name__ == '__main__':
+    random.seed(2)
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    measure(duration, idle=False)
+    measure(duration, idle=True)
@@ -0,0 +1,157 @@
+"""Host stand-in for the parts of the MicroPython machine module that
+the firmware uses.
+
+Devices on the other side are connected with Pin.listen() (called with
+the new level whenever the firmware sets a pin), attach_spi() and
+UART.ports, which holds the last UART created for each id."""
+
+import time
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    levels = {}
+    listeners = {}
+
+    @staticmethod
+    def listen(id, listener):
+        Pin.listeners[id] = listener
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.init(mode, pull, value)
+
+    def init(self, mode=-1, pull=-1, value=None):
+        if value is not None:
+            self.value(value)
+        elif pull == Pin.PULL_UP:
+            Pin.levels.setdefault(self.id, 1)
+
+    def value(self, value=None):
+        if value is None:
+            return Pin.levels.get(self.id, 0)
+        Pin.levels[self.id] = value
+        listener = Pin.listeners.get(self.id)
+        if listener:
+            listener(value)
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+    def irq(self, handler=None, trigger=0):
+        pass
+
+
+class UART:
+    """One end of a serial line.  The PX-8 side is driven through
+    feed() (data the PX-8 sends) and take() (data sent to the PX-8).
+    With line_timing set, sending takes 10 bit times per byte: txdone()
+    is false until the data written so far would have left the line,
+    and writes that would not fit into the TX FIFO and buffer (where
+    the real write() blocks) are counted in blocked_writes.  Without
+    it, the default, the line is infinitely fast, for benchmarks of
+    the code that feeds the UART."""
+
+    TX_BUFFER = 32 + 256
+    ports = {}
+    line_timing = False
+
+    def __init__(self, id, baudrate=9600, **kwargs):
+        self.id = id
+        UART.ports[id] = self
+        self.rx = bytearray()
+        self.tx = bytearray()
+        self.tx_done_at = 0
+        self.blocked_writes = 0
+        self.init(baudrate, **kwargs)
+
+    def init(self, baudrate=9600, **kwargs):
+        self.baudrate = baudrate
+
+    def tx_queued(self):
+        if not self.line_timing:
+            return 0
+        return max(0, self.tx_done_at - time.perf_counter()) * self.baudrate / 10
+
+    def any(self):
+        return len(self.rx)
+
+    def read(self, nbytes=None):
+        if not self.rx:
+            return None
+        if nbytes is None:
+            nbytes = len(self.rx)
+        data = bytes(self.rx[:nbytes])
+        del self.rx[:nbytes]
+        return data
+
+    def readinto(self, buf, nbytes=None):
+        data = self.read(len(buf) if nbytes is None else nbytes)
+        if not data:
+            return None
+        buf[:len(data)] = data
+        return len(data)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        if self.tx_queued() + len(data) > self.TX_BUFFER:
+            self.blocked_writes += 1
+        self.tx_done_at = max(self.tx_done_at, time.perf_counter()) + len(data) * 10 / self.baudrate
+        self.tx += data
+        return len(data)
+
+    def txdone(self):
+        return not self.line_timing or time.perf_counter() >= self.tx_done_at
+
+    def feed(self, data):
+        self.rx += data
+
+    def take(self):
+        data = bytes(self.tx)
+        self.tx = bytearray()
+        return data
+
+
+spi_buses = {}
+
+
+def attach_spi(id, bus):
+    spi_buses[id] = bus
+
+
+def SPI(id, *args, **kwargs):
+    """Return the bus attached for id, e.g. an sdspi.FakeSPI."""
+    try:
+        return spi_buses[id]
+    except KeyError:
+        raise OSError(f'nothing attached to SPI({id})')
+
+
+IDLE_SECONDS = 0.001                                        # there are no interrupts to wake up early
+
+
+def idle():
+    time.sleep(IDLE_SECONDS)
+
+
+def freq():
+    return 125_000_000
+
+
+class Memory(dict):
+    """Writes through mem32 are recorded, reads return 0 (an abort, for
+    example, is done at once)."""
+
+    def __getitem__(self, address):
+        return 0
+
+
+mem32 = Memory()
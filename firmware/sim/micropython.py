@@ -0,0 +1,12 @@
+"""Host stand-in for the MicroPython micropython module."""
+
+
+def const(value):
+    return value
+
+
+def native(function):
+    return function
+
+
+viper = native
@@ -0,0 +1,51 @@
+"""Host stand-in for the MicroPython network module.
+
+The WLAN "connects" after CONNECT_DELAY seconds and reports localhost
+as its address, gateway and name server, so the firmware's sockets are
+host sockets on the loopback interface.  A simulation sets DNS_SERVER
+(and dialer.DNS_PORT) to a name server of its own.
+"""
+
+import time
+
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_WRONG_PASSWORD = -3
+STAT_NO_AP_FOUND = -2
+STAT_CONNECT_FAIL = -1
+STAT_GOT_IP = 3
+
+CONNECT_DELAY = 0.05
+DNS_SERVER = '127.0.0.1'
+
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self.interface = interface
+        self.enabled = False
+        self.connect_time = None
+
+    def active(self, value=None):
+        if value is None:
+            return self.enabled
+        self.enabled = bool(value)
+        if not self.enabled:
+            self.connect_time = None
+
+    def connect(self, ssid, key):
+        self.ssid = ssid
+        self.connect_time = time.monotonic() + CONNECT_DELAY
+
+    def status(self):
+        if not self.enabled or self.connect_time is None:
+            return STAT_IDLE
+        return STAT_GOT_IP if time.monotonic() >= self.connect_time else STAT_CONNECTING
+
+    def isconnected(self):
+        return self.status() == STAT_GOT_IP
+
+    def ifconfig(self):
+        return ('127.0.0.1', '255.0.0.0', '127.0.0.1', DNS_SERVER)
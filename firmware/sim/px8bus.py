@@ -0,0 +1,219 @@
+"""Model of the PicoX-8 CPLD register file (see cpld/picox-8.vhd).
+
+The Pico side is reached through CPLDInterface, which stands in for
+the cpld_interface PIO state machine: it decodes the 32-bit command
+words that firmware/cpld.py puts into the TX FIFO into bus cycles.
+The PX-8 side is reached through px8_in() and px8_out() with the Z80
+I/O port numbers.  Every bus cycle advances the clock, which gives a
+scripted PX-8 (anything with a clock(cpld) method) the chance to run.
+"""
+
+from collections import deque
+
+# Z80 I/O ports decoded by the CPLD
+PX8_BAUDRATE        = 0x00
+PX8_CTLR2           = 0x02
+PX8_RAMDISK_DATA    = 0x80
+PX8_RAMDISK_CONTROL = 0x81
+PX8_TONE_DIALER     = 0x84
+PX8_MODEM_CONTROL   = 0x85
+PX8_MODEM_STATUS    = 0x86
+
+# Pico register addresses and IRQ bits, as in firmware/cpld.py
+REG_TONE_DIALER     = 0
+REG_SERIAL_CONTROL  = 0
+REG_MODEM_CONTROL   = 1
+REG_MODEM_STATUS    = 2
+REG_RAMDISK_DATA    = 3
+REG_RAMDISK_CONTROL = 4
+REG_BAUDRATE        = 5
+REG_MISC_CONTROL    = 6
+REG_IRQ             = 7
+
+IRQ_TONE_DIALER     = 0x01
+IRQ_MODEM_CONTROL   = 0x02
+IRQ_RAMDISK_COMMAND = 0x04
+IRQ_RAMDISK_OBF     = 0x08
+IRQ_RAMDISK_IBF     = 0x10
+IRQ_BAUDRATE        = 0x20
+IRQ_MISC_CONTROL    = 0x40
+
+# Pin numbers relative to GP2 (the out_base of the state machine)
+PIN_DIR = 9
+PIN_STB = 10
+PIN_ADDR = 11
+PIN_IBF = 4                                                 # jmp pin GP6
+
+MAX_POLL_CYCLES = 1_000_000
+
+
+class CPLD:
+    def __init__(self):
+        self.px8 = None
+        self.cycles = 0
+        self.irq = 0
+        self.tone_dialer = 0
+        self.modem_control = 0
+        self.modem_status = 0
+        self.baudrate = 0
+        self.misc_control = 0
+        self.ramdisk_data = 0
+        self.ramdisk_command = 0
+        self.serial_control = 0x01
+        self.overruns = 0                                   # data writes while the PX-8 had not read the last byte
+        self.log = []                                       # (side, 'r'/'w', register/port, value)
+        self.logging = False
+
+    def clock(self):
+        self.cycles += 1
+        if self.px8:
+            self.px8.clock(self)
+
+    def record(self, *entry):
+        if self.logging:
+            self.log.append(entry)
+
+    # Pico side
+
+    def pico_read(self, address):
+        if address == REG_TONE_DIALER:
+            value = self.tone_dialer
+            self.irq &= ~IRQ_TONE_DIALER
+        elif address == REG_MODEM_CONTROL:
+            value = self.modem_control
+            self.irq &= ~IRQ_MODEM_CONTROL
+        elif address == REG_BAUDRATE:
+            value = self.baudrate
+            self.irq &= ~IRQ_BAUDRATE
+        elif address == REG_MISC_CONTROL:
+            value = self.misc_control
+            self.irq &= ~IRQ_MISC_CONTROL
+        elif address == REG_RAMDISK_DATA:
+            value = self.ramdisk_data
+            self.irq &= ~IRQ_RAMDISK_OBF
+        elif address == REG_RAMDISK_CONTROL:
+            value = self.ramdisk_command
+            self.irq &= ~(IRQ_RAMDISK_COMMAND | IRQ_RAMDISK_IBF)
+        elif address == REG_IRQ:
+            value = self.irq
+        else:
+            value = 0
+        self.record('pico', 'r', address, value)
+        return value
+
+    def pico_write(self, address, value):
+        self.record('pico', 'w', address, value)
+        if address == REG_MODEM_STATUS:
+            self.modem_status = value
+        elif address == REG_RAMDISK_DATA:
+            if self.irq & IRQ_RAMDISK_IBF:
+                self.overruns += 1
+            self.ramdisk_data = value
+            self.irq |= IRQ_RAMDISK_IBF
+        elif address == REG_SERIAL_CONTROL:
+            self.serial_control = value
+
+    # PX-8 side
+
+    def px8_in(self, port):
+        if port == PX8_MODEM_STATUS:
+            value = self.modem_status
+        elif port == PX8_RAMDISK_DATA:
+            value = self.ramdisk_data
+            self.irq &= ~IRQ_RAMDISK_IBF
+        elif port == PX8_RAMDISK_CONTROL:
+            value = (1 if self.irq & IRQ_RAMDISK_IBF else 0) | (2 if self.irq & IRQ_RAMDISK_OBF else 0)
+        else:
+            value = 0xff
+        self.record('px8', 'r', port, value)
+        return value
+
+    def px8_out(self, port, value):
+        self.record('px8', 'w', port, value)
+        if port == PX8_TONE_DIALER:
+            self.tone_dialer = value
+            self.irq |= IRQ_TONE_DIALER
+        elif port == PX8_MODEM_CONTROL:
+            self.modem_control = value
+            self.irq |= IRQ_MODEM_CONTROL
+        elif port == PX8_BAUDRATE:
+            self.baudrate = value
+            self.irq |= IRQ_BAUDRATE
+        elif port == PX8_CTLR2:
+            self.set_misc_control((self.misc_control & ~0x01) | ((value >> 5) & 0x01))
+        elif port == PX8_RAMDISK_DATA:
+            self.ramdisk_data = value
+            self.irq |= IRQ_RAMDISK_OBF
+        elif port == PX8_RAMDISK_CONTROL:
+            self.ramdisk_command = value
+            self.irq |= IRQ_RAMDISK_COMMAND
+
+    def set_misc_control(self, value):
+        if value != self.misc_control:
+            self.misc_control = value
+            self.irq |= IRQ_MISC_CONTROL
+
+
+class CPLDInterface:
+    """Decodes the command words of the cpld_interface PIO program.
+
+    The first word after a restart is the IBF poll command that the
+    program keeps in Y.  Every other word is one bus cycle, preceded by
+    IBF polling if its wait flag (bit 0) is set.
+    """
+
+    def __init__(self, cpld):
+        self.cpld = cpld
+        self.rx = deque()
+        self.poll_word = None
+        self.words = 0
+        self.poll_cycles = 0
+
+    def restart(self, sm):
+        self.rx.clear()
+        self.poll_word = None
+
+    def put(self, word):
+        if self.poll_word is None:
+            self.poll_word = word
+            return
+        self.words += 1
+        if word & 1:
+            self.wait_ibf()
+        self.cycle(word >> 1)
+
+    def get(self):
+        if not self.rx:
+            raise RuntimeError('PIO RX FIFO empty, get() would block forever')
+        return self.rx.popleft()
+
+    def rx_fifo(self):
+        return len(self.rx)
+
+    def wait_ibf(self):
+        for _ in range(MAX_POLL_CYCLES):
+            self.poll_cycles += 1
+            if not (self.cycle(self.poll_word, push=False) >> PIN_IBF) & 1:
+                self.cpld.clock()                           # STB dropped for one cycle
+                return
+        raise RuntimeError('IBF handshake timed out, PX-8 does not read data')
+
+    def cycle(self, word, push=True):
+        pins = word & 0xffff
+        pindirs = (word >> 16) & 0x3fff
+        read = (word >> 30) & 1
+        self.cpld.clock()
+        if not (pins >> PIN_STB) & 1 or not (pindirs >> PIN_STB) & 1:
+            return 0
+        address = (pins >> PIN_ADDR) & 0x07
+        if (pins >> PIN_DIR) & 1:
+            if pindirs & 0xff != 0xff:
+                raise RuntimeError(f'write cycle to register {address} without driving the data lines')
+            self.cpld.pico_write(address, pins & 0xff)
+            return pins & 0xff
+        if pindirs & 0xff:
+            raise RuntimeError(f'read cycle from register {address} while driving the data lines')
+        value = self.cpld.pico_read(address)
+        if read and push:
+            self.rx.append(value)
+        return value
@@ -0,0 +1,263 @@
+"""Run the whole firmware, picox8.main_loop(), against a simulated PX-8.
+
+Simulation wires up the stand-ins: the CPLD register file (px8bus,
+with the time every IRQ bit was pending recorded), the UART whose
+other end the PX-8 uses, an SD card (the sdspi model on SPI(0), with
+the files of the card in a host directory) and the WiFi stack
+(network.WLAN on localhost, with a name server that resolves every
+name to 127.0.0.1).  Each simulation gets a fresh root directory that
+holds config.json and the card.
+
+The PX-8 side is a script, a generator function that gets the PX8
+object and yields conditions, functions of the CPLD model that must be
+true before it continues.  It runs in the bus cycles of the firmware's
+register accesses, like the real PX-8 runs while the Pico polls, and
+main_loop() is left when the script ends:
+
+    def script(px8):
+        yield from px8.enable_modem()
+        yield from px8.dial('1')
+        yield from px8.wait_carrier()
+
+    Simulation(phonebook={'1': ['bench.sim', port]}).run(script)
+"""
+
+import json
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+import hostenv
+import machine
+import network
+import px8bus
+import rp2
+import sdspi
+
+SD_CS_PIN = 17
+
+# RAM-Disk commands, as in firmware/ramdisk.py
+RAMDISK_RESET = 0
+RAMDISK_READ = 1
+RAMDISK_WRITE = 3
+RAMDISK_CKSUM = 5
+SECTOR_SIZE = 128
+
+STATUS_CD = 0x04             # modem status bit, low while the carrier is detected
+OHC = 0x01                   # modem control bit, off hook
+
+# baud rate register values, as in REG_TO_BAUD in firmware/picox8.py
+BAUDRATE_CODES = {110: 0, 300: 32, 600: 48, 1200: 64, 2400: 80, 4800: 96, 9600: 112, 19200: 160}
+
+# tone dialer keys (row << 2 | column), as in Modem.DTMF_FREQ_MAP
+DTMF_KEYS = {'1': 0, '2': 1, '3': 2, '4': 4, '5': 5, '6': 6, '7': 8, '8': 9, '9': 10, '*': 12, '0': 13}
+DTMF_PRESS = 0x10
+DTMF_HOLD = 0.05             # s a key is held down
+
+IRQ_NAMES = {
+    px8bus.IRQ_TONE_DIALER: 'tone dialer',
+    px8bus.IRQ_MODEM_CONTROL: 'modem control',
+    px8bus.IRQ_RAMDISK_COMMAND: 'RAM-Disk command',
+    px8bus.IRQ_RAMDISK_OBF: 'RAM-Disk data',
+    px8bus.IRQ_BAUDRATE: 'baud rate',
+    px8bus.IRQ_MISC_CONTROL: 'misc control',
+}
+
+
+class Done(Exception):
+    """Raised when the PX-8 script has ended, to leave main_loop()."""
+
+
+class TimedCPLD(px8bus.CPLD):
+    """Records for each IRQ that the firmware services how long it was
+    pending, from the PX-8's access to the Pico's read of the register."""
+
+    def __init__(self):
+        super().__init__()
+        self.raised = {}
+        self.latencies = {bit: [] for bit in IRQ_NAMES}
+        self.tracked = 0
+
+    def track(self):
+        changed = (self.irq ^ self.tracked) & sum(IRQ_NAMES)
+        if changed:
+            now = time.perf_counter()
+            for bit in IRQ_NAMES:
+                if changed & bit:
+                    if self.irq & bit:
+                        self.raised[bit] = now
+                    elif bit in self.raised:
+                        self.latencies[bit].append(now - self.raised.pop(bit))
+        self.tracked = self.irq
+
+    def pico_read(self, address):
+        value = super().pico_read(address)
+        self.track()
+        return value
+
+    def px8_out(self, port, value):
+        super().px8_out(port, value)
+        self.track()
+
+    def set_misc_control(self, value):
+        super().set_misc_control(value)
+        self.track()
+
+
+class NameServer(threading.Thread):
+    """Answers every A query with 127.0.0.1."""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.port = self.socket.getsockname()[1]
+        self.queries = 0
+        self.start()
+
+    def run(self):
+        while True:
+            query, client = self.socket.recvfrom(512)
+            self.queries += 1
+            question_end = query.index(0, 12) + 5
+            header = query[:2] + struct.pack('!HHHHH', 0x8180, 1, 1, 0, 0)
+            answer = struct.pack('!HHHIH', 0xc00c, 1, 1, 300, 4) + socket.inet_aton('127.0.0.1')
+            self.socket.sendto(header + query[12:question_end] + answer, client)
+
+
+class PX8:
+    def __init__(self, simulation, script):
+        self.simulation = simulation
+        self.bus = simulation.cpld
+        self.uart = simulation.uart
+        self.received = bytearray()                         # serial data from the Pico
+        self.script = script(self)
+        self.condition = None
+
+    def clock(self, bus):
+        self.received += self.uart.take()
+        while self.condition is None or self.condition(bus):
+            try:
+                self.condition = next(self.script)
+            except StopIteration:
+                raise Done from None
+
+    # waiting
+
+    def sleep(self, seconds):
+        end = time.perf_counter() + seconds
+        yield lambda bus: time.perf_counter() >= end
+
+    def serviced(self, irq):
+        yield lambda bus: not bus.irq & irq
+
+    def out(self, port, value, irq):
+        self.bus.px8_out(port, value)
+        yield from self.serviced(irq)
+
+    # RAM-Disk
+
+    def ramdisk_command(self, command, args=b'', reply=0):
+        """Send a command and its arguments, return the status byte and
+        reply bytes that follow it."""
+        yield from self.out(px8bus.PX8_RAMDISK_CONTROL, command, px8bus.IRQ_RAMDISK_COMMAND)
+        for byte in args:
+            yield from self.out(px8bus.PX8_RAMDISK_DATA, byte, px8bus.IRQ_RAMDISK_OBF)
+        data = bytearray()
+        for _ in range(1 + reply):
+            yield lambda bus: bus.irq & px8bus.IRQ_RAMDISK_IBF
+            data.append(self.bus.px8_in(px8bus.PX8_RAMDISK_DATA))
+        return data
+
+    def read_sector(self, track, sector):
+        data = yield from self.ramdisk_command(RAMDISK_READ, (track, sector), SECTOR_SIZE)
+        if data[0]:
+            raise RuntimeError(f'RAM-Disk READ {track}/{sector} failed with status {data[0]}')
+        return bytes(data[1:])
+
+    def write_sector(self, track, sector, data):
+        status = yield from self.ramdisk_command(RAMDISK_WRITE, bytes((track, sector)) + bytes(data))
+        if status[0]:
+            raise RuntimeError(f'RAM-Disk WRITE {track}/{sector} failed with status {status[0]}')
+
+    # modem
+
+    def enable_modem(self):
+        self.bus.misc_control = 0x20
+        self.bus.set_misc_control(0x00)
+        yield from self.serviced(px8bus.IRQ_MISC_CONTROL)
+
+    def set_baudrate(self, baudrate):
+        yield from self.out(px8bus.PX8_BAUDRATE, BAUDRATE_CODES[baudrate], px8bus.IRQ_BAUDRATE)
+
+    def dial(self, number):
+        yield from self.out(px8bus.PX8_MODEM_CONTROL, OHC, px8bus.IRQ_MODEM_CONTROL)
+        for digit in number:
+            key = DTMF_KEYS[digit]
+            yield from self.out(px8bus.PX8_TONE_DIALER, DTMF_PRESS | key, px8bus.IRQ_TONE_DIALER)
+            yield from self.sleep(DTMF_HOLD)
+            yield from self.out(px8bus.PX8_TONE_DIALER, key, px8bus.IRQ_TONE_DIALER)
+            yield from self.sleep(DTMF_HOLD)
+
+    def wait_carrier(self, timeout=30):
+        end = time.perf_counter() + timeout
+        yield lambda bus: not bus.modem_status & STATUS_CD or time.perf_counter() >= end
+        if self.bus.modem_status & STATUS_CD:
+            raise RuntimeError('no carrier')
+
+    def hang_up(self):
+        yield from self.out(px8bus.PX8_MODEM_CONTROL, 0, px8bus.IRQ_MODEM_CONTROL)
+
+    def send(self, data):
+        self.uart.feed(data)
+
+
+class Simulation:
+    def __init__(self, root=None, phonebook=None, config=None, card_blocks=2048):
+        self.root = root or tempfile.mkdtemp(prefix='picox8-sim-')
+        self.card_dir = os.path.join(self.root, 'sd')
+        os.makedirs(self.card_dir, exist_ok=True)
+
+        machine.UART.line_timing = True
+        self.cpld = TimedCPLD()
+        rp2.attach('cpld_interface', px8bus.CPLDInterface(self.cpld))
+        self.card = sdspi.SDCardModel(blocks=card_blocks)
+        machine.attach_spi(0, sdspi.FakeSPI(self.card))
+        machine.Pin.listen(SD_CS_PIN, lambda level: self.card.select(not level))
+        self.name_server = NameServer()
+        network.DNS_SERVER = '127.0.0.1'
+
+        settings = {'wifi': ['picox8-sim', 'secret'], 'phonebook': phonebook or {}}
+        settings.update(config or {})
+        with open(os.path.join(self.root, 'config.json'), 'w') as f:
+            json.dump(settings, f)
+        os.chdir(self.root)
+
+        storage, dialer, self.log = hostenv.load('storage', 'dialer', 'log')
+        storage.SDCARD_DIR = self.card_dir
+        dialer.DNS_PORT = self.name_server.port
+        self.log.console_level = self.log.ERROR
+        (self.picox8,) = hostenv.load('picox8')
+        self.uart = machine.UART.ports[0]
+        server = self.picox8.telnet_server
+        server.port = 0                                     # any free port
+        server.console_port = 0
+
+    def run(self, script):
+        """Run main_loop() until script has ended, return the PX8."""
+        px8 = PX8(self, script)
+        self.cpld.px8 = px8
+        try:
+            self.picox8.main_loop()
+        except Done:
+            pass
+        finally:
+            self.cpld.px8 = None
+        return px8
+
+    def irq_latencies(self):
+        """(name, latencies in seconds) of the IRQs that occurred."""
+        return [(IRQ_NAMES[bit], latencies) for bit, latencies in self.cpld.latencies.items() if latencies]
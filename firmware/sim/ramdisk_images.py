@@ -0,0 +1,235 @@
+"""Check RAM-Disk image switching, snapshots and sparse images.
+
+The whole firmware runs against the simulated PX-8 (px8sim).  Between
+PX-8 sessions the console commands are stood in for by calls to the
+RamDisk, and a model of every image, the bytes the PX-8 should read
+back, is compared with READ and with the sum that CKSUM checks:
+
+- the pool of open images: more images than MAX_OPEN_IMAGES are
+  switched between, each keeps its own contents and checksum
+- a reseated card: a listing remounts it, RESET must reopen the image
+- CKSUM: the sum is built while the loop is idle and kept as the
+  reference with the flushed writes; an image edited behind the
+  firmware's back does not reply 0
+- snapshots: rollback and commit, a snapshot of the same name on a
+  second image, and a stale overlay file left on the card
+- sparse images: blocks are stored only once written, a block shared by
+  two (built with tools/px8dsk.py) is copied before it is written
+"""
+
+import os
+import sys
+
+import px8sim
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tools'))
+import px8dsk                # noqa: E402
+
+IMAGE_SIZE = 120 * 1024
+POOL_IMAGES = 6
+
+
+def sector_offset(track, sector):
+    return track * 8192 + sector * px8sim.SECTOR_SIZE
+
+
+def pattern(seed):
+    return bytes((seed * 7 + i) & 0xff for i in range(px8sim.SECTOR_SIZE))
+
+
+class Checker:
+    def __init__(self):
+        self.simulation = px8sim.Simulation()
+        self.storage = sys.modules['storage']
+        self.ramdisk = self.simulation.picox8.ramdisk
+        self.models = {}                                    # image name -> expected contents
+
+    def session(self, script):
+        """Run a PX-8 script that starts with a RESET, like a cold start does."""
+        def run(px8):
+            yield from px8.ramdisk_command(px8sim.RAMDISK_RESET)
+            yield from script(px8)
+        self.simulation.run(run)
+
+    def active(self):
+        return self.models[self.ramdisk.get_file()]
+
+    def write(self, px8, track, sector, data):
+        yield from px8.write_sector(track, sector, data)
+        offset = sector_offset(track, sector)
+        self.active()[offset:offset + len(data)] = data
+
+    def verify(self, px8, sectors):
+        model = self.active()
+        for track, sector in sectors:
+            data = yield from px8.read_sector(track, sector)
+            offset = sector_offset(track, sector)
+            assert data == model[offset:offset + px8sim.SECTOR_SIZE], \
+                f'{self.ramdisk.get_file()} {track}/{sector} differs'
+        (cksum,) = yield from px8.ramdisk_command(px8sim.RAMDISK_CKSUM)
+        assert cksum == 0, f'{self.ramdisk.get_file()} CKSUM {cksum}'
+        assert self.ramdisk.checksum.total == sum(model) & 0xff, f'{self.ramdisk.get_file()} sum differs'
+
+    def add_image(self, name, data):
+        with open(os.path.join(self.simulation.card_dir, name), 'wb') as f:
+            f.write(data)
+        self.models[name] = bytearray(px8dsk.to_flat(data) if px8dsk.is_sparse(data) else data)
+
+    def switch(self, name):
+        self.ramdisk.set_file(name)
+        assert self.ramdisk.get_file() == name
+
+    def card_file(self, name):
+        return os.path.join(self.simulation.card_dir, name)
+
+
+def check_pool(checker):
+    names = [f'pool{n}.dsk' for n in range(POOL_IMAGES)]
+    for name in names:
+        checker.add_image(name, bytes(IMAGE_SIZE))
+    for n, name in enumerate(names):
+        checker.switch(name)
+        checker.session(lambda px8: checker.write(px8, 1, n, pattern(n)))
+        assert len(checker.ramdisk.handles) <= sys.modules['ramdisk'].MAX_OPEN_IMAGES
+    for n, name in reversed(list(enumerate(names))):
+        checker.switch(name)
+        checker.session(lambda px8: checker.verify(px8, [(1, n), (1, (n + 1) % POOL_IMAGES)]))
+    handle = checker.ramdisk.handles[checker.ramdisk.path]
+    checker.switch(names[1])
+    checker.switch(names[0])
+    assert checker.ramdisk.handles[checker.ramdisk.path] is handle, 'recently used image was reopened'
+    print(f'pool: {POOL_IMAGES} images, {len(checker.ramdisk.handles)} kept open')
+
+
+def check_reseat(checker):
+    def script(px8):
+        yield from checker.write(px8, 2, 5, pattern(25))
+        stale = checker.ramdisk.handles[checker.ramdisk.path][0]
+        checker.simulation.card.reset()                     # reseated, idle until initialized again
+        assert checker.storage.card_present()               # as "ls" checks it
+        yield from px8.ramdisk_command(px8sim.RAMDISK_RESET)
+        assert checker.ramdisk.handles[checker.ramdisk.path][0] is not stale, 'RESET kept the stale file'
+        yield from checker.verify(px8, [(2, 5)])
+    checker.session(script)
+    print('reseat: image reopened on RESET')
+
+
+def check_checksum(checker, name):
+    ramdisk = checker.ramdisk
+    checker.switch(name)
+    def script(px8):
+        yield from px8.sleep(0.5)                           # the sum is stored once it is complete
+        yield from checker.write(px8, 3, 7, pattern(30))
+    checker.session(script)
+    ramdisk.flush_pending_writes()
+    path = ramdisk.path
+    assert ramdisk.config['checksums'][path] == sum(checker.active()) & 0xff, 'reference not stored'
+
+    # as after a reboot: the images are opened again and summed while idle
+    ramdisk.close_images()
+    checker.session(lambda px8: px8.sleep(0.5))
+    assert ramdisk.checksum.complete(), 'checksum not built while idle'
+    checker.session(lambda px8: checker.verify(px8, [(3, 7)]))
+
+    # edited on a PC
+    ramdisk.close_images()
+    with open(checker.card_file(name), 'r+b') as f:
+        f.seek(sector_offset(3, 7))
+        f.write(b'\x01')
+    checker.models[name][sector_offset(3, 7)] = 1
+    def script(px8):
+        (cksum,) = yield from px8.ramdisk_command(px8sim.RAMDISK_CKSUM)
+        expected = (sum(checker.active()) - ramdisk.config['checksums'][path]) & 0xff
+        assert cksum == expected != 0, f'CKSUM {cksum} for a changed image, expected {expected}'
+    checker.session(script)
+
+    # once the PX-8 writes, the image is its own again
+    checker.session(lambda px8: checker.write(px8, 3, 8, pattern(31)))
+    ramdisk.flush_pending_writes()
+    checker.session(lambda px8: checker.verify(px8, [(3, 7), (3, 8)]))
+    print('checksum: built while idle, stored with the writes, changed image detected')
+
+
+def check_snapshots(checker, first, second):
+    ramdisk = checker.ramdisk
+    checker.switch(first)
+    checker.session(lambda px8: checker.write(px8, 0, 0, pattern(1)))
+    kept = bytes(checker.active())
+
+    # rollback
+    ramdisk.take_snapshot('a')
+    checker.session(lambda px8: checker.write(px8, 0, 0, pattern(2)))
+    assert ramdisk.snapshot_sectors() == 1
+    ramdisk.drop_snapshot(False)
+    checker.models[first][:] = kept
+    checker.session(lambda px8: checker.verify(px8, [(0, 0)]))
+    assert not os.path.exists(checker.card_file(f'{first}.a.snp')), 'overlay left after rollback'
+
+    # a snapshot of the same name on another image, while the first one's is open
+    ramdisk.take_snapshot('a')
+    checker.session(lambda px8: checker.write(px8, 0, 0, pattern(3)))
+    checker.switch(second)
+    ramdisk.take_snapshot('a')
+    checker.session(lambda px8: checker.verify(px8, [(0, 0)]))
+    assert ramdisk.snapshot_sectors() == 0, 'new snapshot picked up another image\'s overlay'
+
+    # commit on the second image, rollback on the first
+    checker.session(lambda px8: checker.write(px8, 0, 1, pattern(4)))
+    ramdisk.drop_snapshot(True)
+    checker.session(lambda px8: checker.verify(px8, [(0, 0), (0, 1)]))
+    checker.switch(first)
+    checker.session(lambda px8: checker.verify(px8, [(0, 0)]))
+    ramdisk.drop_snapshot(False)
+    checker.models[first][:] = kept
+    checker.session(lambda px8: checker.verify(px8, [(0, 0)]))
+
+    # an overlay file left on the card by a crash is not reused
+    with open(checker.card_file(f'{first}.b.snp'), 'wb') as f:
+        f.write(bytes(2) + pattern(5))
+    ramdisk.take_snapshot('b')
+    assert ramdisk.snapshot_sectors() == 0, 'stale overlay file reused'
+    checker.session(lambda px8: checker.verify(px8, [(0, 0)]))
+    ramdisk.drop_snapshot(False)
+    assert not [name for name in os.listdir(checker.simulation.card_dir) if name.endswith('.snp')]
+    print('snapshots: rollback, commit, same name on two images, stale overlay file')
+
+
+def check_sparse(checker):
+    flat = bytearray(IMAGE_SIZE)
+    flat[0:1024] = pattern(6) * 8                           # blocks 0 and 5 share a slot
+    flat[5 * 1024:6 * 1024] = pattern(6) * 8
+    flat[10 * 1024:11 * 1024] = bytes([0xe5]) * 1024
+    checker.add_image('shared.spd', px8dsk.to_sparse(flat))
+    size = os.path.getsize(checker.card_file('shared.spd'))
+    assert size == px8dsk.SPARSE_DATA + 1024, size
+    checker.switch('shared.spd')
+    checker.session(lambda px8: checker.verify(px8, [(0, 0), (0, 40), (1, 16)]))
+    assert checker.storage.file_size('shared.spd') == size  # in the directory index now
+    checker.session(lambda px8: checker.write(px8, 0, 40, pattern(7)))   # block 5
+    checker.ramdisk.flush_pending_writes()
+    size = os.path.getsize(checker.card_file('shared.spd'))
+    assert size == px8dsk.SPARSE_DATA + 2 * 1024, f'{size} bytes after writing a shared block'
+    assert checker.storage.file_size('shared.spd') == size, 'listing shows the size before the write'
+    checker.ramdisk.close_images()                          # closed, as for a new card
+    checker.session(lambda px8: checker.verify(px8, [(0, 0), (0, 40), (0, 41), (1, 16)]))
+    with open(checker.card_file('shared.spd'), 'rb') as f:
+        assert px8dsk.to_flat(f.read()) == checker.models['shared.spd'], 'sparse file differs from the image'
+    print(f'sparse: {size} bytes for 120 KB with 2 blocks stored')
+
+
+def main():
+    checker = Checker()
+    checker.models[checker.ramdisk.get_file()] = bytearray(IMAGE_SIZE)
+    default = checker.ramdisk.get_file()
+    check_pool(checker)
+    checker.switch(default)
+    check_reseat(checker)
+    check_checksum(checker, 'pool2.dsk')
+    checker.switch(default)
+    check_snapshots(checker, default, 'pool0.dsk')
+    check_sparse(checker)
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Count the SD-Card block writes that RAM-Disk sector writes cause.
+
+Without a cache every 128 byte PX-8 sector written is a write to the
+image file, which the FAT driver turns into a read-modify-write of the
+512 byte SD block holding it.  BlockCache collects the sectors of a
+block and writes it once.  The same write patterns are run both ways
+against an in-memory image file, the resulting images compared and the
+512 byte writes that reach the file counted.
+"""
+
+import io
+import random
+
+import hostenv
+
+(ramdisk,) = hostenv.load('ramdisk')
+
+SECTORS = ramdisk.IMAGE_KB * 1024 // ramdisk.SECTOR_SIZE
+WRITES = 512
+
+
+class CountingFile(io.BytesIO):
+    """Image file that counts the SD blocks its writes touch."""
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.block_writes = 0
+
+    def write(self, data):
+        first = self.tell() // ramdisk.BLOCK_SIZE
+        last = (self.tell() + len(data) - 1) // ramdisk.BLOCK_SIZE
+        self.block_writes += last - first + 1
+        return super().write(data)
+
+
+def run(pattern):
+    image = bytes(ramdisk.IMAGE_KB * 1024)
+    direct = CountingFile(image)
+    cached = CountingFile(image)
+    cache = ramdisk.BlockCache(cached)
+    for sector in pattern:
+        data = bytes([sector & 0xff]) * ramdisk.SECTOR_SIZE
+        direct.seek(sector * ramdisk.SECTOR_SIZE)
+        direct.write(data)
+        cache.write(sector * ramdisk.SECTOR_SIZE, data)
+    cache.flush()
+    assert direct.getvalue() == cached.getvalue(), 'cached image differs'
+    return direct.block_writes, cached.block_writes
+
+
+if __name__ == '__main__':
+    random.seed(1)
+    for name, pattern in (('sequential', list(range(WRITES))),
+                          ('random', [random.randrange(SECTORS) for _ in range(WRITES)])):
+        direct, cached = run(pattern)
+        print(f'{name:<10} {len(pattern)} sector writes: {direct} block writes direct, '
+              f'{cached} with BlockCache ({direct / cached:.1f}x fewer)')
@@ -0,0 +1,96 @@
+"""Host stand-in for the MicroPython rp2 module.
+
+PIO programs are not executed.  A state machine forwards the words it
+is given to the device model attached for its program name (see
+attach()), or just records them if there is none.
+"""
+
+devices = {}
+
+
+def attach(program_name, device):
+    devices[program_name] = device
+
+
+class PIO:
+    IN_LOW = 0
+    IN_HIGH = 1
+    OUT_LOW = 2
+    OUT_HIGH = 3
+    SHIFT_LEFT = 0
+    SHIFT_RIGHT = 1
+    IRQ_SM0 = 0x100
+
+
+def asm_pio(**kwargs):
+    def assemble(program):
+        program.pio_options = kwargs
+        return program
+    return assemble
+
+
+class StateMachine:
+    def __init__(self, id, program=None, freq=None, **kwargs):
+        self.id = id
+        self.program = program
+        self.freq = freq
+        self.options = kwargs
+        self.running = False
+        self.words = []
+        self.device = devices.get(program.__name__) if program else None
+        if self.device:
+            self.device.restart(self)
+
+    def init(self, program, freq=None, **kwargs):
+        self.__init__(self.id, program, freq, **kwargs)
+
+    def active(self, value=None):
+        if value is None:
+            return self.running
+        self.running = bool(value)
+
+    def restart(self):
+        self.words = []
+        if self.device:
+            self.device.restart(self)
+
+    def put(self, value, shift=0):
+        words = [value] if isinstance(value, int) else value
+        for word in words:
+            word = (word >> shift) & 0xffffffff
+            if self.device:
+                self.device.put(word)
+            else:
+                self.words.append(word)
+
+    def get(self, buf=None, shift=0):
+        return self.device.get() >> shift
+
+    def rx_fifo(self):
+        return self.device.rx_fifo() if self.device else 0
+
+    def tx_fifo(self):
+        return 0
+
+    def exec(self, instruction):
+        pass
+
+
+class DMA:
+    """A channel that accepts its configuration but never transfers."""
+
+    channels = 0
+
+    def __init__(self):
+        self.channel = DMA.channels
+        DMA.channels += 1
+        self.settings = {}
+
+    def pack_ctrl(self, **kwargs):
+        return kwargs
+
+    def config(self, **kwargs):
+        self.settings.update(kwargs)
+
+    def active(self, value=None):
+        return False
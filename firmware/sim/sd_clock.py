@@ -0,0 +1,49 @@
+"""Check the SD card clock negotiation against cards with bit errors.
+
+Each case builds a fake card that corrupts data above its maximum
+clock and checks which clock the driver settles on, with and without
+a previously saved clock.
+"""
+
+import random
+
+import hostenv
+import sdspi
+
+(sdcard,) = hostenv.load('sdcard')
+
+BAUDRATES = (1_320_000, 4_000_000, 8_000_000, 12_500_000, 20_000_000, 25_000_000)
+
+CASES = (
+    # card limit, error rate, saved clock, expected clock
+    (None, 0.01, None, 25_000_000),
+    (10_000_000, 0.01, None, 8_000_000),
+    (10_000_000, 0.001, None, 8_000_000),
+    (1_320_000, 0.01, None, 1_320_000),
+    (20_000_000, 0.01, 20_000_000, 20_000_000),
+    (10_000_000, 0.01, 25_000_000, 8_000_000),              # saved clock too fast for a new card
+)
+
+
+def run(max_baudrate, bit_error_rate, saved, expected):
+    card = sdspi.SDCardModel(init_polls=1, max_baudrate=max_baudrate, bit_error_rate=bit_error_rate)
+    for i in range(card.blocks):
+        card.data[i * 512:(i + 1) * 512] = bytes([i & 0xff]) * 512
+    sd = sdcard.SDCard(sdspi.FakeSPI(card), sdspi.FakeCS(card))
+    card.reset_counters()
+    baudrate = sd.negotiate_clock(BAUDRATES, saved)
+    # blocks must still read back correctly at the negotiated clock
+    buf = bytearray(512)
+    for block in range(0, card.blocks, 97):
+        sd.readblocks(block, buf)
+        assert buf == card.data[block * 512:(block + 1) * 512], f'block {block} corrupted'
+    print(f'limit {max_baudrate}, error rate {bit_error_rate}, saved {saved}: '
+          f'{baudrate} Hz, {card.bit_errors} bit errors injected, {card.bytes_clocked} bytes clocked')
+    assert baudrate == expected, f'expected {expected}'
+
+
+if __name__ == '__main__':
+    random.seed(3)
+    for case in CASES:
+        run(*case)
+    print('ok')
@@ -0,0 +1,45 @@
+"""Compare SD card bus traffic with and without read-ahead.
+
+A FAT file system reads files one 512 byte block at a time.  The same
+sequential and random single-block read patterns are run against the
+fake card with read-ahead disabled and enabled, and the commands and
+bytes clocked over the SPI bus are counted.
+"""
+
+import random
+
+import hostenv
+import sdspi
+
+(sdcard,) = hostenv.load('sdcard')
+
+BLOCKS = 256
+
+
+def run(readahead, pattern):
+    card = sdspi.SDCardModel(init_polls=1)
+    for i in range(card.blocks):
+        card.data[i * 512:(i + 1) * 512] = bytes([i & 0xff]) * 512
+    sd = sdcard.SDCard(sdspi.FakeSPI(card), sdspi.FakeCS(card), readahead=readahead)
+    card.reset_counters()
+    buf = bytearray(512)
+    for block in pattern:
+        sd.readblocks(block, buf)
+        assert buf == card.data[block * 512:(block + 1) * 512], f'block {block} read wrong'
+    # writes must update blocks already in the cache
+    sd.writeblocks(pattern[-1] + 1, b'\x5a' * 512)
+    sd.readblocks(pattern[-1] + 1, buf)
+    assert buf == b'\x5a' * 512, 'stale read-ahead block'
+    commands = ', '.join(f'{name} {count}' for name, count in sorted(card.commands.items()))
+    print(f'  readahead {readahead}: {card.bytes_clocked} bytes clocked, {commands}, '
+          f'{sd.cache_hits} hits, {sd.cache_misses} misses')
+
+
+if __name__ == '__main__':
+    random.seed(1)
+    for name, pattern in (('sequential', list(range(BLOCKS))),
+                          ('random', random.sample(range(1024), BLOCKS)),
+                          ('interleaved', [b for i in range(0, BLOCKS, 2) for b in (i, 1000 - i)])):
+        print(f'{name} reads of {len(pattern)} blocks:')
+        for readahead in (0, 4, 8):
+            run(readahead, pattern)
@@ -0,0 +1,252 @@
+"""SPI mode SD card model for running firmware/sdcard.py on the host.
+
+FakeSPI stands in for machine.SPI and FakeCS for the chip select pin.
+The card answers the commands the driver uses, stores its blocks in a
+bytearray and counts every command and every byte clocked over the
+bus, so that changes to the driver can be compared by bus traffic.
+Above max_baudrate, bits of the data blocks the card sends are flipped
+at random with probability bit_error_rate, to exercise the driver's
+clock negotiation.
+"""
+
+import random
+from collections import Counter, deque
+
+BLOCK_SIZE = 512
+
+R1_IDLE = 0x01
+R1_ILLEGAL_COMMAND = 0x04
+R1_CRC_ERROR = 0x08
+
+TOKEN_DATA = 0xFE
+TOKEN_CMD25 = 0xFC
+TOKEN_STOP_TRAN = 0xFD
+
+
+def crc7(data):
+    crc = 0
+    for byte in data:
+        for bit in range(7, -1, -1):
+            crc <<= 1
+            if ((byte >> bit) & 1) ^ ((crc >> 7) & 1):
+                crc ^= 0x09
+        crc &= 0x7F
+    return crc
+
+
+def crc16(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+    return crc
+
+
+def register(payload):
+    """Complete a 15 byte CSD or CID with its CRC7 byte."""
+    return bytes(payload) + bytes([(crc7(payload) << 1) | 1])
+
+
+class SDCardModel:
+    def __init__(self, blocks=2048, data=None, init_polls=2, max_baudrate=None, bit_error_rate=0.01):
+        assert blocks % 1024 == 0, 'capacity must be a multiple of 512 KB for the CSD'
+        self.data = data if data is not None else bytearray(blocks * BLOCK_SIZE)
+        self.blocks = len(self.data) // BLOCK_SIZE
+        c_size = self.blocks // 1024 - 1
+        self.csd = register([0x40, 0x0E, 0x00, 0x32, 0x5B, 0x59, 0x00,
+                             (c_size >> 16) & 0x3F, (c_size >> 8) & 0xFF, c_size & 0xFF,
+                             0x7F, 0x80, 0x0A, 0x40, 0x00])
+        self.cid = register(b'\x03SDPX8SM\x80\x12\x34\x56\x78\x01\x6A')
+        self.init_polls = init_polls
+        self.max_baudrate = max_baudrate
+        self.bit_error_rate = bit_error_rate
+        self.baudrate = 0
+        self.bit_errors = 0
+        self.selected = False
+        self.out = deque()
+        self.reset()
+        self.reset_counters()
+
+    def reset(self):
+        self.idle = True
+        self.app_command = False
+        self.polls = 0
+        self.command = bytearray()
+        self.stream_block = None                            # next block of a CMD18 transfer
+        self.write_block = None                             # block of a CMD24/CMD25 transfer
+        self.write_multiple = False
+        self.receiving = None                               # data block being received
+        self.out.clear()
+
+    def reset_counters(self):
+        self.commands = Counter()
+        self.bytes_clocked = 0
+        self.blocks_read = 0
+        self.blocks_written = 0
+
+    def select(self, selected):
+        if self.selected and not selected and self.stream_block is None:
+            self.out.clear()
+        self.selected = selected
+
+    def corrupt(self, data):
+        if self.max_baudrate is None or self.baudrate <= self.max_baudrate:
+            return data
+        data = bytearray(data)
+        for i in range(len(data)):
+            for bit in range(8):
+                if random.random() < self.bit_error_rate:
+                    data[i] ^= 1 << bit
+                    self.bit_errors += 1
+        return data
+
+    def exchange(self, byte):
+        self.bytes_clocked += 1
+        if not self.selected:
+            return 0xFF
+        if not self.out and self.stream_block is not None:
+            self.send_block(self.read_block(self.stream_block), gap=1)
+            self.stream_block += 1
+        result = self.out.popleft() if self.out else 0xFF
+        self.receive(byte)
+        return result
+
+    def read_block(self, n):
+        self.blocks_read += 1
+        return self.data[n * BLOCK_SIZE:(n + 1) * BLOCK_SIZE]
+
+    def send_block(self, data, gap=0):
+        crc = crc16(data)
+        self.out.extend([0xFF] * gap)
+        self.out.append(TOKEN_DATA)
+        self.out.extend(self.corrupt(bytes(data) + bytes([crc >> 8, crc & 0xFF])))
+
+    def respond(self, *response):
+        self.out.clear()
+        self.out.append(0xFF)                               # N_CR
+        self.out.extend(response)
+
+    def receive(self, byte):
+        if self.receiving is not None:
+            self.receiving.append(byte)
+            if len(self.receiving) == BLOCK_SIZE + 2:
+                self.store_block()
+            return
+        if self.write_block is not None and not self.command:
+            if byte == TOKEN_DATA and not self.write_multiple or byte == TOKEN_CMD25 and self.write_multiple:
+                self.receiving = bytearray()
+                return
+            if byte == TOKEN_STOP_TRAN and self.write_multiple:
+                self.write_block = None
+                self.out.extend([0xFF, 0x00, 0xFF])          # busy, then ready
+                return
+        if not self.command and byte & 0xC0 != 0x40:
+            return
+        self.command.append(byte)
+        if len(self.command) == 6:
+            command = bytes(self.command)
+            self.command = bytearray()
+            self.execute(command)
+
+    def store_block(self):
+        data = self.receiving[:BLOCK_SIZE]
+        self.receiving = None
+        self.data[self.write_block * BLOCK_SIZE:(self.write_block + 1) * BLOCK_SIZE] = data
+        self.blocks_written += 1
+        self.out.extend([0x05, 0x00, 0x00, 0xFF])           # data accepted, busy, ready
+        if self.write_multiple:
+            self.write_block += 1
+        else:
+            self.write_block = None
+
+    def execute(self, command):
+        cmd = command[0] & 0x3F
+        arg = int.from_bytes(command[1:5], 'big')
+        app_command = self.app_command
+        self.app_command = False
+        self.commands[f'ACMD{cmd}' if app_command else f'CMD{cmd}'] += 1
+        r1 = R1_IDLE if self.idle else 0
+        if cmd == 0:
+            self.reset()
+            self.respond(R1_IDLE)
+        elif cmd == 8:
+            self.respond(r1, 0x00, 0x00, 0x01, arg & 0xFF)
+        elif cmd == 55:
+            self.app_command = True
+            self.respond(r1)
+        elif cmd == 41 and app_command:
+            self.polls += 1
+            if self.polls >= self.init_polls:
+                self.idle = False
+            self.respond(R1_IDLE if self.idle else 0)
+        elif cmd == 58:
+            self.respond(r1, 0x80 if self.idle else 0xC0, 0xFF, 0x80, 0x00)
+        elif cmd == 9 or cmd == 10:
+            self.respond(r1)
+            self.send_block(self.csd if cmd == 9 else self.cid, gap=1)
+        elif cmd == 16:
+            self.respond(r1 if arg == BLOCK_SIZE else r1 | R1_ILLEGAL_COMMAND)
+        elif cmd == 13:
+            self.respond(r1, 0x00)
+        elif cmd == 17:
+            self.respond(r1)
+            self.send_block(self.read_block(arg), gap=1)
+        elif cmd == 18:
+            self.respond(r1)
+            self.stream_block = arg
+        elif cmd == 12:
+            self.stream_block = None
+            self.respond(0xFF, r1)                          # stuff byte, see skip1 in the driver
+        elif cmd == 24 or cmd == 25:
+            self.respond(r1)
+            self.write_block = arg
+            self.write_multiple = cmd == 25
+        else:
+            self.respond(r1 | R1_ILLEGAL_COMMAND)
+
+
+class FakeCS:
+    OUT = 1
+    IN = 0
+
+    def __init__(self, card):
+        self.card = card
+        self.level = 1
+
+    def init(self, mode=None, value=None):
+        if value is not None:
+            self(value)
+
+    def __call__(self, value=None):
+        if value is None:
+            return self.level
+        self.level = value
+        self.card.select(not value)
+
+    value = __call__
+
+
+class FakeSPI:
+    def __init__(self, card):
+        self.card = card
+        self.baudrate = None
+
+    def init(self, baudrate=1000000, **kwargs):
+        self.baudrate = baudrate
+        self.card.baudrate = baudrate
+
+    def write(self, buf):
+        for byte in buf:
+            self.card.exchange(byte)
+
+    def read(self, nbytes, write=0x00):
+        return bytes(self.card.exchange(write) for _ in range(nbytes))
+
+    def readinto(self, buf, write=0x00):
+        for i in range(len(buf)):
+            buf[i] = self.card.exchange(write)
+
+    def write_readinto(self, write_buf, read_buf):
+        for i in range(len(read_buf)):
+            read_buf[i] = self.card.exchange(write_buf[i])
@@ -0,0 +1,127 @@
+"""Throughput of the telnet server under CPython.
+
+The server runs on localhost with the host UART stand-in.  One client
+owns the UART and sends data to the PX-8 side, then PX-8 output is
+sent to the owner and to two monitor clients, one of which does not
+read until the end; output that a monitor cannot take is dropped and
+counted.  A console client checks the console port.
+"""
+
+import asyncio
+import sys
+import time
+
+import hostenv
+from machine import UART
+
+(telnet,) = hostenv.load('telnet')
+
+SIZE = 1_000_000
+
+
+class UpperConsole:
+    """Stands in for the command processor: echoes lines upper-cased."""
+
+    def __init__(self, terminal):
+        self.terminal = terminal
+        self.terminal.write('console> ')
+
+    def userinput(self, data):
+        text = bytes(data).decode()
+        self.terminal.write(text.upper())
+        return 'QUIT' in text.upper()
+
+
+async def read_until(reader, count):
+    data = bytearray()
+    while len(data) < count:
+        chunk = await reader.read(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+async def pump(server):
+    # the part of the main loop that serves the telnet server
+    while True:
+        server.poll()
+        await asyncio.sleep(0)
+
+
+def port_of(server, index):
+    return server.servers[index].sockets[0].getsockname()[1]
+
+
+async def main(size):
+    uart = UART(0)
+    server = telnet.TelnetServer(uart, console=UpperConsole, port=0, console_port=0)
+    await server.start()
+    pump_task = asyncio.create_task(pump(server))
+    port = port_of(server, 0)
+
+    owner_reader, owner_writer = await asyncio.open_connection('127.0.0.1', port)
+    options = await read_until(owner_reader, 6)             # WILL SGA, WILL ECHO
+    assert options == b'\xff\xfb\x03\xff\xfb\x01', options
+
+    # client -> UART, with escaped 0xff bytes in the stream
+    payload = bytes(range(256)) * (size // 256)
+    escaped = payload.replace(b'\xff', b'\xff\xff')
+    start = time.perf_counter()
+    owner_writer.write(escaped)
+    await owner_writer.drain()
+    while len(uart.tx) < len(payload):
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    assert uart.take() == payload, 'data to the PX-8 corrupted'
+    print(f'socket -> UART: {len(payload) / elapsed / 1e6:.2f} MB/s')
+
+    # UART -> owner and monitors
+    monitors = []
+    for _ in range(2):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        banner = await read_until(reader, 6 + len('PicoX-8 serial port monitor, input is ignored\r\n'))
+        monitors.append((reader, writer))
+    start = time.perf_counter()
+    sent = 0
+    received = bytearray()
+    fast = bytearray()
+    while len(received) < len(escaped):
+        if sent < len(payload) and len(uart.rx) < 8192:
+            chunk = payload[sent:sent + 4096]
+            uart.feed(chunk)
+            sent += len(chunk)
+        try:
+            received += await asyncio.wait_for(owner_reader.read(65536), 0.001)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            fast += await asyncio.wait_for(monitors[0][0].read(65536), 0.0001)
+        except asyncio.TimeoutError:
+            pass
+    elapsed = time.perf_counter() - start
+    assert received == escaped, 'data from the PX-8 corrupted'
+    while len(fast) < len(escaped):
+        fast += await monitors[0][0].read(65536)
+    dropped = [session.dropped for session in server.sessions if session.role == telnet.MONITOR]
+    print(f'UART -> owner + 2 monitors: {len(payload) / elapsed / 1e6:.2f} MB/s, '
+          f'bytes dropped for monitors: {dropped}')
+
+    # console
+    reader, writer = await asyncio.open_connection('127.0.0.1', port_of(server, 1))
+    prompt = await read_until(reader, 6 + len('console> '))
+    writer.write(b'hello quit\r')
+    answer = await read_until(reader, len('HELLO QUIT\r'))
+    assert answer == b'HELLO QUIT\r', answer
+    assert await reader.read(100) == b'', 'console not closed after quit'
+    print('console ok')
+
+    for _, writer in monitors + [(None, owner_writer)]:
+        writer.close()
+    while server.sessions:
+        await asyncio.sleep(0.01)
+    pump_task.cancel()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else SIZE))
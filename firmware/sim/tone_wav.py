@@ -0,0 +1,115 @@
+"""Render the modem's tones to WAV files, e.g.
+
+    python firmware/sim/tone_wav.py /tmp/tones
+
+Without a directory the files go to a new temporary one.
+
+The DMA control blocks of each tone are followed like the control
+channel would, with the sample channel's read ring wrapping inside the
+wave table, so the files contain the sample stream that the pwm_dac
+state machine gets.  For every segment the frequency measured from the
+zero crossings is compared with the one asked for; DTMF receivers
+accept 1.5 %.
+"""
+
+import os
+import sys
+import tempfile
+import wave
+
+import hostenv
+
+(tones,) = hostenv.load('tones')
+
+CONTINUOUS_MS = 500          # rendered length of tones that play until stopped
+REPEATS = 2                  # rendered cycles of repeating tones
+TOLERANCE = 0.015
+
+DTMF_LOW = (697, 770, 852, 941)
+DTMF_HIGH = (1209, 1336, 1477, 1633)
+DTMF_KEYS = '123A456B789C*0#D'
+
+
+def run_blocks(tables, blocks):
+    """Yield (sample count, table) per segment, as the DMA streams them."""
+    for i in range(0, len(blocks), 2):
+        count, address = blocks[i], blocks[i + 1]
+        if address == 0:
+            return
+        assert (address - tables.address) % tones.TABLE_SIZE == 0
+        slot = (address - tables.address) // tones.TABLE_SIZE
+        if count == 0xffffffff:
+            count = CONTINUOUS_MS * tones.SAMPLE_RATE // 1000
+        yield count, tables.samples(slot)
+
+
+def render(tables, tone):
+    stream = bytearray()
+    for _ in range(REPEATS if tone.repeats else 1):
+        for count, table in run_blocks(tables, tone.blocks):
+            stream += bytes(table[i % tones.TABLE_SIZE] for i in range(count))
+    return stream
+
+
+def measure(table):
+    samples = bytes(table)
+    crossings = sum(1 for a, b in zip(samples, samples[1:] + samples[:1]) if a < 128 <= b)   # the ring wraps
+    return crossings * tones.SAMPLE_RATE / len(samples)
+
+
+def check(tables, tone):
+    """Return the worst relative frequency error of the single frequency segments."""
+    worst = 0
+    for (frequencies, duration), (count, table) in zip(tone.segments(), run_blocks(tables, tone.blocks)):
+        if duration != tones.CONTINUOUS:
+            assert count == duration * tones.SAMPLE_RATE // 1000
+        if len(frequencies) == 1 and frequencies[0] >= 100:
+            error = abs(measure(table) - frequencies[0]) / frequencies[0]
+            worst = max(worst, error)
+    return worst
+
+
+def check_dtmf(low, high):
+    # the steps that fill_table() uses give the frequencies actually played
+    return max(abs(round(f * tones.TABLE_SIZE / tones.SAMPLE_RATE) * tones.SAMPLE_RATE / tones.TABLE_SIZE - f) / f
+               for f in (low, high))
+
+
+def write_wav(path, samples):
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(1)                                   # 8 bit WAV samples are unsigned, like the tables
+        f.setframerate(tones.SAMPLE_RATE)
+        f.writeframes(bytes(samples))
+
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else tempfile.mkdtemp(prefix='picox8-tones-')
+    os.makedirs(directory, exist_ok=True)
+    tables = tones.WaveTables()                             # the firmware's TABLE_COUNT must hold all of them
+    failed = False
+    for name in dir(tones):
+        tone = getattr(tones, name)
+        if not isinstance(tone, tones.CallProgressTone):
+            continue
+        tone.compile(tables)
+        samples = render(tables, tone)
+        write_wav(os.path.join(directory, name.lower() + '.wav'), samples)
+        error = check(tables, tone)
+        print(f'{name:<26} {len(samples) * 1000 // tones.SAMPLE_RATE:6d} ms  frequency error {error:.2%}')
+    for key, digit in enumerate(DTMF_KEYS):
+        low, high = DTMF_LOW[key >> 2], DTMF_HIGH[key & 0x03]
+        tone = tones.CallProgressTone(((low, high), tones.CONTINUOUS))
+        tone.compile(tables)
+        name = 'dtmf_' + {'*': 'star', '#': 'hash'}.get(digit, digit)
+        write_wav(os.path.join(directory, name + '.wav'), render(tables, tone))
+        error = check_dtmf(low, high)
+        failed = failed or error > TOLERANCE
+        print(f'DTMF {digit} ({low} + {high} Hz){"":9} frequency error {error:.2%}')
+    print(f'{len(tables.slots)} of {tables.count} wave tables used, WAV files in {directory}')
+    print('fail' if failed else 'ok')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
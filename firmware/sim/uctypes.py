@@ -0,0 +1,6 @@
+"""Host stand-in for the MicroPython uctypes module."""
+
+
+def addressof(obj):
+    # a 32 bit address in the RP2040's SRAM range, stable for the object
+    return 0x20000000 + (id(obj) & 0x0fffffff)
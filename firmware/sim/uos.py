@@ -0,0 +1,47 @@
+"""Host stand-in for the MicroPython uos module.
+
+Paths are host paths; a simulation points storage.SDCARD_DIR at a host
+directory, which then holds the files of the card.  VfsFat keeps the
+block device (an sdcard.SDCard talking to an sdspi card model) but does
+not read the file system from it, mount() only records the mount.
+"""
+
+import errno
+import os
+from os import listdir, mkdir, remove, rename, stat
+
+mounts = {}
+
+
+def ilistdir(path='.'):
+    with os.scandir(path) as entries:
+        for entry in entries:
+            yield (entry.name, 0x4000 if entry.is_dir() else 0x8000, 0, entry.stat().st_size)
+
+
+def statvfs(path):
+    st = os.statvfs(path)
+    return (st.f_bsize, st.f_frsize, st.f_blocks, st.f_bfree, st.f_bavail, st.f_files, st.f_ffree,
+            st.f_favail, st.f_flag, st.f_namemax)
+
+
+def sync():
+    pass
+
+
+class VfsFat:
+    def __init__(self, device):
+        self.device = device
+
+
+def mount(vfs, path):
+    if path in mounts:
+        raise OSError(errno.EPERM, 'already mounted')
+    os.makedirs(path, exist_ok=True)
+    mounts[path] = vfs
+
+
+def umount(path):
+    if path not in mounts:
+        raise OSError(errno.EINVAL, 'not mounted')
+    del mounts[path]
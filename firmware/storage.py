@@ -3,9 +3,27 @@ import uos
 import sdcard
 import time
 import errno
+import config
+import log
 
 SDCARD_DIR = '/sd'
 
+# SPI clocks tried after the card is initialized.  The highest one that
+# reads the CSD and CID back without CRC errors is used and saved in
+# the configuration, so that later mounts only need to verify it.
+SDCARD_BAUDRATES = (1_320_000, 4_000_000, 8_000_000, 12_500_000, 20_000_000, 25_000_000)
+saved_baudrate = config.setting('sdcard_baudrate', int, None, SDCARD_BAUDRATES)
+
+card = None
+mounted = False
+generation = 0               # counts mounts, files opened before the last one are stale
+
+# Directory index of the card: name -> size, read with one ilistdir()
+# (FAT returns the sizes with the names), so that listings don't stat
+# every file.  It is dropped when the card is mounted or unmounted and
+# when a file is written or removed through this module.
+index = None
+
 def ensure_mountpoint(dir):
   try:
     uos.mkdir(dir)
@@ -18,9 +36,27 @@ def path(filename):
   return f'{SDCARD_DIR}/{filename}'
 
 
+def invalidate():
+  global index
+  index = None
+
+
+def get_index():
+  global index
+  if index is None:
+    entries = {}
+    for entry in uos.ilistdir(SDCARD_DIR):
+      name = entry[0]
+      entries[name] = entry[3] if len(entry) > 3 else uos.stat(path(name))[6]
+    index = entries
+  return index
+
+
 def exists(filename):
+  if filename in get_index():
+    return True
   try:
-    uos.stat(path(filename))
+    uos.stat(path(filename))                                # names on FAT are not case sensitive
   except OSError as e:
     if e.errno == errno.ENOENT:
       return False
@@ -30,11 +66,20 @@ def exists(filename):
 
 
 def listdir():
-  return uos.listdir(SDCARD_DIR)
+  return list(get_index())
 
 
 def file_size(filename):
-  return uos.stat(path(filename))[6]
+  size = get_index().get(filename)
+  if size is None:
+    return uos.stat(path(filename))[6]
+  return size
+
+
+def open_file(filename, mode='rb'):
+  if 'r' not in mode or '+' in mode:
+    invalidate()                                            # may create the file or change its size
+  return open(path(filename), mode)
 
 
 def slurp(filename):
@@ -43,36 +88,94 @@ def slurp(filename):
 
 
 def spit(filename, data):
-  with open(path(filename), 'w') as f:
+  with open_file(filename, 'w') as f:
     return f.write(data)
 
 
 def remove(filename):
+  invalidate()
   uos.remove(path(filename))
 
 
 def mount_sdcard():
-  global SDCARD_DIR
+  global SDCARD_DIR, card, mounted
   if sdcard_mounted():
     print(f'SDCard already mounted on {SDCARD_DIR}')
     return True
   try:
     ensure_mountpoint(SDCARD_DIR)
     sd = sdcard.SDCard(SPI(0), Pin(17))
+    saved = saved_baudrate.value
+    baudrate = sd.negotiate_clock(SDCARD_BAUDRATES, saved)
+    if baudrate != saved:
+      log.info('SD card clock set to %d Hz', baudrate)
+      saved_baudrate.set(baudrate)
     vfs = uos.VfsFat(sd)
+    try:
+      uos.umount(SDCARD_DIR)                                # left over from a card that was removed
+    except OSError:
+      pass
     uos.mount(vfs, SDCARD_DIR)
+    if card and sd.cid != card.cid:
+      log.info('SD card changed')
+    card = sd
+    mounted = True
+    mounted_now()
   except OSError as e:
     print(f'Error mounting SD card: {e}')
     return False
   return True
 
 
+def mounted_now():
+  global generation
+  generation += 1
+  invalidate()
+
+
 def umount_sdcard():
+  global mounted
   if sdcard_mounted():
     global SDCARD_DIR
     uos.umount(SDCARD_DIR)
+    mounted = False
+    invalidate()
+
+
+def card_present():
+  """Check with a CMD13 that the mounted card is still there.  A card
+  that does not answer is initialized again; if its CID is that of the
+  mounted card, it was only reseated and its file system is mounted
+  again without negotiating the clock.  Otherwise the card is unmounted.
+  Either way generation changes, so open files must be reopened."""
+  global mounted
+  if not sdcard_mounted():
+    return False
+  try:
+    if card.present():
+      return True
+    if card.reinit():
+      log.warning('SD card reseated')
+      uos.umount(SDCARD_DIR)
+      uos.mount(uos.VfsFat(card), SDCARD_DIR)
+      mounted_now()
+      return True
+  except OSError:
+    pass
+  log.warning('SD card removed')
+  try:
+    umount_sdcard()
+  except OSError:
+    mounted = False
+    invalidate()
+  return False
+
+
+def sdcard_baudrate():
+  return card.baudrate if card and sdcard_mounted() else None
 
 
 def sdcard_mounted():
-  global SDCARD_DIR
-  return uos.statvfs(SDCARD_DIR) != uos.statvfs('/')
+  # the flag instead of comparing statvfs() of the card with that of
+  # the root, which counts the free clusters of the card
+  return mounted and card is not None
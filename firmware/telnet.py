@@ -1,8 +1,18 @@
-import usocket as socket
+try:
+  import asyncio
+except ImportError:
+  import uasyncio as asyncio
 from enum import Enum
+import log
 
 LISTEN_PORT = 23
-MAX_CONNECTIONS = 1
+CONSOLE_PORT = 2323
+MAX_CONNECTIONS = 4          # sessions on both ports together
+RECV_SIZE = 1024
+QUEUE_LIMIT = 4096           # bytes queued for sending per session
+UART_READ_SIZE = 256
+UART_CHUNK = 32              # size of the UART TX FIFO
+UART_WAIT = 0.002            # seconds between checks for the UART to finish sending
 
 # telnet option negotiation
 
@@ -13,6 +23,8 @@ class Commands(Enum):
   DO   = 253
   WONT = 252
   WILL = 251
+  SB   = 250  # Subnegotiation begin
+  SE   = 240  # Subnegotiation end
 
 # Telnet options
 class Options(Enum):
@@ -57,78 +69,276 @@ class Options(Enum):
   ENCRYPT = 38
   NEW_ENVIRON = 39
 
+# Session roles
+UART_OWNER = 'uart'          # first connection on LISTEN_PORT, talks to the PX-8
+MONITOR = 'monitor'          # further connections on LISTEN_PORT, see the PX-8 output only
+CONSOLE = 'console'          # connections on CONSOLE_PORT, each with its own command processor
+
+
+class Session:
+  """One telnet connection.  Output is queued and sent by a separate
+  task, so writers never wait for the network.  queued counts the bytes
+  that the socket has not accepted yet; the server stops reading the
+  UART when the UART owner's queue is full and drops output for
+  monitors that cannot keep up."""
+  def __init__(self, server, reader, writer, role):
+    self.server = server
+    self.reader = reader
+    self.writer = writer
+    self.role = role
+    self.queue = []
+    self.queued = 0
+    self.dropped = 0
+    self.ready = asyncio.Event()
+    self.closed = False
+    self.parser = TelnetParser(RECV_SIZE)
+    self.parser.reset(self)
+    self.console = None
+    self.peer = writer.get_extra_info('peername')[0]
+
+  def room(self):
+    return QUEUE_LIMIT - self.queued
+
+  def sendall(self, data):
+    self.queue.append(bytes(data))
+    self.queued += len(data)
+    self.ready.set()
+
+  def write(self, s):
+    # terminal interface for the command processor
+    self.sendall(s.encode() if isinstance(s, str) else s)
+
+  async def send_queued(self):
+    try:
+      while True:
+        await self.ready.wait()
+        self.ready.clear()
+        while self.queue:
+          data = b''.join(self.queue)
+          self.queue = []
+          self.writer.write(data)
+          await self.writer.drain()
+          self.queued -= len(data)
+        if self.closed:
+          return
+    except OSError as e:
+      log.info('telnet %s: error %s sending', self.peer, e)
+      self.closed = True
+
+  async def run(self):
+    sender = asyncio.create_task(self.send_queued())
+    try:
+      while not self.closed:
+        data = await self.reader.read(RECV_SIZE)
+        if not data:
+          break
+        payload = self.parser.feed(data)
+        if payload:
+          await self.server.received(self, payload)
+    except OSError as e:
+      log.info('telnet %s: error %s receiving', self.peer, e)
+    self.closed = True
+    self.ready.set()
+    await sender
+    self.server.remove(self)
+    try:
+      self.writer.close()
+      await self.writer.wait_closed()
+    except OSError:
+      pass
+    log.info('telnet %s: %s connection closed', self.peer, self.role)
+
+
 class TelnetServer:
-  def __init__(self, uart):
-    self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    self.server_socket.bind(('0.0.0.0', LISTEN_PORT))
-    self.server_socket.listen(MAX_CONNECTIONS)
-    self.server_socket.setblocking(False)
-    self.client_socket = None
+  """Telnet access to the PX-8 serial port and to the configuration
+  console, run as asyncio tasks.
+
+  The first client on LISTEN_PORT owns the UART, further clients are
+  monitors.  Clients on CONSOLE_PORT each get a console created by
+  console(terminal), e.g. a CommandProcessor.  UART output is moved to
+  the sessions by poll(), called from the main loop, while uart_free()
+  says that the modem is not using the UART."""
+  def __init__(self, uart, console=None, uart_free=None, port=LISTEN_PORT, console_port=CONSOLE_PORT):
     self.uart = uart
+    self.console = console
+    self.uart_free = uart_free or (lambda: True)
+    self.port = port
+    self.console_port = console_port
+    self.sessions = []
+    self.owner = None
+    self.servers = []
+    self.bytes_in = 0
+    self.bytes_out = 0
+
+  async def start(self):
+    self.servers.append(await asyncio.start_server(self.accept_uart, '0.0.0.0', self.port, backlog=MAX_CONNECTIONS))
+    if self.console:
+      self.servers.append(await asyncio.start_server(self.accept_console, '0.0.0.0', self.console_port, backlog=MAX_CONNECTIONS))
+
+  async def accept_uart(self, reader, writer):
+    await self.accept(reader, writer, MONITOR if self.owner else UART_OWNER)
+
+  async def accept_console(self, reader, writer):
+    await self.accept(reader, writer, CONSOLE)
+
+  async def accept(self, reader, writer, role):
+    if len(self.sessions) >= MAX_CONNECTIONS:
+      log.warning('telnet: too many connections')
+      writer.write(b'Too many connections\r\n')
+      await writer.drain()
+      writer.close()
+      return
+    session = Session(self, reader, writer, role)
+    log.info('telnet %s: %s connection accepted', session.peer, role)
+    self.sessions.append(session)
+    send_options(session)
+    if role == UART_OWNER:
+      self.owner = session
+    elif role == MONITOR:
+      session.write('PicoX-8 serial port monitor, input is ignored\r\n')
+    else:
+      session.console = self.console(session)
+    await session.run()
+
+  def remove(self, session):
+    self.sessions.remove(session)
+    if session is self.owner:
+      self.owner = None
+
+  async def received(self, session, data):
+    if session.role == UART_OWNER:
+      if self.uart_free():
+        await self.write_uart(data)
+    elif session.role == CONSOLE:
+      if session.console.userinput(data):
+        session.closed = True
+
+  async def write_uart(self, data):
+    # write in pieces that fit into the UART FIFO, so that the sender
+    # waits here instead of blocking the main loop in uart.write()
+    self.bytes_in += len(data)
+    for i in range(0, len(data), UART_CHUNK):
+      while not self.uart.txdone():
+        await asyncio.sleep(UART_WAIT)
+      self.uart.write(data[i:i + UART_CHUNK])
+
+  def owns_uart(self):
+    return self.owner is not None and self.uart_free()
 
   def poll(self):
-    if self.client_socket:
-      if self.uart.any() > 0:
-        data = self.uart.read()
-        self.client_socket.sendall(data)
-        print(f'-> {data}')
-      try:
-        data = self.client_socket.recv(1024)
-      except OSError as e:
-        if e.errno == errno.EAGAIN:
-          return
-        raise e
-      if data:
-        print(f'<- {data}')
-        old_data = data
-        data = process_options(self.client_socket, data)
-        self.uart.write(data)
+    if not self.owns_uart() or not self.uart.any():
+      return False
+    room = self.owner.room()
+    if room <= 0:
+      return False                                          # leave the data in the UART until the owner catches up
+    data = self.uart.read(min(room, UART_READ_SIZE))
+    if not data:
+      return False
+    self.bytes_out += len(data)
+    log.debug('-> %r', data)
+    if Commands.IAC in data:
+      data = data.replace(_IAC_BYTE, _IAC_BYTE + _IAC_BYTE)
+    for session in self.sessions:
+      if session.role == CONSOLE:
+        continue
+      if session is self.owner or session.room() >= len(data):
+        session.sendall(data)
       else:
-        self.client_socket.close()
-        self.client_socket = None
-        print('connection closed')
-    else:
-      try:
-        client_socket, client_address = self.server_socket.accept()
-      except OSError as e:
-        if e.errno == errno.EAGAIN:
-          return
-        raise e
-      print(f'connection from {client_address[0]} accepted')
-      self.client_socket = client_socket
-      self.connected = True
-      send_options(self.client_socket)
+        session.dropped += len(data)
+    return True
+
 
 def send_telnet_option(socket, cmd, opt):
-  print(f'telnet > {Commands.get_name(cmd)} {Options.get_name(opt)}')
+  log.debug('telnet > %s %s', Commands.get_name(cmd), Options.get_name(opt))
   socket.sendall(bytes([Commands.IAC, cmd, opt]))
 
-# telnet option negotiation only works for options that arrive within one chunk of received
-# data (i.e. if they span multiple socket read()s, they won't be processed)
-def process_options(socket, data):
-  i = 0
-  count = len(data)
-  j = 0
-  return_data = bytearray(data)
-  while i < count:
-    if data[i] == Commands.IAC and (count - i) >= 3:
-      iac, cmd, opt = data[i:i+3]
-      print(f'telnet < {Commands.get_name(cmd)} {Options.get_name(opt)}')
-      if cmd == Commands.DO:
-        send_telnet_option(socket, Commands.WILL if opt == Options.SGA or opt == Options.ECHO else Commands.WONT, opt)
-      elif cmd == Commands.DONT:
-        send_telnet_option(socket, Commands.WONT, opt)
-      elif cmd == Commands.WILL or cmd == Commands.WONT:
-        pass
-      else:
-        print(f'Unrecognized telnet option {cmd} {opt}')
-      i += 3
-    else:
-      return_data[j] = data[i]
-      j += 1
+# parser states
+_DATA = 0
+_IAC = 1
+_OPTION = 2
+_SB = 3
+_SB_IAC = 4
+
+_IAC_BYTE = bytes([Commands.IAC])
+
+class TelnetParser:
+  """Incremental parser for the data received from a telnet peer.
+
+  feed() strips telnet commands from each received chunk and answers
+  option negotiation.  The parser state is kept between calls, so
+  commands that are split over several chunks are handled, and the
+  payload is written to a buffer allocated once.
+  """
+  def __init__(self, size):
+    self.buffer = bytearray(size)
+    self.view = memoryview(self.buffer)
+    self.reset(None)
+
+  def reset(self, socket):
+    self.socket = socket
+    self.state = _DATA
+    self.command = 0
+    self.option = None
+
+  def feed(self, data):
+    """Returns a memoryview of the payload in data, valid until the
+    next call."""
+    count = len(data)
+    if count > len(self.buffer):
+      self.buffer = bytearray(count)
+      self.view = memoryview(self.buffer)
+    data_view = memoryview(data)
+    out = 0
+    i = 0
+    while i < count:
+      state = self.state
+      if state == _DATA:
+        end = data.find(_IAC_BYTE, i)
+        if end < 0:
+          end = count
+        self.view[out:out + end - i] = data_view[i:end]
+        out += end - i
+        if end < count:
+          self.state = _IAC
+        i = end + 1
+        continue
+      byte = data[i]
       i += 1
-  return return_data[:j]
+      if state == _IAC:
+        if byte == Commands.IAC:
+          self.buffer[out] = byte                           # escaped 0xff data byte
+          out += 1
+          self.state = _DATA
+        elif byte == Commands.SB:
+          self.option = None
+          self.state = _SB
+        elif Commands.WILL <= byte <= Commands.DONT:
+          self.command = byte
+          self.state = _OPTION
+        else:
+          self.state = _DATA                                # two byte command, e.g. NOP or GA
+      elif state == _OPTION:
+        self.negotiate(self.command, byte)
+        self.state = _DATA
+      elif state == _SB:
+        if byte == Commands.IAC:
+          self.state = _SB_IAC
+        elif self.option is None:
+          self.option = byte
+      elif state == _SB_IAC:
+        if byte == Commands.SE:
+          log.debug('telnet < SB %s ... SE ignored', Options.get_name(self.option))
+          self.state = _DATA
+        else:
+          self.state = _SB                                  # IAC IAC inside the subnegotiation
+    return self.view[:out]
+
+  def negotiate(self, cmd, opt):
+    log.debug('telnet < %s %s', Commands.get_name(cmd), Options.get_name(opt))
+    if cmd == Commands.DO:
+      send_telnet_option(self.socket, Commands.WILL if opt == Options.SGA or opt == Options.ECHO else Commands.WONT, opt)
+    elif cmd == Commands.DONT:
+      send_telnet_option(self.socket, Commands.WONT, opt)
 
 def send_options(socket):
   send_telnet_option(socket, Commands.WILL, Options.SGA)
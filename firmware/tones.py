@@ -0,0 +1,220 @@
+import math
+import time
+from array import array
+
+import machine
+import rp2
+import uctypes
+
+# Call progress and DTMF tones are played from wave tables.  A table
+# holds TABLE_SIZE 8 bit samples of a whole number of periods of one
+# frequency, or of two frequencies mixed for DTMF, so that the DMA
+# read ring can loop it without a click.  Each tone is compiled once
+# into DMA control blocks, one (sample count, table address) pair per
+# segment: a control channel loads the next block into the sample
+# channel, which streams the table to the pwm_dac state machine paced
+# by a DMA timer and chains back to the control channel when the
+# segment is over.  The CPU starts a tone and restarts repeating ones
+# from poll(), there is no work per segment.
+
+SAMPLE_RATE = 8000
+TABLE_BITS = 9
+TABLE_SIZE = 1 << TABLE_BITS    # frequencies are rounded to multiples of SAMPLE_RATE / TABLE_SIZE = 15.625 Hz
+TABLE_COUNT = 26                # the 10 call progress frequencies (silence is one) and all 16 DTMF keys
+AMPLITUDE = 127
+SILENCE = 128                   # mid-level, the tables swing around it
+CONTINUOUS = -1                 # duration of a tone that plays until stopped
+
+PWM_TOP = 255
+PWM_FREQ = 20_000_000           # state machine clock, gives a PWM carrier of about 38.8 kHz
+
+DMA_BASE = 0x50000000
+DMA_CHANNEL_SIZE = 0x40
+DMA_AL3_TRANS_COUNT = 0x38      # followed by AL3_READ_ADDR_TRIG
+DMA_TIMER0 = DMA_BASE + 0x420
+DMA_CHAN_ABORT = DMA_BASE + 0x444
+DREQ_TIMER0 = 0x3b
+DREQ_FORCE = 0x3f
+PIO1_TXF0 = 0x50300010          # TX FIFO of state machine 4
+
+
+@rp2.asm_pio(sideset_init=rp2.PIO.OUT_LOW, out_shiftdir=rp2.PIO.SHIFT_RIGHT)
+def pwm_dac():
+    # The DMA writes bytes, which arrive in all four bytes of the FIFO
+    # word, so the sample is taken from the low byte.  When no new
+    # sample is there, pull(noblock) copies x to osr and the last one
+    # is repeated.  isr holds PWM_TOP.
+    pull(noblock)       .side(0)
+    out(x, 8)
+    mov(y, isr)
+    label("count")
+    jmp(x_not_y, "skip")
+    nop()               .side(1)
+    label("skip")
+    jmp(y_dec, "count")
+
+
+SINE = array('b', (round(AMPLITUDE * math.sin(2 * math.pi * i / TABLE_SIZE)) for i in range(TABLE_SIZE)))
+
+
+def fill_table(table, frequencies):
+    steps = [round(frequency * TABLE_SIZE / SAMPLE_RATE) for frequency in frequencies]
+    mask = TABLE_SIZE - 1
+    count = len(steps)
+    for i in range(TABLE_SIZE):
+        total = 0
+        for step in steps:
+            total += SINE[(i * step) & mask]
+        table[i] = SILENCE + total // count
+
+
+class WaveTables:
+    """Tables in one arena aligned to TABLE_SIZE, as the DMA read ring
+    requires.  A table is computed when it is first asked for."""
+
+    def __init__(self, count=TABLE_COUNT):
+        self.count = count
+        self.arena = bytearray((count + 1) * TABLE_SIZE)
+        self.view = memoryview(self.arena)
+        address = uctypes.addressof(self.arena)
+        self.offset = -address % TABLE_SIZE
+        self.address = address + self.offset
+        self.slots = {}                                     # frequencies -> slot
+
+    def slot(self, frequencies):
+        slot = self.slots.get(frequencies)
+        if slot is None:
+            if len(self.slots) == self.count:
+                raise MemoryError('no room for another wave table')
+            slot = len(self.slots)
+            fill_table(self.samples(slot), frequencies)
+            self.slots[frequencies] = slot
+        return slot
+
+    def samples(self, slot):
+        start = self.offset + slot * TABLE_SIZE
+        return self.view[start:start + TABLE_SIZE]
+
+    def table_address(self, frequencies):
+        return self.address + self.slot(frequencies) * TABLE_SIZE
+
+
+class CallProgressTone:
+    """A sequence of frequency, duration (ms) pairs.  A frequency of 0
+    is silence, a tuple of two frequencies is a DTMF tone."""
+
+    def __init__(self, tones, repeats=False):
+        assert len(tones) % 2 == 0
+        self.tones = tones
+        self.repeats = repeats
+        self.blocks = None                                  # set by compile()
+
+    def segments(self):
+        for i in range(0, len(self.tones), 2):
+            frequencies = self.tones[i]
+            if not isinstance(frequencies, tuple):
+                frequencies = (frequencies,)
+            yield frequencies, self.tones[i + 1]
+
+    def compile(self, tables):
+        """Build the DMA control blocks, ended by a null trigger that stops
+        the control channel."""
+        if self.blocks is None:
+            blocks = array('I')
+            for frequencies, duration in self.segments():
+                blocks.append(0xffffffff if duration == CONTINUOUS else duration * SAMPLE_RATE // 1000)
+                blocks.append(tables.table_address(frequencies))
+            blocks.extend((0, 0))
+            self.blocks = blocks
+        return self.blocks
+
+
+CONNECT_DELAY = 3000 # time to wait before opening the data channel after carrier detect was signalled
+
+DIAL_TONE = CallProgressTone((425, CONTINUOUS))
+INVALID_NUMBER_TONE = CallProgressTone((950, 330, 1450, 330, 1880, 330, 0, 1000), repeats=True)
+NO_NETWORK_TONE = CallProgressTone((425, 240, 0, 240), repeats=True)
+BUSY_TONE = CallProgressTone((425, 480, 0, 430), repeats=True)
+RING_TONE = CallProgressTone((425, 1000, 0, 4000))
+ECHO_CANCEL_TONE = CallProgressTone((2100, 430, 20, 20) * 6 + (2225, 430, 20, 20) * 6)
+HANDSHAKE_ANSWER_TONE = CallProgressTone((1650, CONNECT_DELAY))
+HANDSHAKE_ORIGINATE_TONE = CallProgressTone((980, CONNECT_DELAY))
+COMMAND_MODE_TONE = CallProgressTone((425, 240, 0, 240, 425, 240, 0, 3000))
+
+CALL_PROGRESS_TONES = (DIAL_TONE, INVALID_NUMBER_TONE, NO_NETWORK_TONE, BUSY_TONE, RING_TONE, ECHO_CANCEL_TONE,
+                       HANDSHAKE_ANSWER_TONE, HANDSHAKE_ORIGINATE_TONE, COMMAND_MODE_TONE)
+
+
+class ToneEngine:
+    def __init__(self, pin, tables=None):
+        self.tables = tables or WaveTables()
+        self.sm = rp2.StateMachine(4, pwm_dac, freq=PWM_FREQ, sideset_base=pin)
+        self.sm.put(PWM_TOP)
+        self.sm.exec('pull()')
+        self.sm.exec('mov(isr, osr)')
+        self.sm.put(SILENCE)
+        self.sm.active(1)
+        machine.mem32[DMA_TIMER0] = (1 << 16) | (machine.freq() // SAMPLE_RATE)
+        self.samples = rp2.DMA()
+        self.control = rp2.DMA()
+        self.samples.config(write=PIO1_TXF0,
+                            ctrl=self.samples.pack_ctrl(size=0, inc_write=False, ring_size=TABLE_BITS,
+                                                        treq_sel=DREQ_TIMER0, chain_to=self.control.channel))
+        # the control channel writes a block to TRANS_COUNT and READ_ADDR_TRIG,
+        # its write ring wraps back to TRANS_COUNT for the next one
+        self.block_target = DMA_BASE + self.samples.channel * DMA_CHANNEL_SIZE + DMA_AL3_TRANS_COUNT
+        self.control_ctrl = self.control.pack_ctrl(size=2, inc_write=True, ring_size=3, ring_sel=True,
+                                                   treq_sel=DREQ_FORCE)
+        self.tone = None
+        self.started = time.ticks_ms()
+        self.dtmf_tones = {}
+
+    def prepare(self, tones):
+        for tone in tones:
+            tone.compile(self.tables)
+
+    def dtmf_tone(self, low, high):
+        tone = self.dtmf_tones.get((low, high))
+        if not tone:
+            tone = CallProgressTone(((low, high), CONTINUOUS))
+            tone.compile(self.tables)
+            self.dtmf_tones[(low, high)] = tone
+        return tone
+
+    def play(self, tone):
+        self.stop()
+        self.tone = tone
+        tone.compile(self.tables)
+        self.start()
+
+    def start(self):
+        self.started = time.ticks_ms()
+        self.control.config(read=self.tone.blocks, write=self.block_target, count=2, ctrl=self.control_ctrl,
+                            trigger=True)
+
+    def busy(self):
+        return self.control.active() or self.samples.active()
+
+    def stop(self):
+        if self.tone is None:
+            return
+        machine.mem32[DMA_CHAN_ABORT] = (1 << self.control.channel) | (1 << self.samples.channel)
+        while machine.mem32[DMA_CHAN_ABORT]:
+            pass
+        self.tone = None
+        self.sm.put(SILENCE)                                # park the output at mid-level, not low, so it does not click
+
+    def poll(self):
+        """Return True when the tone is over.  A repeating tone is started
+        again; they end in silence, so the delay until the next poll only
+        stretches that a little."""
+        if self.tone is None:
+            return True
+        if self.busy():
+            return False
+        if self.tone.repeats:
+            self.start()
+            return False
+        self.tone = None
+        self.sm.put(0)
+        return True
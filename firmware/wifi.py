@@ -1,12 +1,16 @@
 import network
 import config
 import socket
+import dialer
 
 nic = None
+was_connected = False
+
+credentials = config.setting('wifi', list, None, check=lambda value: len(value) == 2)   # [SSID, key]
 
 def connect():
   global nic
-  wifi_config = config.get('wifi', None)
+  wifi_config = credentials.value
   if not wifi_config:
     print('No "wifi" configuration')
     return
@@ -22,12 +26,32 @@ def connected():
   return nic and nic.status() == network.STAT_GOT_IP
 
 
+def check_connection():
+  """Returns True once each time the link reaches STAT_GOT_IP."""
+  global was_connected
+  now_connected = bool(connected())
+  became_connected = now_connected and not was_connected
+  was_connected = now_connected
+  return became_connected
+
+
+def dns_server():
+  if not connected():
+    return None
+  return nic.ifconfig()[3]
+
+
 def resolve(host, port):
+  address = dialer.cache.lookup(host, port)
+  if address is not None:
+    return address or None
   try:
     info = socket.getaddrinfo(host, port)
   except OSError:
     print(f'Cannot resolve host {host}')
+    dialer.cache.put(host, port, None)
     return None
+  dialer.cache.put(host, port, info[0][-1], dialer.MIN_TTL)
   return info[0][-1]
 
 
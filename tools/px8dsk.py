@@ -0,0 +1,452 @@
+"""Create, list, extract and fill PX-8 RAM-Disk images on the host.
+
+The images are CP/M 2.2 file systems with the px8ramdisk geometry from
+diskdef.txt, the same layout RamDisk.get_sector_offset() uses: track t,
+sector s is at t * 8192 + s * 128.  The image is accessed through mmap,
+and the directory is read once into an index of files and allocated
+blocks, so adding or extracting many files does not rescan it.
+
+    python tools/px8dsk.py create IMAGE
+    python tools/px8dsk.py ls IMAGE
+    python tools/px8dsk.py extract IMAGE [-d DIR] [FILE...]
+    python tools/px8dsk.py add IMAGE FILE...
+    python tools/px8dsk.py pack [--sparse] IMAGE software/<app>/
+    python tools/px8dsk.py sparse FLAT SPARSE
+    python tools/px8dsk.py flat SPARSE FLAT
+
+pack creates IMAGE with all files of the folder in one pass, ready to
+be copied to the SD card and selected with "set ramdisk".  Host file
+names must be valid CP/M 8.3 names, they are stored in upper case.
+
+sparse and flat convert between flat images and the sparse container
+the firmware also reads (SparseFile in firmware/ramdisk.py): a block
+map in which 1K blocks filled with 0x00 or 0xE5 are not stored and
+blocks with the same contents share their data.  ls and extract read
+sparse images as well.
+"""
+
+import argparse
+import mmap
+import os
+import re
+import sys
+
+DISKDEF_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'diskdef.txt')
+DISKDEF_NAME = 'px8ramdisk'
+
+ENTRY_SIZE = 32
+RECORD_SIZE = 128            # CP/M counts file sizes in records
+EXTENT_SIZE = 16384          # bytes in a logical extent
+UNUSED = 0xe5                # user byte of a free directory entry, and format filler
+EOF = 0x1a                   # pads the last record of a file
+MAX_USER = 15
+
+SPARSE_MAGIC = b'PX8S'
+SPARSE_VERSION = 1
+SPARSE_HEADER = 16
+SPARSE_BLOCK = 1024
+SPARSE_DATA = 512
+FIRST_SLOT = 2
+FILLERS = (0x00, 0xe5)
+
+NAME_RE = re.compile(r'^([A-Z0-9!#$%&\'()\-@^_{}~]{1,8})(?:\.([A-Z0-9!#$%&\'()\-@^_{}~]{0,3}))?$')
+
+
+class DiskDef:
+    """A cpmtools disk definition."""
+
+    def __init__(self, seclen=128, tracks=15, sectrk=64, blocksize=1024, maxdir=32, skew=0, boottrk=0):
+        if skew:
+            raise ValueError('sector skew is not supported')
+        self.seclen = seclen
+        self.tracks = tracks
+        self.sectrk = sectrk
+        self.blocksize = blocksize
+        self.maxdir = maxdir
+        self.boottrk = boottrk
+        self.size = tracks * sectrk * seclen
+        self.blocks = (tracks - boottrk) * sectrk * seclen // blocksize     # DSM + 1
+        self.dir_blocks = -(-maxdir * ENTRY_SIZE // blocksize)
+        self.pointer_size = 1 if self.blocks <= 256 else 2
+        self.pointers = 16 // self.pointer_size                             # block pointers per entry
+        self.exm = self.pointers * blocksize // EXTENT_SIZE - 1             # extent mask
+        self.entry_records = self.pointers * blocksize // RECORD_SIZE
+
+    def block_offset(self, block):
+        return self.boottrk * self.sectrk * self.seclen + block * self.blocksize
+
+
+def read_diskdef(filename=DISKDEF_FILE, name=DISKDEF_NAME):
+    """Return the DiskDef named name from a cpmtools diskdefs file."""
+    params = None
+    with open(filename) as f:
+        for line in f:
+            words = line.split()
+            if not words:
+                continue
+            if words[0] == 'diskdef':
+                params = {} if words[1:] == [name] else None
+            elif params is not None:
+                if words[0] == 'end':
+                    return DiskDef(**{key: int(params[key]) for key in params
+                                      if key in ('seclen', 'tracks', 'sectrk', 'blocksize', 'maxdir', 'skew', 'boottrk')})
+                params[words[0]] = words[1]
+    raise ValueError(f'{filename}: no diskdef {name}')
+
+
+def cpm_name(filename):
+    """Return the 11 byte directory name of a host file name."""
+    match = NAME_RE.match(os.path.basename(filename).upper())
+    if not match:
+        raise ValueError(f'{filename!r} is not a valid CP/M file name')
+    base, ext = match.group(1), match.group(2) or ''
+    return f'{base:<8}{ext:<3}'.encode('ascii')
+
+
+def host_name(name):
+    base = name[:8].decode('ascii', 'replace').rstrip()
+    ext = name[8:].decode('ascii', 'replace').rstrip()
+    return f'{base}.{ext}' if ext else base
+
+
+def is_sparse(data):
+    return data[:len(SPARSE_MAGIC)] == SPARSE_MAGIC
+
+
+def to_sparse(data):
+    """Return the sparse container holding the flat image data."""
+    blocks = len(data) // SPARSE_BLOCK
+    header = bytearray(SPARSE_DATA)
+    header[:4] = SPARSE_MAGIC
+    header[4:8] = bytes((SPARSE_VERSION, SPARSE_BLOCK // 1024, blocks & 0xff, blocks >> 8))
+    fillers = {bytes([fill]) * SPARSE_BLOCK: entry for entry, fill in enumerate(FILLERS)}
+    slots = {}
+    stored = []
+    for block in range(blocks):
+        contents = bytes(data[block * SPARSE_BLOCK:(block + 1) * SPARSE_BLOCK])
+        entry = fillers.get(contents)
+        if entry is None:
+            entry = slots.get(contents)
+            if entry is None:
+                entry = slots[contents] = FIRST_SLOT + len(stored)
+                stored.append(contents)
+        header[SPARSE_HEADER + 2 * block:SPARSE_HEADER + 2 * block + 2] = bytes((entry & 0xff, entry >> 8))
+    return bytes(header) + b''.join(stored)
+
+
+def to_flat(data):
+    """Return the flat image stored in the sparse container data."""
+    if not is_sparse(data) or data[4] != SPARSE_VERSION or data[5] * 1024 != SPARSE_BLOCK:
+        raise ValueError('not a sparse image')
+    flat = bytearray()
+    for block in range(data[6] | data[7] << 8):
+        entry = data[SPARSE_HEADER + 2 * block] | data[SPARSE_HEADER + 2 * block + 1] << 8
+        if entry < FIRST_SLOT:
+            flat += bytes([FILLERS[entry]]) * SPARSE_BLOCK
+        else:
+            offset = SPARSE_DATA + (entry - FIRST_SLOT) * SPARSE_BLOCK
+            flat += data[offset:offset + SPARSE_BLOCK]
+    return bytes(flat)
+
+
+class File:
+    def __init__(self, user, name):
+        self.user = user
+        self.name = name                                    # 11 bytes, attribute bits cleared
+        self.entries = []                                   # directory entry numbers, in extent order
+        self.records = 0
+        self.blocks = []
+
+    @property
+    def host_name(self):
+        return host_name(self.name)
+
+    @property
+    def size(self):
+        return self.records * RECORD_SIZE
+
+
+class Image:
+    """A RAM-Disk image file, opened read-only unless writable is set.
+    Sparse images are expanded into memory and can only be read."""
+
+    def __init__(self, filename, diskdef=None, writable=False):
+        self.diskdef = diskdef or read_diskdef()
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            data = f.read(len(SPARSE_MAGIC))
+            if is_sparse(data):
+                if writable:
+                    raise ValueError(f'{filename}: sparse images can only be read, convert it with "flat" first')
+                data += f.read()
+        if is_sparse(data):
+            data = to_flat(data)
+            self.file = None
+            self.map = mmap.mmap(-1, len(data))
+            self.map[:] = data
+        else:
+            self.file = open(filename, 'r+b' if writable else 'rb')
+            size = os.fstat(self.file.fileno()).st_size
+            if size != self.diskdef.size:
+                self.file.close()
+                raise ValueError(f'{filename}: size is {size}, expected {self.diskdef.size}')
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        if len(self.map) != self.diskdef.size:
+            self.close()
+            raise ValueError(f'{filename}: holds {len(self.map)} bytes, expected {self.diskdef.size}')
+        self.read_directory()
+
+    def close(self):
+        if self.map:
+            self.map.flush()
+            self.map.close()
+        if self.file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # directory index
+
+    def entry_offset(self, number):
+        return self.diskdef.block_offset(0) + number * ENTRY_SIZE
+
+    def entry_blocks(self, entry):
+        pointers = entry[16:32]
+        if self.diskdef.pointer_size == 2:
+            pointers = [pointers[i] | pointers[i + 1] << 8 for i in range(0, 16, 2)]
+        return [block for block in pointers if block]
+
+    def read_directory(self):
+        """Build the index of files, free directory entries and allocated
+        blocks.  An all zero directory, as in the images the Pico creates
+        before the PX-8 formats them, counts as empty."""
+        diskdef = self.diskdef
+        self.files = {}
+        self.free_entries = []
+        self.allocated = bytearray(diskdef.blocks)
+        for block in range(diskdef.dir_blocks):
+            self.allocated[block] = 1
+        blank = not any(self.map[self.entry_offset(0):self.entry_offset(diskdef.maxdir)])
+        extents = {}
+        for number in range(diskdef.maxdir):
+            entry = self.map[self.entry_offset(number):self.entry_offset(number + 1)]
+            if blank or entry[0] > MAX_USER:
+                self.free_entries.append(number)
+                continue
+            name = bytes(c & 0x7f for c in entry[1:12])
+            key = entry[0], name
+            file = self.files.get(key)
+            if file is None:
+                file = self.files[key] = File(entry[0], name)
+            extent = entry[14] << 5 | entry[12] & 0x1f
+            extents[number] = extent
+            file.entries.append(number)
+            blocks = self.entry_blocks(entry)
+            for block in blocks:
+                if block < diskdef.blocks:
+                    self.allocated[block] = 1
+            file.records = max(file.records, extent * (EXTENT_SIZE // RECORD_SIZE) + entry[15])
+        for file in self.files.values():
+            file.entries.sort(key=extents.get)
+            for number in file.entries:
+                offset = self.entry_offset(number)
+                file.blocks += self.entry_blocks(self.map[offset:offset + ENTRY_SIZE])
+
+    def lookup(self, filename, user=0):
+        return self.files.get((user, cpm_name(filename)))
+
+    def free_blocks(self):
+        return self.allocated.count(0)
+
+    # file access
+
+    def read(self, file):
+        diskdef = self.diskdef
+        data = bytearray()
+        for block in file.blocks:
+            offset = diskdef.block_offset(block)
+            data += self.map[offset:offset + diskdef.blocksize]
+        return bytes(data[:file.size])
+
+    def remove(self, file):
+        for number in file.entries:
+            self.map[self.entry_offset(number)] = UNUSED
+            self.free_entries.append(number)
+        for block in file.blocks:
+            self.allocated[block] = 0
+        self.free_entries.sort()
+        del self.files[file.user, file.name]
+
+    def write(self, filename, data, user=0):
+        """Store data as filename, replacing an existing file.  Raises
+        OSError if the image has not enough space left."""
+        diskdef = self.diskdef
+        name = cpm_name(filename)
+        records = -(-len(data) // RECORD_SIZE)
+        block_count = -(-len(data) // diskdef.blocksize)
+        entry_count = max(1, -(-records // diskdef.entry_records))
+        old = self.files.get((user, name))
+        free_blocks = self.free_blocks() + (len(old.blocks) if old else 0)
+        free_entries = len(self.free_entries) + (len(old.entries) if old else 0)
+        if block_count > free_blocks or entry_count > free_entries:
+            raise OSError(f'{filename}: not enough space on {self.filename}')
+        if old:
+            self.remove(old)
+        blocks = [block for block in range(diskdef.blocks) if not self.allocated[block]][:block_count]
+        padded = bytes(data) + bytes([EOF]) * (records * RECORD_SIZE - len(data))
+        for i, block in enumerate(blocks):
+            self.allocated[block] = 1
+            chunk = padded[i * diskdef.blocksize:(i + 1) * diskdef.blocksize]
+            offset = diskdef.block_offset(block)
+            self.map[offset:offset + len(chunk)] = chunk
+        file = self.files[user, name] = File(user, name)
+        file.records = records
+        file.blocks = blocks
+        for i in range(entry_count):
+            number = self.free_entries.pop(0)
+            entry_records = min(records - i * diskdef.entry_records, diskdef.entry_records)
+            extent = i * (diskdef.exm + 1) + max(0, -(-entry_records // (EXTENT_SIZE // RECORD_SIZE)) - 1)
+            rc = entry_records - (extent & diskdef.exm) * (EXTENT_SIZE // RECORD_SIZE)
+            pointers = blocks[i * diskdef.pointers:(i + 1) * diskdef.pointers]
+            if diskdef.pointer_size == 2:
+                pointers = [byte for block in pointers for byte in (block & 0xff, block >> 8)]
+            entry = bytes([user]) + name + bytes([extent & 0x1f, 0, extent >> 5, rc]) + bytes(pointers)
+            offset = self.entry_offset(number)
+            self.map[offset:offset + ENTRY_SIZE] = entry.ljust(ENTRY_SIZE, b'\0')
+            file.entries.append(number)
+        return file
+
+
+def create(filename, diskdef=None):
+    """Create a formatted, empty image and return it opened for writing."""
+    diskdef = diskdef or read_diskdef()
+    with open(filename, 'wb') as f:
+        f.write(bytes([UNUSED]) * diskdef.size)
+    return Image(filename, diskdef, writable=True)
+
+
+def convert(source, destination, function):
+    with open(source, 'rb') as f:
+        data = function(f.read())
+    with open(destination, 'wb') as f:
+        f.write(data)
+    return data
+
+
+def pack(filename, directory, diskdef=None, sparse=False):
+    """Create filename holding the files in directory, as a sparse
+    image if sparse is set."""
+    names = sorted(name for name in os.listdir(directory) if os.path.isfile(os.path.join(directory, name)))
+    for name in names:
+        cpm_name(name)                                      # fail before anything is written
+    with create(filename, diskdef) as image:
+        for name in names:
+            with open(os.path.join(directory, name), 'rb') as f:
+                image.write(name, f.read())
+    if sparse:
+        convert(filename, filename, to_sparse)
+    return names
+
+
+def cmd_create(args):
+    create(args.image).close()
+
+
+def cmd_ls(args):
+    with Image(args.image) as image:
+        files = sorted(image.files.values(), key=lambda file: (file.user, file.name))
+        for file in files:
+            user = f'{file.user}:' if file.user else ''
+            print(f'{user + file.host_name:<15} {file.size:>7}')
+        free = image.free_blocks() * image.diskdef.blocksize
+        print(f'{len(files)} file(s), {free // 1024}K free, {len(image.free_entries)} directory entries free')
+
+
+def cmd_extract(args):
+    os.makedirs(args.directory, exist_ok=True)
+    with Image(args.image) as image:
+        if args.files:
+            files = []
+            for name in args.files:
+                file = image.lookup(name, args.user)
+                if file is None:
+                    raise OSError(f'{name}: not found on {args.image}')
+                files.append(file)
+        else:
+            files = [file for file in image.files.values() if file.user == args.user]
+        for file in files:
+            with open(os.path.join(args.directory, file.host_name), 'wb') as f:
+                f.write(image.read(file))
+
+
+def cmd_add(args):
+    with Image(args.image, writable=True) as image:
+        for name in args.files:
+            with open(name, 'rb') as f:
+                image.write(name, f.read(), args.user)
+
+
+def cmd_pack(args):
+    if os.path.exists(args.image) and not args.force:
+        raise OSError(f'{args.image} already exists, use --force to replace it')
+    names = pack(args.image, args.directory, sparse=args.sparse)
+    print(f'{args.image}: {len(names)} file(s) from {args.directory}')
+
+
+def cmd_sparse(args):
+    data = convert(args.source, args.destination, to_sparse)
+    print(f'{args.destination}: {len(data)} bytes, {(len(data) - SPARSE_DATA) // SPARSE_BLOCK} block(s) stored')
+
+
+def cmd_flat(args):
+    convert(args.source, args.destination, to_flat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PX-8 RAM-Disk image tool')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('create', help='create an empty image')
+    command.add_argument('image')
+    command.set_defaults(function=cmd_create)
+    command = commands.add_parser('ls', help='list the files in an image')
+    command.add_argument('image')
+    command.set_defaults(function=cmd_ls)
+    command = commands.add_parser('extract', help='copy files from an image')
+    command.add_argument('image')
+    command.add_argument('files', nargs='*')
+    command.add_argument('-d', '--directory', default='.')
+    command.add_argument('-u', '--user', type=int, default=0)
+    command.set_defaults(function=cmd_extract)
+    command = commands.add_parser('add', help='copy files into an image')
+    command.add_argument('image')
+    command.add_argument('files', nargs='+')
+    command.add_argument('-u', '--user', type=int, default=0)
+    command.set_defaults(function=cmd_add)
+    command = commands.add_parser('pack', help='create an image holding the files of a folder')
+    command.add_argument('image')
+    command.add_argument('directory')
+    command.add_argument('-f', '--force', action='store_true')
+    command.add_argument('-s', '--sparse', action='store_true', help='create a sparse image')
+    command.set_defaults(function=cmd_pack)
+    command = commands.add_parser('sparse', help='convert a flat image to a sparse one')
+    command.add_argument('source')
+    command.add_argument('destination')
+    command.set_defaults(function=cmd_sparse)
+    command = commands.add_parser('flat', help='convert a sparse image to a flat one')
+    command.add_argument('source')
+    command.add_argument('destination')
+    command.set_defaults(function=cmd_flat)
+    args = parser.parse_args()
+    try:
+        args.function(args)
+    except (OSError, ValueError) as e:
+        print(f'{parser.prog}: {e}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()